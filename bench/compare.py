@@ -0,0 +1,83 @@
+"""
+Compare two proxy_bench.py result files and flag regressions.
+
+    python compare.py results/before.json results/after.json --tolerance 0.10
+
+Exits 1 if any tracked metric got worse by more than the tolerance.
+"""
+import argparse
+import json
+
+# (metric path inside an endpoint summary, True if higher is better)
+TRACKED = [
+    (('rps',), True),
+    (('ttfc', 'p50'), False),
+    (('ttfc', 'p95'), False),
+    (('ttfc', 'p99'), False),
+    (('ttft', 'p50'), False),
+    (('ttft', 'p95'), False),
+    (('latency', 'p50'), False),
+    (('latency', 'p95'), False),
+    (('latency', 'p99'), False),
+    (('chunk_rate', 'p50'), True),
+]
+
+
+def lookup(summary, path):
+    for key in path:
+        if not isinstance(summary, dict):
+            return None
+        summary = summary.get(key)
+    return summary
+
+
+def compare_results(baseline, current, tolerance=0.10):
+    rows = []
+    before = baseline['summary']['endpoints']
+    after = current['summary']['endpoints']
+    for endpoint in sorted(before.keys() & after.keys()):
+        for path, higher_is_better in TRACKED:
+            old = lookup(before[endpoint], path)
+            new = lookup(after[endpoint], path)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = -change if higher_is_better else change
+            rows.append({
+                'endpoint': endpoint,
+                'metric': '.'.join(path),
+                'baseline': old,
+                'current': new,
+                'change': change,
+                'regressed': worse > tolerance,
+            })
+    return rows
+
+
+def print_comparison(rows):
+    print(f"\n{'endpoint':<12} {'metric':<16} {'baseline':>10} {'current':>10} {'change':>8}")
+    for row in rows:
+        flag = '  REGRESSED' if row['regressed'] else ''
+        print(f"{row['endpoint']:<12} {row['metric']:<16} {row['baseline']:>10.4g} {row['current']:>10.4g} "
+              f"{row['change'] * 100:>+7.1f}%{flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files.")
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Allowed regression (default: 10%%)")
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    rows = compare_results(baseline, current, args.tolerance)
+    print_comparison(rows)
+    if any(row['regressed'] for row in rows):
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,440 @@
+"""
+Load generator for the Open WebUI proxy (openwebui/proxy.py).
+
+Sends the requests Open WebUI sends (/api/chat with Substrate:-prefixed model
+names, plus its /api/tags and /api/version polling) at a fixed concurrency or
+arrival rate, with a configurable mix of prompt lengths and streaming vs
+non-streaming chats. Reports RPS, time-to-first-chunk, total latency and chunk
+throughput, and writes everything to JSON so runs can be compared with
+compare.py.
+
+Without --url it starts its own fake Substrate upstream and proxy, so a run
+needs no API key and is repeatable:
+
+    python proxy_bench.py --concurrency 32 --duration 30 --profile realistic
+    python proxy_bench.py --url http://127.0.0.1:11435 --rate 20 --baseline results/main.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import httpx
+
+from compare import compare_results, print_comparison
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(HERE)
+
+WORDS = """
+system cache stream token model latency request server client proxy answer question
+history memory vector graph python function result error retry window budget prompt
+summary detail example reason because should would could might always never often
+quick brown fox jumps over lazy dog while parrot talks about blue skies and green trees
+""".split()
+
+SYSTEM_PROMPT = "You are a helpful assistant. Answer concisely and accurately."
+
+
+def parse_mix(value):
+    """'chat=90,tags=8,version=2' -> [('chat', 90.0), ...]"""
+    mix = []
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        mix.append((name.strip(), float(weight or 1)))
+    return mix
+
+
+def pick(rng, mix):
+    names, weights = zip(*mix)
+    return rng.choices(names, weights)[0]
+
+
+def filler(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def build_messages(rng, kind, nonce):
+    """Message lists shaped like Open WebUI conversations of different sizes."""
+    if kind == 'short':
+        return [{"role": "user", "content": f"{filler(rng, 12)}? ({nonce})"}]
+    if kind == 'medium':
+        return [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": filler(rng, 40)},
+            {"role": "assistant", "content": filler(rng, 60)},
+            {"role": "user", "content": f"{filler(rng, 50)}? ({nonce})"},
+        ]
+    # long: a pasted document followed by a question about it
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": f"Here is a document:\n\n{filler(rng, 1500)}\n\nSummarize it. ({nonce})"},
+    ]
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def at(q):
+        return values[min(len(values) - 1, int(len(values) * q))]
+    return {
+        'p50': at(0.50),
+        'p95': at(0.95),
+        'p99': at(0.99),
+        'mean': sum(values) / len(values),
+        'max': values[-1],
+    }
+
+
+class Workload:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.mix = parse_mix(args.mix)
+        self.prompt_mix = parse_mix(args.prompt_mix)
+        self.sent = []  # message lists already sent, for --repeat-ratio
+        self.count = 0
+
+    def next_request(self):
+        """(endpoint label, method, path, json body, prompt class)"""
+        self.count += 1
+        endpoint = pick(self.rng, self.mix)
+        if endpoint == 'tags':
+            return 'tags', 'GET', '/api/tags', None, None
+        if endpoint == 'version':
+            return 'version', 'GET', '/api/version', None, None
+
+        stream = self.rng.random() < self.args.stream_ratio
+        model = self.rng.choice(self.args.models)
+        if self.sent and self.rng.random() < self.args.repeat_ratio:
+            kind, messages = self.rng.choice(self.sent)
+        else:
+            kind = pick(self.rng, self.prompt_mix)
+            messages = build_messages(self.rng, kind, f"{self.args.seed}-{self.count}")
+            if len(self.sent) < 1000:
+                self.sent.append((kind, messages))
+        body = {
+            "model": f"Substrate:{model}",
+            "messages": messages,
+            "stream": stream,
+            "options": {},
+        }
+        return ('chat_stream' if stream else 'chat'), 'POST', '/api/chat', body, kind
+
+
+async def send(client, method, path, body, headers=None):
+    """Issue one request and time it. Returns a result dict."""
+    start = time.perf_counter()
+    ttfc = None
+    ttft = None
+    chunks = 0
+    size = 0
+    first_chunk_at = last_chunk_at = None
+    status = None
+    error = None
+    failed = False
+    try:
+        async with client.stream(method, path, json=body, headers=headers) as response:
+            status = response.status_code
+            pending = b''
+            async for raw in response.aiter_raw():
+                now = time.perf_counter()
+                if ttfc is None:
+                    ttfc = now - start
+                size += len(raw)
+                # A chunk is one NDJSON message, however the bytes were framed
+                pending += raw
+                *lines, pending = pending.split(b'\n')
+                for line in lines:
+                    chunks += 1
+                    if first_chunk_at is None:
+                        first_chunk_at = now
+                    last_chunk_at = now
+                    failed = failed or b'"error"' in line
+                    # Heartbeats and the done message carry empty content
+                    if ttft is None and b'"content":"' in line and b'"content":""' not in line:
+                        ttft = now - start
+            if pending:
+                chunks += 1
+                failed = failed or b'"error"' in pending
+            if status != 200:
+                error = f"http_{status}"
+            elif failed:
+                error = 'error_message'
+    except httpx.HTTPError as e:
+        error = type(e).__name__
+    total = time.perf_counter() - start
+    rate = None
+    if chunks > 1 and last_chunk_at > first_chunk_at:
+        rate = (chunks - 1) / (last_chunk_at - first_chunk_at)
+    return {
+        'status': status,
+        'error': error,
+        'ttfc': ttfc,
+        'ttft': ttft,
+        'latency': total,
+        'chunks': chunks,
+        'bytes': size,
+        'chunk_rate': rate,
+    }
+
+
+async def run_load(base_url, args):
+    workload = Workload(args)
+    results = []
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    started = time.perf_counter()
+    measure_from = started + args.warmup
+    deadline = measure_from + args.duration
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=args.timeout) as client:
+        async def one(request, scheduled):
+            label, method, path, body, kind = request
+            result = await send(client, method, path, body, args.headers)
+            if args.rate:
+                # Open loop: count time spent waiting for a free slot, or the
+                # numbers would hide exactly the queueing we want to see
+                queued = time.perf_counter() - scheduled - result['latency']
+                result['latency'] += queued
+                for field in ('ttfc', 'ttft'):
+                    if result[field] is not None:
+                        result[field] += queued
+            if scheduled >= measure_from:
+                result.update(endpoint=label, prompt=kind, at=scheduled - measure_from)
+                results.append(result)
+
+        if args.rate:
+            slots = asyncio.Semaphore(args.concurrency)
+            tasks = []
+
+            async def limited(request, scheduled):
+                async with slots:
+                    await one(request, scheduled)
+
+            arrivals = random.Random(args.seed + 1)
+            next_at = time.perf_counter()
+            while next_at < deadline:
+                await asyncio.sleep(max(0.0, next_at - time.perf_counter()))
+                tasks.append(asyncio.ensure_future(limited(workload.next_request(), next_at)))
+                next_at += arrivals.expovariate(args.rate)
+            await asyncio.gather(*tasks)
+        else:
+            async def user():
+                while time.perf_counter() < deadline:
+                    await one(workload.next_request(), time.perf_counter())
+            await asyncio.gather(*(user() for _ in range(args.concurrency)))
+
+        server = {}
+        for path in ('/api/engine', '/api/cache'):
+            try:
+                server[path] = (await client.get(path)).json()
+            except (httpx.HTTPError, ValueError):
+                pass
+
+    return results, server
+
+
+def summarize(results, duration):
+    def group(items):
+        ok = [r for r in items if r['error'] is None]
+        return {
+            'requests': len(items),
+            'errors': len(items) - len(ok),
+            'rps': len(items) / duration,
+            'ttfc': percentiles([r['ttfc'] for r in ok if r['ttfc'] is not None]),
+            'ttft': percentiles([r['ttft'] for r in ok if r['ttft'] is not None]),
+            'latency': percentiles([r['latency'] for r in ok]),
+            'chunk_rate': percentiles([r['chunk_rate'] for r in ok if r['chunk_rate'] is not None]),
+            'chunks': sum(r['chunks'] for r in ok),
+            'bytes': sum(r['bytes'] for r in ok),
+            'chunks_per_second': sum(r['chunks'] for r in ok) / duration,
+        }
+
+    errors = {}
+    for r in results:
+        if r['error']:
+            errors[r['error']] = errors.get(r['error'], 0) + 1
+
+    summary = {'overall': group(results), 'errors': errors, 'endpoints': {}, 'prompts': {}}
+    for label in sorted({r['endpoint'] for r in results}):
+        summary['endpoints'][label] = group([r for r in results if r['endpoint'] == label])
+    for kind in sorted({r['prompt'] for r in results if r['prompt']}):
+        summary['prompts'][kind] = group([r for r in results if r['prompt'] == kind])
+    return summary
+
+
+def git_info():
+    def git(*cmd):
+        try:
+            return subprocess.run(['git', *cmd], cwd=REPO, capture_output=True, text=True, timeout=10).stdout.strip()
+        except (OSError, subprocess.SubprocessError):
+            return None
+    return {'commit': git('rev-parse', 'HEAD'), 'dirty': bool(git('status', '--porcelain', '--untracked-files=no'))}
+
+
+def ms(value):
+    return f"{value * 1000:.0f}" if value is not None else '-'
+
+
+def print_summary(summary):
+    print(f"\n{'endpoint':<12} {'reqs':>6} {'err':>5} {'rps':>7} {'ttfc p50':>9} {'p95':>7} {'p99':>7} "
+          f"{'ttft p50':>9} {'p95':>7} {'lat p50':>8} {'p95':>7} {'p99':>7} {'chunks/s':>9}")
+    rows = list(summary['endpoints'].items()) + [('overall', summary['overall'])]
+    for label, g in rows:
+        ttfc = g['ttfc'] or {}
+        ttft = g['ttft'] or {}
+        latency = g['latency'] or {}
+        rate = g['chunk_rate'] or {}
+        print(f"{label:<12} {g['requests']:>6} {g['errors']:>5} {g['rps']:>7.1f} {ms(ttfc.get('p50')):>9} "
+              f"{ms(ttfc.get('p95')):>7} {ms(ttfc.get('p99')):>7} {ms(ttft.get('p50')):>9} {ms(ttft.get('p95')):>7} "
+              f"{ms(latency.get('p50')):>8} "
+              f"{ms(latency.get('p95')):>7} {ms(latency.get('p99')):>7} "
+              f"{rate.get('p50', 0):>9.0f}")
+    if summary['errors']:
+        print(f"errors: {summary['errors']}")
+    print("(times in ms; ttft is the first chunk with content; chunks/s is the median per-stream rate)")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def wait_for(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def spawn(args, tmp):
+    """Start the fake upstream and the proxy; returns (base_url, processes)."""
+    upstream_port = free_port()
+    upstream = subprocess.Popen(
+        [sys.executable, '-m', 'fakesubstrate', '--port', str(upstream_port), '--profile', args.profile,
+         '--seed', str(args.seed)],
+        cwd=REPO, stderr=subprocess.DEVNULL)
+    config_file = args.proxy_config
+    if not config_file:
+        config_file = os.path.join(tmp, 'config.json')
+        with open(config_file, 'w') as f:
+            # Measure the streaming path, not the cache
+            json.dump({'cache_enabled': False}, f)
+    env = dict(os.environ,
+               SUBSTRATE_PROXY_CONFIG=os.path.abspath(config_file),
+               SUBSTRATE_API_KEY='bench',
+               SUBSTRATE_BASE_URL=f'http://127.0.0.1:{upstream_port}')
+    port = free_port()
+    proxy = subprocess.Popen(
+        [sys.executable, os.path.join(REPO, 'openwebui', 'serve.py'), '--workers', str(args.workers),
+         '--bind', f'127.0.0.1:{port}', '--log-level', 'warning', '--graceful-timeout', '5'],
+        env=env, stderr=subprocess.DEVNULL)
+    base_url = f'http://127.0.0.1:{port}'
+    asyncio.run(wait_for(f'http://127.0.0.1:{upstream_port}/health'))
+    asyncio.run(wait_for(f'{base_url}/api/version'))
+    return base_url, [proxy, upstream]
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Benchmark the Open WebUI proxy endpoints.")
+    parser.add_argument("--url", help="Proxy to benchmark (default: start a proxy against the fake upstream)")
+    parser.add_argument("--concurrency", type=int, default=16, help="Virtual users, or max in flight with --rate")
+    parser.add_argument("--rate", type=float, help="Open-loop arrivals per second instead of closed-loop users")
+    parser.add_argument("--duration", type=float, default=20.0, help="Seconds to measure")
+    parser.add_argument("--warmup", type=float, default=2.0, help="Seconds of load before measuring")
+    parser.add_argument("--mix", default="chat=90,tags=8,version=2", help="Endpoint weights")
+    parser.add_argument("--prompt-mix", default="short=60,medium=30,long=10", help="Prompt length weights")
+    parser.add_argument("--stream-ratio", type=float, default=0.8, help="Fraction of chats with stream=true")
+    parser.add_argument("--repeat-ratio", type=float, default=0.0, help="Fraction of chats reusing an earlier prompt")
+    parser.add_argument("--models", nargs='+', default=["Llama3Instruct8B"])
+    parser.add_argument("--header", action='append', default=[], metavar='NAME:VALUE',
+                        help="Extra request header, e.g. X-Stream-Mode:burst (repeatable)")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--profile", default="fast", help="Fake upstream profile when spawning (default: fast)")
+    parser.add_argument("--workers", type=int, default=1, help="Proxy workers when spawning")
+    parser.add_argument("--proxy-config", help="Proxy config file when spawning (default: cache disabled)")
+    parser.add_argument("--output", help="Results file (default: results/<time>-<commit>.json)")
+    parser.add_argument("--baseline", help="Earlier results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Allowed regression vs baseline (default: 10%%)")
+    return parser
+
+
+def parse_args(argv=None):
+    args = build_parser().parse_args(argv)
+    args.headers = dict(h.split(':', 1) for h in args.header)
+    return args
+
+
+def main():
+    args = parse_args()
+
+    processes = []
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            base_url = args.url
+            if not base_url:
+                base_url, processes = spawn(args, tmp)
+            print(f"Benchmarking {base_url} for {args.duration:.0f}s "
+                  f"({'rate ' + str(args.rate) + '/s' if args.rate else str(args.concurrency) + ' users'})", flush=True)
+            results, server = asyncio.run(run_load(base_url, args))
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait(timeout=30)
+
+    summary = summarize(results, args.duration)
+    print_summary(summary)
+
+    git = git_info()
+    report = {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'git_commit': git['commit'],
+            'git_dirty': git['dirty'],
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'target': args.url or f"spawned ({args.workers} worker(s), fake upstream '{args.profile}')",
+            'args': vars(args),
+        },
+        'summary': summary,
+        'server': server,
+        'requests': results,
+    }
+    output = args.output
+    if not output:
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        output = os.path.join(HERE, 'results', f"{stamp}-{(git['commit'] or 'nogit')[:8]}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        rows = compare_results(baseline, report, args.tolerance)
+        print_comparison(rows)
+        if any(row['regressed'] for row in rows):
+            exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Compare the proxy's two ways of sending answers from models that can't stream.
+
+Starts the fake upstream and one proxy, then runs the same /api/chat load
+against a non-streaming model once per X-Stream-Mode value:
+
+    python stream_modes.py --model gpt-4o --profile realistic --duration 15
+
+'adaptive' should show a time to first chunk close to zero (the heartbeat)
+and more, smaller chunks; 'burst' a first chunk that arrives with the answer.
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+
+from proxy_bench import parse_args, run_load, spawn, summarize, ms
+
+MODES = ['adaptive', 'burst']
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark adaptive vs burst pseudo-streaming.")
+    parser.add_argument("--model", default="gpt-4o", help="A model without upstream streaming")
+    parser.add_argument("--modes", nargs='+', default=MODES, choices=MODES)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=15.0)
+    parser.add_argument("--profile", default="realistic", help="Fake upstream profile (default: realistic)")
+    parser.add_argument("--prompt-mix", default="short=60,medium=30,long=10")
+    parser.add_argument("--output", help="Write the per-mode summaries to this JSON file")
+    options = parser.parse_args()
+
+    summaries = {}
+    processes = []
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            for mode in options.modes:
+                args = parse_args([
+                    '--mix', 'chat=1', '--stream-ratio', '1', '--models', options.model,
+                    '--prompt-mix', options.prompt_mix, '--profile', options.profile,
+                    '--concurrency', str(options.concurrency), '--duration', str(options.duration),
+                    '--header', f'X-Stream-Mode:{mode}',
+                ])
+                if not processes:
+                    base_url, processes = spawn(args, tmp)
+                print(f"{mode}: {options.concurrency} users for {options.duration:.0f}s", flush=True)
+                results, _ = asyncio.run(run_load(base_url, args))
+                summaries[mode] = summarize(results, args.duration)['overall']
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait(timeout=30)
+
+    print(f"\n{'mode':<10} {'reqs':>6} {'err':>5} {'ttfc p50':>9} {'p95':>7} {'ttft p50':>9} {'p95':>7} "
+          f"{'lat p50':>8} {'p95':>7} {'chunks/resp':>12}")
+    for mode, g in summaries.items():
+        ttfc = g['ttfc'] or {}
+        ttft = g['ttft'] or {}
+        latency = g['latency'] or {}
+        ok = g['requests'] - g['errors']
+        print(f"{mode:<10} {g['requests']:>6} {g['errors']:>5} {ms(ttfc.get('p50')):>9} {ms(ttfc.get('p95')):>7} "
+              f"{ms(ttft.get('p50')):>9} {ms(ttft.get('p95')):>7} {ms(latency.get('p50')):>8} "
+              f"{ms(latency.get('p95')):>7} {g['chunks'] / ok if ok else 0:>12.1f}")
+    print("(times in ms; ttfc includes heartbeats, ttft is the first chunk with content)")
+
+    if options.output:
+        os.makedirs(os.path.dirname(os.path.abspath(options.output)), exist_ok=True)
+        with open(options.output, 'w') as f:
+            json.dump({'model': options.model, 'profile': options.profile, 'modes': summaries}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+import os
+import shutil
+import asyncio
+import logging
+from substrate import FindOrCreateVectorStore, MultiEmbedText, QueryVectorStore, ListVectorStores, DeleteVectorStore
+from localstore import LocalVectorIndex
+
+
+class RemoteBackend:
+    """Collections in Substrate's hosted vector store."""
+
+    def __init__(self, substrate, model):
+        self.substrate = substrate
+        self.model = model
+
+    def create(self, collection_name):
+        create = FindOrCreateVectorStore(
+            collection_name=collection_name,
+            model=self.model,
+        )
+        self.substrate.run(create)
+
+    def write(self, entries):
+        """
+        Embed and store entries, one MultiEmbedText node per collection in a
+        single graph. Returns their vectors, in the order of `entries`.
+        """
+        by_collection = {}
+        for entry in entries:
+            by_collection.setdefault(entry['collection_name'], []).append(entry)
+        nodes = [
+            MultiEmbedText(
+                items=[{'text': e['text'], 'metadata': e['metadata'], 'doc_id': e['id']} for e in batch],
+                collection_name=collection_name,
+                model=self.model,
+            )
+            for collection_name, batch in by_collection.items()
+        ]
+        response = self.substrate.run(*nodes)
+        vectors = {}
+        for node, batch in zip(nodes, by_collection.values()):
+            # Raises if the node has no output
+            written = response.get(node).embeddings
+            if len(written) != len(batch):
+                raise ValueError(f"Expected {len(batch)} embeddings, got {len(written)}")
+            for entry, embedding in zip(batch, written):
+                vectors[entry['id']] = embedding.vector
+        return [vectors[e['id']] for e in entries]
+
+    async def query(self, collection_name, query_strings, top_k):
+        query = QueryVectorStore(
+            query_strings=query_strings,
+            collection_name=collection_name,
+            model=self.model,
+            include_metadata=True,
+            top_k=top_k,
+        )
+        return (await self.substrate.async_run(query)).get(query).results
+
+    def entries(self, collection_name):
+        # Searched remotely; nothing to load
+        return []
+
+    def collections(self):
+        """Names of this model's collections on the server."""
+        node = ListVectorStores()
+        items = self.substrate.run(node).get(node).items or []
+        return [item.collection_name for item in items if item.model == self.model]
+
+    def delete(self, collection_name):
+        node = DeleteVectorStore(collection_name=collection_name, model=self.model)
+        self.substrate.run(node).get(node)
+
+    def stats(self):
+        return {}
+
+    def close(self):
+        pass
+
+
+class LocalBackend:
+    """
+    Collections on local disk (see localstore.py), kept across sessions.
+    Substrate only computes the embeddings, unless they are in `cache`
+    (see embedcache.py); search runs locally.
+    """
+
+    def __init__(self, substrate, model, root, index='auto', ann_threshold=50000, cache=None):
+        self.substrate = substrate
+        self.model = model
+        self.root = root
+        self.index = index
+        self.ann_threshold = ann_threshold
+        self.cache = cache
+        self._indexes = {}
+
+    def _open(self, collection_name):
+        index = self._indexes.get(collection_name)
+        if index is None:
+            index = self._indexes[collection_name] = LocalVectorIndex(
+                os.path.join(self.root, collection_name), self.index, self.ann_threshold)
+            logging.info(f"Opened local vector store {collection_name} with {len(index)} entries")
+        return index
+
+    def embed(self, texts):
+        if self.cache is not None:
+            return self.cache.embed(self.model, texts, self._embed)
+        return self._embed(texts)
+
+    async def aembed(self, texts):
+        if self.cache is not None:
+            return await self.cache.aembed(self.model, texts, self._aembed)
+        return await self._aembed(texts)
+
+    def _embed_node(self, texts):
+        return MultiEmbedText(items=[{'text': text} for text in texts], model=self.model)
+
+    def _vectors(self, node, response, texts):
+        embeddings = response.get(node).embeddings
+        if len(embeddings) != len(texts):
+            raise ValueError(f"Expected {len(texts)} embeddings, got {len(embeddings)}")
+        return [embedding.vector for embedding in embeddings]
+
+    def _embed(self, texts):
+        node = self._embed_node(texts)
+        return self._vectors(node, self.substrate.run(node), texts)
+
+    async def _aembed(self, texts):
+        node = self._embed_node(texts)
+        return self._vectors(node, await self.substrate.async_run(node), texts)
+
+    def create(self, collection_name):
+        self._open(collection_name)
+
+    def write(self, entries, vectors=None):
+        """Store entries, embedding them unless their vectors are given (from the cold tier's write)."""
+        if vectors is None:
+            vectors = self.embed([e['text'] for e in entries])
+        by_collection = {}
+        for entry, vector in zip(entries, vectors):
+            by_collection.setdefault(entry['collection_name'], []).append((entry, vector))
+        for collection_name, batch in by_collection.items():
+            self._open(collection_name).add(
+                [e['id'] for e, _ in batch],
+                [v for _, v in batch],
+                [e['text'] for e, _ in batch],
+                [e['metadata'] for e, _ in batch],
+            )
+
+    async def query(self, collection_name, query_strings, top_k):
+        index = self._open(collection_name)
+        if len(index) == 0:
+            return [[] for _ in query_strings]
+        vectors = await self.aembed(query_strings)
+        # A scan of a large store takes long enough to stall the prompt
+        return await asyncio.to_thread(index.search, vectors, top_k)
+
+    def entries(self, collection_name):
+        return self._open(collection_name).metadata()
+
+    def recent(self, collection_name, n):
+        return self._open(collection_name).recent(n) if n else []
+
+    def count(self, collection_name):
+        return len(self._open(collection_name))
+
+    def exists(self, collection_name):
+        return collection_name in self._indexes or os.path.isdir(os.path.join(self.root, collection_name))
+
+    def delete(self, collection_name):
+        index = self._indexes.pop(collection_name, None)
+        if index is not None:
+            index.close()
+        shutil.rmtree(os.path.join(self.root, collection_name), ignore_errors=True)
+
+    def stats(self):
+        stats = {"collections": {name: len(index) for name, index in self._indexes.items()}}
+        if self.cache is not None:
+            stats["embedding_cache"] = self.cache.stats()
+        return stats
+
+    def close(self):
+        for index in self._indexes.values():
+            index.close()
+        if self.cache is not None:
+            self.cache.close()
@@ -0,0 +1,103 @@
+"""
+Cost and latency of best-of-N replies for nomemory8b.py.
+
+For each N, sends the same prompts as N parallel Llama3Instruct8B
+candidates, in both modes:
+
+    quality   wait for all N, score them locally, show the best
+    latency   stream the first candidate to start, stop at its end
+
+and reports time to first token, time to the full reply, and cost as the
+tokens generated across all candidates (the other candidates of a latency
+turn are still generated, and billed, after it returns).
+
+    python bench_bestof.py                   # N = 1 2 4 8, via SUBSTRATE_BASE_URL
+    python bench_bestof.py --n 1 3 --rounds 5
+
+Against the fake server (fakesubstrate --profile realistic) the latencies
+are meaningful but the candidates are filler text, so compare the scorer's
+picks against the real API.
+"""
+import argparse
+import asyncio
+import os
+import time
+
+from substrate import Substrate, Llama3Instruct8B
+
+from bestof import candidate_nodes, pick_best
+from context import count_tokens
+from streaming import stream_first, stream_reply
+
+PROMPTS = [
+    "write some python to print a fib sequence",
+    "what's the difference between a list and a tuple?",
+    "give me three ideas for a rainy weekend",
+    "explain what a vector store is in two sentences",
+]
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+async def run_quality(substrate, n, prompt):
+    start = time.perf_counter()
+    nodes = candidate_nodes(Llama3Instruct8B, n, prompt=prompt, max_tokens=800)
+    response = await substrate.async_run(*nodes)
+    texts = [response.get(node).choices[0].text for node in nodes]
+    elapsed = time.perf_counter() - start
+    # Scored separately from the request, to report the scorer's own cost
+    scored = time.perf_counter()
+    pick_best(texts, prompt)
+    score_time = time.perf_counter() - scored
+    return elapsed + score_time, elapsed + score_time, sum(count_tokens(t) for t in texts), score_time
+
+
+async def run_latency(substrate, n, prompt):
+    nodes = candidate_nodes(Llama3Instruct8B, n, prompt=prompt, max_tokens=800)
+    if n == 1:
+        text, stats = await stream_reply(substrate, nodes[0], lambda text: None)
+    else:
+        _, text, stats = await stream_first(substrate, nodes, lambda text: None)
+    # The candidates not shown are assumed to be as long as the one that was
+    return stats.ttft, stats.end - stats.start, n * count_tokens(text), 0.0
+
+
+async def bench(substrate, ns, rounds):
+    print(f"{'mode':8s} {'N':>3s} {'ttft p50':>10s} {'reply p50':>10s} {'reply p95':>10s} "
+          f"{'tokens/turn':>12s} {'vs N=1':>7s} {'score':>8s}")
+    base = {}
+    for mode, run in (('quality', run_quality), ('latency', run_latency)):
+        for n in ns:
+            ttfts, totals, tokens, scoring = [], [], [], []
+            for _ in range(rounds):
+                # Turns are sequential, as in the chat
+                for prompt in PROMPTS:
+                    ttft, total, cost, score_time = await run(substrate, n, prompt)
+                    ttfts.append(ttft)
+                    totals.append(total)
+                    tokens.append(cost)
+                    scoring.append(score_time)
+            mean_tokens = sum(tokens) / len(tokens)
+            base.setdefault(mode, mean_tokens)
+            print(f"{mode:8s} {n:3d} {percentile(ttfts, 0.5) * 1000:8.0f}ms {percentile(totals, 0.5) * 1000:8.0f}ms "
+                  f"{percentile(totals, 0.95) * 1000:8.0f}ms {mean_tokens:12.1f} {mean_tokens / base[mode]:6.1f}x "
+                  f"{sum(scoring) / len(scoring) * 1000:6.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark best-of-N replies.")
+    parser.add_argument("--n", type=int, nargs='+', default=[1, 2, 4, 8], help="Candidate counts to compare")
+    parser.add_argument("--rounds", type=int, default=3, help="Passes over the prompts per N")
+    args = parser.parse_args()
+
+    substrate = Substrate(api_key=os.environ.get('SUBSTRATE_API_KEY', ''),
+                          base_url=os.environ.get('SUBSTRATE_BASE_URL', 'https://api.substrate.run'),
+                          timeout=60 * 5)
+    asyncio.run(bench(substrate, args.n, args.rounds))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Key term extraction for memory70B.py: local extractor vs the LLM.
+
+Replays the conversation in example.txt through each extractor and reports
+the time per turn and retrieval recall: for the follow-up turns labelled
+below, the share of their relevant earlier turns that rank in the top k by
+key term overlap, which is what query expansion relies on.
+
+    python bench_keyterms.py               # local only
+    python bench_keyterms.py --llm         # also Llama3Instruct70B, via SUBSTRATE_BASE_URL
+
+Against the fake server (fakesubstrate) the LLM's latency is meaningful
+but its terms are not, so compare recall against the real API.
+"""
+import argparse
+import asyncio
+import os
+import re
+import time
+
+from keyterms import KeywordExtractor
+
+EXAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'example.txt')
+
+# Turn index -> earlier turns it refers back to (turns alternate Human, Assistant)
+RELEVANT = {
+    8: {6, 7},        # just show the code
+    9: {6, 7},
+    10: {0, 1, 3, 5},  # what color is my parrot?
+    11: {0, 1, 3, 5},
+}
+
+
+def load_turns(path):
+    turns = []
+    for line in open(path, encoding='utf-8').read().splitlines():
+        human = re.match(r'^[a-z]+-[a-z]+> (.*)', line)
+        if human:
+            turns.append(human.group(1))
+        elif line.startswith('Llama3: '):
+            turns.append(line[len('Llama3: '):])
+        elif turns and len(turns) % 2 == 0:
+            # Continuation of a multi-line reply
+            turns[-1] += '\n' + line
+    return turns
+
+
+def words(terms):
+    return {word for term in terms for word in str(term).lower().split()}
+
+
+def recall(all_terms, k):
+    scores = []
+    for turn, relevant in RELEVANT.items():
+        query = words(all_terms[turn])
+        overlap = sorted(range(turn), key=lambda i: (len(query & words(all_terms[i])), i), reverse=True)
+        top = {i for i in overlap[:k] if query & words(all_terms[i])}
+        scores.append(len(top & relevant) / len(relevant))
+    return sum(scores) / len(scores)
+
+
+def run(name, extract, turns, k):
+    timings, all_terms = [], []
+    for text in turns:
+        start = time.perf_counter()
+        all_terms.append(extract(text))
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    print(f"{name:8s} mean {sum(timings) / len(timings) * 1000:9.3f} ms  max {timings[-1] * 1000:9.3f} ms  "
+          f"recall@{k} {recall(all_terms, k):.2f}")
+    return all_terms
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark key term extraction on example.txt.")
+    parser.add_argument("--file", default=EXAMPLE)
+    parser.add_argument("--k", type=int, default=4, help="Earlier turns retrieved per follow-up")
+    parser.add_argument("--llm", action="store_true", help="Also run the Llama3Instruct70B extractor")
+    parser.add_argument("--show", action="store_true", help="Print the terms for each turn")
+    args = parser.parse_args()
+
+    turns = load_turns(args.file)
+    print(f"{len(turns)} turns from {args.file}")
+    results = {'local': run('local', KeywordExtractor().extract, turns, args.k)}
+    if args.llm:
+        from substrate import Substrate
+        from memory70B import extract_key_terms
+        substrate = Substrate(api_key=os.environ.get('SUBSTRATE_API_KEY', ''),
+                              base_url=os.environ.get('SUBSTRATE_BASE_URL', 'https://api.substrate.run'))
+        results['llm'] = run('llm', lambda text: asyncio.run(extract_key_terms(text, substrate)), turns, args.k)
+    if args.show:
+        for i, text in enumerate(turns):
+            print(f"\n[{i}] {text[:60]!r}")
+            for name, terms in results.items():
+                print(f"  {name}: {terms[i]}")
+
+
+if __name__ == "__main__":
+    main()
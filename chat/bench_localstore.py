@@ -0,0 +1,95 @@
+"""
+Query latency of the local vector store (localstore.py) by store size.
+
+Fills a fresh store per size with synthetic clustered embeddings, then times
+queries with each search method and reports recall@k of the approximate
+ones against brute force:
+
+    python bench_localstore.py --sizes 10000 100000 1000000 --dim 768
+
+Nothing is sent upstream. 1M rows of 768 floats take about 3 GB of disk
+under --dir (a temporary directory by default).
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from localstore import LocalVectorIndex, hnswlib
+
+
+def synthetic(rng, n, dim, centers):
+    """Embeddings that cluster by topic, like conversation turns do."""
+    topics = rng.integers(0, len(centers), n)
+    return centers[topics] + rng.normal(0, 0.6 / np.sqrt(dim), (n, dim)).astype(np.float32)
+
+
+def fill(index, rng, n, dim, centers, chunk=20000):
+    start = time.perf_counter()
+    for first in range(0, n, chunk):
+        count = min(chunk, n - first)
+        ids = [f"doc{first + i}" for i in range(count)]
+        index.add(ids, synthetic(rng, count, dim, centers), ids,
+                  [{"role": "Human", "timestamp": first + i} for i in range(count)])
+    return time.perf_counter() - start
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark local vector store queries.")
+    parser.add_argument("--sizes", type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument("--dim", type=int, default=768, help="Embedding size (jina-v2 is 768)")
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--k", type=int, default=50, help="top_k, as get_recent_history asks for")
+    parser.add_argument("--topics", type=int, default=200)
+    parser.add_argument("--dir", help="Where to build the stores (default: a temporary directory)")
+    args = parser.parse_args()
+
+    methods = ['brute', 'ivf'] + (['hnsw'] if hnswlib is not None else [])
+    root = args.dir or tempfile.mkdtemp(prefix='localstore-bench-')
+    rng = np.random.default_rng(0)
+    centers = rng.normal(0, 1 / np.sqrt(args.dim), (args.topics, args.dim)).astype(np.float32)
+    queries = synthetic(rng, args.queries, args.dim, centers)
+
+    print(f"{'rows':>9} {'method':>6} {'build s':>8} {'p50 ms':>8} {'p95 ms':>8} {'recall@k':>9}")
+    try:
+        for n in args.sizes:
+            path = os.path.join(root, str(n))
+            shutil.rmtree(path, ignore_errors=True)
+            index = LocalVectorIndex(path, index='brute')
+            fill_seconds = fill(index, rng, n, args.dim, centers)
+            print(f"{n:>9} {'append':>6} {fill_seconds:8.1f}")
+
+            exact = None
+            for method in methods:
+                index.index = method
+                start = time.perf_counter()
+                index.search_rows(queries[:1], args.k)  # builds the approximate index
+                build = time.perf_counter() - start if method != 'brute' else 0.0
+                timings, found = [], []
+                for query in queries:
+                    start = time.perf_counter()
+                    rows, _ = index.search_rows(query, args.k)[0]
+                    timings.append(time.perf_counter() - start)
+                    found.append(set(rows.tolist()))
+                if exact is None:
+                    exact = found
+                recall = np.mean([len(f & e) / len(e) for f, e in zip(found, exact)])
+                print(f"{n:>9} {method:>6} {build:8.1f} {percentile(timings, 0.5) * 1000:8.2f} "
+                      f"{percentile(timings, 0.95) * 1000:8.2f} {recall:9.3f}", flush=True)
+            index.close()
+            shutil.rmtree(path, ignore_errors=True)
+    finally:
+        if not args.dir:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+import math
+import re
+import time
+import zlib
+from collections import Counter
+
+from context import count_tokens
+from streaming import ReplyStats
+
+_WORD = re.compile(r"\w+|[^\w\s]")
+
+
+def words(text):
+    return _WORD.findall(text.lower())
+
+
+def candidate_nodes(node_class, n, temperature=0.4, spread=0.1, **kwargs):
+    """
+    n single-choice nodes for the same prompt, which run in parallel in one
+    graph. Each samples at a slightly higher temperature than the last, so
+    the candidates differ even where sampling is seeded by the request.
+    """
+    return [node_class(num_choices=1, temperature=round(temperature + spread * i, 3), **kwargs)
+            for i in range(n)]
+
+
+def score_candidate(text, others=(), prompt='', min_words=20, max_words=400):
+    """
+    A cheap local quality score for one candidate reply; higher is better.
+
+    - length: rises to 1 at `min_words`, falls off past `max_words` (likely cut off or rambling)
+    - repetition: share of repeated word trigrams, plus zlib compressibility beyond normal prose
+    - perplexity: mean surprise of the reply's words under a unigram model
+      of the prompt and the other candidates, so the odd one out scores
+      worse; a stand-in for the model's own perplexity, which isn't returned
+
+    Returns (score, {component: value}).
+    """
+    tokens = words(text)
+    if not tokens:
+        return float('-inf'), {"length": 0.0, "repetition": 0.0, "perplexity": 0.0}
+
+    length = min(1.0, len(tokens) / min_words)
+    if len(tokens) > max_words:
+        length -= min(1.0, (len(tokens) - max_words) / max_words)
+
+    trigrams = list(zip(tokens, tokens[1:], tokens[2:]))
+    repeated = 1.0 - len(set(trigrams)) / len(trigrams) if trigrams else 0.0
+    raw = text.encode('utf-8')
+    # English prose compresses to about 0.45-0.6 of its size; a looping reply compresses much further
+    ratio = len(zlib.compress(raw)) / len(raw) if len(raw) > 64 else 1.0
+    repetition = repeated + max(0.0, 0.4 - ratio)
+
+    reference = Counter(words(prompt))
+    for other in others:
+        reference.update(words(other))
+    vocabulary = len(set(reference) | set(tokens)) + 1
+    total = sum(reference.values())
+    surprise = sum(-math.log((reference[t] + 1) / (total + vocabulary)) for t in tokens) / len(tokens)
+    perplexity = surprise / math.log(vocabulary)
+
+    score = length - 2.0 * repetition - 0.5 * perplexity
+    return score, {"length": round(length, 3), "repetition": round(repetition, 3), "perplexity": round(perplexity, 3)}
+
+
+def pick_best(texts, prompt=''):
+    """Index of the best-scoring text, and every text's (score, components)."""
+    scores = [score_candidate(text, texts[:i] + texts[i + 1:], prompt) for i, text in enumerate(texts)]
+    best = max(range(len(texts)), key=lambda i: scores[i][0])
+    return best, scores
+
+
+async def best_of(substrate, nodes, prompt=''):
+    """Wait for every candidate and return (index, text, scores, ReplyStats) of the best."""
+    stats = ReplyStats()
+    response = await substrate.async_run(*nodes)
+    texts = [response.get(node).choices[0].text.strip() for node in nodes]
+    # Nothing can be shown until the best is known, so the first token comes with the last
+    stats.first_token = stats.end = time.perf_counter()
+    best, scores = pick_best(texts, prompt)
+    # No deltas to count, so the reply is tokenized instead
+    stats.tokens = count_tokens(texts[best])
+    return best, texts[best], scores, stats
+
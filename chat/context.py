@@ -0,0 +1,243 @@
+import os
+import re
+import json
+import math
+import hashlib
+import logging
+
+try:
+    import tiktoken
+    _ENCODING = tiktoken.get_encoding('cl100k_base')
+except ImportError:
+    # tiktoken is optional; without it tokens are estimated from words and punctuation
+    _ENCODING = None
+
+_PIECE = re.compile(r"\w+|[^\w\s]|\n")
+
+
+def count_tokens(text):
+    """Tokens in text: cl100k_base if tiktoken is installed (close to Llama 3's tokenizer), else an estimate."""
+    if not text:
+        return 0
+    if _ENCODING is not None:
+        return len(_ENCODING.encode(text, disallowed_special=()))
+    # A BPE vocabulary has most short words whole; longer ones split about every 4 characters
+    return sum(1 if len(piece) <= 6 else 1 + math.ceil((len(piece) - 6) / 4) for piece in _PIECE.findall(text))
+
+
+def line(role, content):
+    return f"{role}: {content}"
+
+
+class RollingSummaries:
+    """
+    Summaries of the conversation's older turns, `run_length` turns at a
+    time, cached in a JSONL file per session.
+
+    Turns are added as they leave the hot tier. Each full run is
+    summarized once, by `summarize(run)` if given (an async function
+    returning text), else by taking the first sentence of each turn.
+    Summaries are keyed by the hash of their turns' ids, so a run that
+    comes round again (a replay, or a resumed session) isn't summarized
+    twice.
+    """
+
+    def __init__(self, path, run_length=8, summarize=None):
+        self.path = path
+        self.run_length = run_length
+        self.summarize = summarize
+        self.summaries = []
+        self._by_key = {}
+        self._by_entry = {}
+        self._pending = []
+        self._ready = []
+        self.failures = 0
+        if path and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for raw in f:
+                    try:
+                        self._index(json.loads(raw))
+                    except ValueError:
+                        logging.warning(f"Skipping a damaged line in {path}")
+
+    def _index(self, summary):
+        if summary['key'] in self._by_key:
+            return
+        self._by_key[summary['key']] = summary
+        self.summaries.append(summary)
+        for entry_id in summary['ids']:
+            self._by_entry[entry_id] = summary
+
+    def last_end(self):
+        return max((s['end'] for s in self.summaries), default=0)
+
+    def add_turn(self, entry):
+        """An entry that has left the hot tier; full runs wait for summarize_ready()."""
+        if entry['id'] in self._by_entry or entry['timestamp'] <= self.last_end():
+            return
+        self._pending.append(entry)
+        if len(self._pending) >= self.run_length:
+            self._ready.append(self._pending)
+            self._pending = []
+
+    def summary_of(self, entry_id):
+        return self._by_entry.get(entry_id)
+
+    def latest(self):
+        return max(self.summaries, key=lambda s: s['end']) if self.summaries else None
+
+    async def summarize_ready(self):
+        while self._ready:
+            run = self._ready.pop(0)
+            key = hashlib.sha256('\n'.join(e['id'] for e in run).encode()).hexdigest()[:16]
+            if key in self._by_key:
+                continue
+            text = None
+            if self.summarize is not None:
+                try:
+                    text = (await self.summarize(run)).strip()
+                except Exception as e:
+                    self.failures += 1
+                    logging.error(f"Error summarizing turns: {str(e)}")
+            if not text:
+                text = extractive_summary(run)
+            summary = {
+                'key': key,
+                'ids': [e['id'] for e in run],
+                'start': run[0]['timestamp'],
+                'end': run[-1]['timestamp'],
+                'text': text,
+                'tokens': count_tokens(text),
+                'source_tokens': sum(e['tokens'] for e in run),
+            }
+            self._index(summary)
+            if self.path:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(summary) + '\n')
+
+    def stats(self):
+        return {"summaries": len(self.summaries), "pending_turns": len(self._pending),
+                "ready_runs": len(self._ready), "failures": self.failures}
+
+
+def extractive_summary(run, words=24):
+    parts = []
+    for entry in run:
+        sentence = re.split(r'(?<=[.!?])\s', entry['content'].strip(), maxsplit=1)[0].split()
+        text = ' '.join(sentence[:words]) + (' ...' if len(sentence) > words else '')
+        parts.append(line(entry['role'], text))
+    return ' / '.join(parts)
+
+
+class ContextBuilder:
+    """
+    Packs history into a prompt of at most `budget` tokens.
+
+    The hot entries go in first, newest first. The rest are ranked by
+    relevance x recency: similarity times a factor that is 1 for a new
+    entry and falls to 1 - recency_weight, halving the gap every
+    `half_life` seconds. They are then taken greedily while they fit.
+    Older turns whose run has a rolling summary are replaced by that
+    summary when it is shorter, and the latest summary is always a
+    candidate, so the prompt keeps a thread back past the hot tier.
+    """
+
+    def __init__(self, budget=3000, half_life=1800.0, recency_weight=0.3, summaries=None, summary_relevance=0.5):
+        self.budget = budget
+        self.half_life = half_life
+        self.recency_weight = recency_weight
+        self.summaries = summaries
+        self.summary_relevance = summary_relevance
+        self.turns = 0
+        self.tokens_used = 0
+        self.tokens_saved = 0
+        self.last = {}
+
+    def score(self, item, now):
+        age = max(0.0, now - item['timestamp'])
+        decay = math.pow(0.5, age / self.half_life) if self.half_life else 0.0
+        return item['similarity'] * ((1.0 - self.recency_weight) + self.recency_weight * decay)
+
+    def _collapse(self, older):
+        """Older candidates with runs replaced by their summaries where that is shorter."""
+        if self.summaries is None:
+            return older
+        runs, items = {}, []
+        for item in older:
+            summary = self.summaries.summary_of(item['id'])
+            if summary is None:
+                items.append(item)
+            else:
+                runs.setdefault(summary['key'], (summary, []))[1].append(item)
+        latest = self.summaries.latest()
+        if latest is not None and latest['key'] not in runs:
+            runs[latest['key']] = (latest, [])
+        for summary, members in runs.values():
+            if members and summary['tokens'] >= sum(m['tokens'] for m in members):
+                items.extend(members)
+                continue
+            items.append({
+                'id': summary['key'],
+                'role': 'Summary of earlier turns',
+                'content': summary['text'],
+                'timestamp': summary['end'],
+                'similarity': max((m['similarity'] for m in members), default=self.summary_relevance),
+                'tokens': count_tokens(line('Summary of earlier turns', summary['text'])),
+                'summary': True,
+            })
+        return items
+
+    def build(self, candidates, now):
+        """
+        candidates: dicts with id, role, content, timestamp, similarity,
+        tokens and hot. Returns the context text and a report of its tokens.
+        """
+        naive = '\n'.join(line(c['role'], c['content']) for c in sorted(candidates, key=lambda c: c['timestamp']))
+        hot = sorted((c for c in candidates if c.get('hot')), key=lambda c: c['timestamp'], reverse=True)
+        older = self._collapse([c for c in candidates if not c.get('hot')])
+
+        # Each line also costs its newline
+        chosen, remaining = [], self.budget
+        for item in hot:
+            if item['tokens'] + 1 > remaining and chosen:
+                break
+            chosen.append(item)
+            remaining -= item['tokens'] + 1
+        for item in sorted(older, key=lambda c: self.score(c, now), reverse=True):
+            if item['tokens'] + 1 <= remaining:
+                chosen.append(item)
+                remaining -= item['tokens'] + 1
+
+        chosen.sort(key=lambda c: c['timestamp'])
+        context = '\n'.join(line(c['role'], c['content']) for c in chosen)
+        used, before = count_tokens(context), count_tokens(naive)
+        self.turns += 1
+        self.tokens_used += used
+        self.tokens_saved += max(0, before - used)
+        self.last = {
+            "tokens": used,
+            "budget": self.budget,
+            "candidates": len(candidates),
+            "candidate_tokens": before,
+            "saved": max(0, before - used),
+            "entries": sum(1 for c in chosen if not c.get('summary')),
+            "summaries": sum(1 for c in chosen if c.get('summary')),
+        }
+        logging.info(f"Context: {used} of {self.budget} tokens, {self.last['entries']} entries and "
+                     f"{self.last['summaries']} summaries; saved {self.last['saved']} of {before}")
+        return context, self.last
+
+    def format(self):
+        """The last build's report as one line, for the per-reply stats."""
+        last = self.last
+        return (f"[context {last['tokens']}/{last['budget']} tokens, {last['entries']} entries, "
+                f"{last['summaries']} summaries, saved {last['saved']} of {last['candidate_tokens']}]")
+
+    def stats(self):
+        return {
+            "turns": self.turns,
+            "mean_tokens": round(self.tokens_used / self.turns, 1) if self.turns else 0.0,
+            "tokens_saved": self.tokens_saved,
+            "last": self.last,
+        }
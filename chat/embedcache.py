@@ -0,0 +1,124 @@
+import os
+import hashlib
+import sqlite3
+import threading
+
+import numpy as np
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode('utf-8', 'surrogatepass')).digest()
+
+
+class EmbeddingCache:
+    """
+    Embedding vectors keyed by (model, sha256(text)), in one SQLite file.
+
+    Vectors are stored as float32 blobs. Each hit bumps the entry's use
+    counter, and once there are more than `max_entries` the least recently
+    used tenth is evicted. embed() only calls `fetch` for texts it doesn't
+    have, and for each distinct text once.
+    """
+
+    def __init__(self, path, max_entries=100000):
+        self.path = path
+        self.max_entries = max_entries
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (model TEXT NOT NULL, hash BLOB NOT NULL, "
+            "vector BLOB NOT NULL, used INTEGER NOT NULL, PRIMARY KEY (model, hash))")
+        self._db.execute("CREATE INDEX IF NOT EXISTS embeddings_used ON embeddings (used)")
+        self._db.commit()
+        self._clock = self._db.execute("SELECT COALESCE(MAX(used), 0) FROM embeddings").fetchone()[0]
+        self.entries = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_many(self, model, texts):
+        """A vector or None per text."""
+        hashes = [text_hash(text) for text in texts]
+        found = {}
+        with self._lock:
+            unique = list(dict.fromkeys(hashes))
+            for start in range(0, len(unique), 500):
+                chunk = unique[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                found.update(self._db.execute(
+                    f"SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN ({placeholders})",
+                    [model] + chunk).fetchall())
+            if found:
+                self._clock += 1
+                self._db.executemany("UPDATE embeddings SET used = ? WHERE model = ? AND hash = ?",
+                                     [(self._clock, model, h) for h in found])
+                self._db.commit()
+        vectors = [np.frombuffer(found[h], dtype=np.float32) if h in found else None for h in hashes]
+        hits = sum(1 for v in vectors if v is not None)
+        self.hits += hits
+        self.misses += len(vectors) - hits
+        return vectors
+
+    def put_many(self, model, texts, vectors):
+        with self._lock:
+            self._clock += 1
+            rows = {text_hash(text): np.asarray(vector, dtype=np.float32).tobytes()
+                    for text, vector in zip(texts, vectors)}
+            self._db.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, hash, vector, used) VALUES (?, ?, ?, ?)",
+                [(model, h, blob, self._clock) for h, blob in rows.items()])
+            self.entries = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            if self.entries > self.max_entries:
+                # Evict in bulk so it doesn't happen on every insert
+                evict = self.entries - self.max_entries + self.max_entries // 10
+                self._db.execute(
+                    "DELETE FROM embeddings WHERE rowid IN "
+                    "(SELECT rowid FROM embeddings ORDER BY used LIMIT ?)", (evict,))
+                self.evictions += evict
+                self.entries -= evict
+            self._db.commit()
+
+    def embed(self, model, texts, fetch):
+        """Vectors for texts, calling fetch(missing texts) -> vectors only for the misses."""
+        vectors = self.get_many(model, texts)
+        missing = self._missing(texts, vectors)
+        if missing:
+            vectors = self._fill(model, texts, vectors, missing, fetch(missing))
+        return vectors
+
+    async def aembed(self, model, texts, fetch):
+        """embed() with an async fetch."""
+        vectors = self.get_many(model, texts)
+        missing = self._missing(texts, vectors)
+        if missing:
+            vectors = self._fill(model, texts, vectors, missing, await fetch(missing))
+        return vectors
+
+    @staticmethod
+    def _missing(texts, vectors):
+        return list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+
+    def _fill(self, model, texts, vectors, missing, fetched):
+        fetched = dict(zip(missing, fetched))
+        self.put_many(model, missing, [fetched[text] for text in missing])
+        return [vector if vector is not None else np.asarray(fetched[text], dtype=np.float32)
+                for text, vector in zip(texts, vectors)]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": self.entries,
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "bytes": os.path.getsize(self.path) if os.path.exists(self.path) else 0,
+        }
+
+    def close(self):
+        with self._lock:
+            self._db.close()
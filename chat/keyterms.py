@@ -0,0 +1,92 @@
+import math
+import re
+from collections import Counter
+
+STOPWORDS = frozenset("""
+a about above after again against all also am an and any are aren't as at be because been before being below
+between both but by can can't cannot could couldn't did didn't do does doesn't doing don't down during each
+either else ever few for from further get gets got had hadn't has hasn't have haven't having he he'd he'll he's
+her here here's hers herself him himself his how how's however i i'd i'll i'm i've if in into is isn't it it's
+its itself just let let's like made make many may me might more most much must mustn't my myself need no nor
+not now of off on once one only or other ought our ours ourselves out over own please put really said same say
+says see shall shan't she she'd she'll she's should shouldn't show so some such sure than that that's the their
+theirs them themselves then there there's these they they'd they'll they're they've this those though through
+to too under until up upon us use used using very via want was wasn't we we'd we'll we're we've well were
+weren't what what's when when's where where's whether which while who who's whom why why's will with within
+without won't would wouldn't yes yet you you'd you'll you're you've your yours yourself yourselves
+ok okay hi hello hey thanks thank sorry know think tell go going would like anything something thing things
+""".split())
+
+# Words, with inner apostrophes, hyphens and underscores (snake_case identifiers stay whole)
+_WORD = re.compile(r"[a-z0-9][a-z0-9_'-]*[a-z0-9]|[a-z0-9]")
+# Punctuation that ends a phrase
+_BREAK = re.compile(r"[.,;:!?()\[\]{}\"`\n]+")
+
+
+class KeywordExtractor:
+    """
+    Key terms of a message without a model call.
+
+    Candidate phrases are runs of up to `max_ngram` words between stopwords
+    and punctuation (as in RAKE). Words are weighted by TF-IDF against the
+    conversation so far, so words that come up in every message count for
+    less as the conversation goes on. Phrases score the sum of their words.
+    The result has the best phrases followed by the best single words, so
+    exact-term overlap still works for retrieval.
+    """
+
+    def __init__(self, max_terms=8, max_ngram=3, min_length=2):
+        self.max_terms = max_terms
+        self.max_ngram = max_ngram
+        self.min_length = min_length
+        self.documents = 0
+        self.document_frequency = Counter()
+
+    def _phrases(self, text):
+        phrases = []
+        for fragment in _BREAK.split(text.lower()):
+            run = []
+            for word in _WORD.findall(fragment):
+                if word in STOPWORDS or len(word) < self.min_length or word.isdigit():
+                    if run:
+                        phrases.append(run)
+                    run = []
+                else:
+                    run.append(word)
+            if run:
+                phrases.append(run)
+        # Long runs are usually code or lists; cut them into n-grams
+        split = []
+        for run in phrases:
+            for start in range(0, len(run), self.max_ngram):
+                split.append(tuple(run[start:start + self.max_ngram]))
+        return split
+
+    def extract(self, text, update=True):
+        phrases = self._phrases(text)
+        frequency = Counter(word for phrase in phrases for word in phrase)
+        if update:
+            self.documents += 1
+            self.document_frequency.update(frequency.keys())
+
+        def idf(word):
+            return math.log((1 + self.documents) / (1 + self.document_frequency[word])) + 1.0
+
+        weights = {word: (1 + math.log(count)) * idf(word) for word, count in frequency.items()}
+        scored = {}
+        for phrase in phrases:
+            if len(phrase) > 1:
+                scored[phrase] = max(scored.get(phrase, 0.0), sum(weights[w] for w in phrase))
+
+        terms, seen = [], set()
+        phrase_slots = self.max_terms // 3
+        for phrase in sorted(scored, key=scored.get, reverse=True)[:phrase_slots]:
+            terms.append(' '.join(phrase))
+            seen.add(terms[-1])
+        for word in sorted(weights, key=lambda w: (-weights[w], w)):
+            if len(terms) >= self.max_terms:
+                break
+            if word not in seen:
+                seen.add(word)
+                terms.append(word)
+        return terms
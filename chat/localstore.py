@@ -0,0 +1,356 @@
+import os
+import json
+import math
+import time
+import sqlite3
+import logging
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+try:
+    import hnswlib
+except ImportError:
+    # hnswlib is optional; without it large stores use the IVF index below
+    hnswlib = None
+
+# Same fields the SDK's QueryVectorStore results have
+Match = namedtuple('Match', ['id', 'distance', 'metadata'])
+
+# Rows scored per matrix multiply in a brute-force scan, to bound memory
+SCAN_BLOCK = 65536
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors[None, :]
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def top_k(scores, k):
+    """Indices of the k highest scores, best first."""
+    if len(scores) <= k:
+        return np.argsort(-scores)
+    best = np.argpartition(-scores, k)[:k]
+    return best[np.argsort(-scores[best])]
+
+
+class IVFIndex:
+    """
+    Inverted-file index: rows are grouped by their nearest of `nlist`
+    k-means centroids, and a query only scores the rows of its `nprobe`
+    nearest groups. New rows are assigned to the existing centroids; the
+    owner retrains once the store has doubled since the last training.
+    """
+
+    def __init__(self, centroids, assignments, trained_rows):
+        self.centroids = centroids
+        self.trained_rows = trained_rows
+        self.lists = [[] for _ in range(len(centroids))]
+        self._arrays = None
+        self._add(np.arange(len(assignments)), assignments)
+
+    @classmethod
+    def train(cls, matrix, iterations=8, seed=0):
+        n = len(matrix)
+        nlist = max(1, int(math.sqrt(n)))
+        rng = np.random.default_rng(seed)
+        sample = matrix[np.sort(rng.choice(n, min(n, nlist * 32), replace=False))]
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+        for _ in range(iterations):
+            nearest = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, nearest, sample)
+            counts = np.bincount(nearest, minlength=nlist)
+            empty = counts == 0
+            # Re-seed empty clusters from random sample rows
+            sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+            centroids = normalize(sums)
+        index = cls(centroids, np.zeros(0, dtype=np.int32), n)
+        index.add(matrix, 0)
+        return index
+
+    def assign(self, vectors):
+        assignments = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), SCAN_BLOCK):
+            block = np.asarray(vectors[start:start + SCAN_BLOCK])
+            assignments[start:start + len(block)] = np.argmax(block @ self.centroids.T, axis=1)
+        return assignments
+
+    def add(self, vectors, first_row):
+        self._add(np.arange(first_row, first_row + len(vectors)), self.assign(vectors))
+
+    def _add(self, rows, assignments):
+        for row, assignment in zip(rows.tolist(), assignments.tolist()):
+            self.lists[assignment].append(row)
+        self._arrays = None
+
+    def candidates(self, query, nprobe):
+        if self._arrays is None:
+            self._arrays = [np.array(rows, dtype=np.int64) for rows in self.lists]
+        probes = top_k(self.centroids @ query, nprobe)
+        return np.concatenate([self._arrays[i] for i in probes])
+
+    def assignments(self, n):
+        assignments = np.zeros(n, dtype=np.int32)
+        for i, rows in enumerate(self.lists):
+            assignments[rows] = i
+        return assignments
+
+
+class LocalVectorIndex:
+    """
+    A vector store on local disk, one directory per collection.
+
+    Vectors are unit-normalized float32 rows appended to vectors.f32 and read
+    back through a memory map; documents and metadata live in meta.sqlite,
+    keyed by row. Vectors are written before their rows are committed, so
+    after a crash any vectors without a row are cut off on the next open.
+    Search is brute-force cosine (one matrix product) up to
+    `ann_threshold` rows, and an approximate index above it: HNSW if
+    hnswlib is installed, otherwise IVF. `index` forces 'brute', 'ivf' or
+    'hnsw'.
+    """
+
+    def __init__(self, path, index='auto', ann_threshold=50000, nprobe=16, ef=64):
+        self.path = path
+        self.index = index
+        self.ann_threshold = ann_threshold
+        self.nprobe = nprobe
+        self.ef = ef
+        os.makedirs(path, exist_ok=True)
+        self.vectors_path = os.path.join(path, 'vectors.f32')
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(os.path.join(path, 'meta.sqlite'), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entries (row INTEGER PRIMARY KEY, doc_id TEXT UNIQUE NOT NULL, "
+            "doc TEXT, metadata TEXT)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT)")
+        self._db.commit()
+        dim = self._db.execute("SELECT value FROM info WHERE key = 'dim'").fetchone()
+        self.dim = int(dim[0]) if dim else None
+        self.count = self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        self._matrix = None
+        self._ivf = None
+        self._hnsw = None
+        if self.dim is not None:
+            # Drop vectors written by an append whose rows were never committed
+            expected = self.count * self.dim * 4
+            if os.path.exists(self.vectors_path) and os.path.getsize(self.vectors_path) > expected:
+                logging.warning(f"Truncating {self.vectors_path} to the {self.count} committed rows")
+                with open(self.vectors_path, 'r+b') as f:
+                    f.truncate(expected)
+
+    def __len__(self):
+        return self.count
+
+    def matrix(self):
+        if self.count == 0:
+            return np.zeros((0, self.dim or 0), dtype=np.float32)
+        if self._matrix is None or len(self._matrix) != self.count:
+            self._matrix = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(self.count, self.dim))
+        return self._matrix
+
+    def add(self, doc_ids, vectors, docs, metadatas):
+        """Append entries; an existing doc_id has its vector and metadata replaced in place."""
+        vectors = normalize(vectors)
+        with self._lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                self._db.execute("INSERT OR REPLACE INTO info VALUES ('dim', ?)", (str(self.dim),))
+            elif vectors.shape[1] != self.dim:
+                raise ValueError(f"Expected {self.dim}-dimensional vectors, got {vectors.shape[1]}")
+
+            existing = {}
+            for start in range(0, len(doc_ids), 500):
+                chunk = list(doc_ids[start:start + 500])
+                placeholders = ','.join('?' * len(chunk))
+                existing.update(self._db.execute(
+                    f"SELECT doc_id, row FROM entries WHERE doc_id IN ({placeholders})", chunk).fetchall())
+
+            new, replaced = [], []
+            for i, doc_id in enumerate(doc_ids):
+                (replaced if doc_id in existing else new).append(i)
+            # Duplicates within one call: the last one wins
+            seen = {}
+            for i in new:
+                seen[doc_ids[i]] = i
+            new = sorted(seen.values())
+
+            with open(self.vectors_path, 'ab') as f:
+                f.write(vectors[new].tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            if replaced:
+                with open(self.vectors_path, 'r+b') as f:
+                    for i in replaced:
+                        f.seek(existing[doc_ids[i]] * self.dim * 4)
+                        f.write(vectors[i].tobytes())
+            first_row = self.count
+            self._db.executemany(
+                "INSERT INTO entries (row, doc_id, doc, metadata) VALUES (?, ?, ?, ?)",
+                [(first_row + j, doc_ids[i], docs[i], json.dumps(metadatas[i])) for j, i in enumerate(new)])
+            self._db.executemany(
+                "UPDATE entries SET doc = ?, metadata = ? WHERE doc_id = ?",
+                [(docs[i], json.dumps(metadatas[i]), doc_ids[i]) for i in replaced])
+            self._db.commit()
+            self.count += len(new)
+            self._matrix = None
+            if replaced:
+                # Replaced vectors may belong elsewhere in the index; rebuild it on the next search
+                self._ivf = self._hnsw = None
+                for name in ('ivf.npz', 'hnsw.bin'):
+                    if os.path.exists(os.path.join(self.path, name)):
+                        os.remove(os.path.join(self.path, name))
+            if new:
+                self._extend_index(vectors[new], first_row)
+
+    def _kind(self):
+        if self.index != 'auto':
+            return self.index
+        if self.count < self.ann_threshold:
+            return 'brute'
+        return 'hnsw' if hnswlib is not None else 'ivf'
+
+    def _extend_index(self, vectors, first_row):
+        if self._ivf is not None:
+            if self.count >= 2 * self._ivf.trained_rows:
+                self._ivf = None
+            else:
+                self._ivf.add(vectors, first_row)
+        if self._hnsw is not None:
+            if self._hnsw.get_max_elements() < self.count:
+                self._hnsw.resize_index(max(self.count, 2 * self._hnsw.get_max_elements()))
+            self._hnsw.add_items(vectors, np.arange(first_row, first_row + len(vectors)))
+
+    def _ivf_index(self):
+        if self._ivf is None:
+            saved = os.path.join(self.path, 'ivf.npz')
+            if os.path.exists(saved):
+                data = np.load(saved)
+                rows = len(data['assignments'])
+                if rows <= self.count < 2 * int(data['trained_rows']):
+                    self._ivf = IVFIndex(data['centroids'], data['assignments'], int(data['trained_rows']))
+                    if rows < self.count:
+                        self._ivf.add(self.matrix()[rows:], rows)
+            if self._ivf is None:
+                start = time.perf_counter()
+                self._ivf = IVFIndex.train(self.matrix())
+                logging.info(f"Trained IVF index on {self.count} rows in {time.perf_counter() - start:.1f}s")
+        return self._ivf
+
+    def _hnsw_index(self):
+        if hnswlib is None:
+            raise RuntimeError("index 'hnsw' needs hnswlib installed")
+        if self._hnsw is None:
+            saved = os.path.join(self.path, 'hnsw.bin')
+            index = hnswlib.Index(space='ip', dim=self.dim)
+            loaded = 0
+            if os.path.exists(saved):
+                index.load_index(saved, max_elements=max(self.count, 1))
+                loaded = index.get_current_count()
+                if loaded > self.count:
+                    # Saved after rows that were later cut off; rebuild
+                    index = hnswlib.Index(space='ip', dim=self.dim)
+                    loaded = 0
+            if not loaded:
+                index.init_index(max_elements=max(self.count, 1), ef_construction=200, M=16)
+            if loaded < self.count:
+                index.add_items(self.matrix()[loaded:], np.arange(loaded, self.count))
+            index.set_ef(self.ef)
+            self._hnsw = index
+        return self._hnsw
+
+    def save(self):
+        """Persist the approximate index, so the next session doesn't rebuild it."""
+        with self._lock:
+            if self._ivf is not None:
+                np.savez(os.path.join(self.path, 'ivf.npz'), centroids=self._ivf.centroids,
+                         assignments=self._ivf.assignments(self.count), trained_rows=self._ivf.trained_rows)
+            if self._hnsw is not None:
+                self._hnsw.save_index(os.path.join(self.path, 'hnsw.bin'))
+
+    def search_rows(self, queries, k):
+        """(rows, similarities) per query vector."""
+        queries = normalize(queries)
+        with self._lock:
+            if self.count == 0:
+                return [(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)) for _ in queries]
+            kind = self._kind()
+            matrix = self.matrix()
+            if kind == 'hnsw':
+                index = self._hnsw_index()
+                labels, distances = index.knn_query(queries, k=min(k, self.count))
+                return [(labels[i].astype(np.int64), 1.0 - distances[i]) for i in range(len(queries))]
+            if kind == 'ivf':
+                index = self._ivf_index()
+                results = []
+                for query in queries:
+                    rows = index.candidates(query, self.nprobe)
+                    scores = matrix[rows] @ query
+                    best = top_k(scores, k)
+                    results.append((rows[best], scores[best]))
+                return results
+
+            # Brute force, a block of rows at a time for all queries at once
+            best_rows = [np.zeros(0, dtype=np.int64) for _ in queries]
+            best_scores = [np.zeros(0, dtype=np.float32) for _ in queries]
+            for start in range(0, self.count, SCAN_BLOCK):
+                scores = np.asarray(matrix[start:start + SCAN_BLOCK]) @ queries.T
+                for i in range(len(queries)):
+                    block_best = top_k(scores[:, i], k)
+                    rows = np.concatenate([best_rows[i], block_best + start])
+                    merged = np.concatenate([best_scores[i], scores[block_best, i]])
+                    keep = top_k(merged, k)
+                    best_rows[i], best_scores[i] = rows[keep], merged[keep]
+            return list(zip(best_rows, best_scores))
+
+    def search(self, queries, k):
+        """Matches per query, best first, shaped like QueryVectorStore results."""
+        found = self.search_rows(queries, k)
+        rows = sorted({int(row) for row_ids, _ in found for row in row_ids})
+        entries = {}
+        with self._lock:
+            for start in range(0, len(rows), 500):
+                chunk = rows[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                for row, doc_id, doc, metadata in self._db.execute(
+                        f"SELECT row, doc_id, doc, metadata FROM entries WHERE row IN ({placeholders})", chunk):
+                    entries[row] = (doc_id, doc, metadata)
+        results = []
+        for row_ids, scores in found:
+            matches = []
+            for row, score in zip(row_ids.tolist(), scores.tolist()):
+                doc_id, doc, metadata = entries[row]
+                metadata = json.loads(metadata) if metadata else {}
+                metadata['doc'] = doc
+                matches.append(Match(doc_id, 1.0 - score, metadata))
+            results.append(matches)
+        return results
+
+    def metadata(self):
+        """Metadata of every entry, oldest first."""
+        with self._lock:
+            rows = self._db.execute("SELECT metadata FROM entries ORDER BY row").fetchall()
+        return [json.loads(metadata) if metadata else {} for metadata, in rows]
+
+    def recent(self, n):
+        """Metadata, with the document as 'doc', of the last n entries added, oldest first."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT doc, metadata FROM entries ORDER BY row DESC LIMIT ?", (n,)).fetchall()
+        recent = []
+        for doc, metadata in reversed(rows):
+            metadata = json.loads(metadata) if metadata else {}
+            metadata['doc'] = doc
+            recent.append(metadata)
+        return recent
+
+    def close(self):
+        self.save()
+        with self._lock:
+            self._db.close()
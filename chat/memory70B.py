@@ -1,5 +1,6 @@
 import os
 import sys
+import argparse
 import json
 import asyncio
 import logging
@@ -12,7 +13,16 @@ from prompt_toolkit.key_binding import KeyBindings
 from prompt_toolkit.styles import Style
 from prompt_toolkit.shortcuts import print_formatted_text
 from coolname import generate_slug
-from substrate import Substrate, Llama3Instruct70B, FindOrCreateVectorStore, EmbedText, QueryVectorStore, DeleteVectorStore, sb, Box
+from substrate import Substrate, Llama3Instruct70B, Llama3Instruct8B, DeleteVectorStore, sb, Box
+from writebehind import WriteBehindEmbedder
+from backends import RemoteBackend, LocalBackend
+from embedcache import EmbeddingCache
+from keyterms import KeywordExtractor
+from pipeline import StageTimings, BackgroundQueue
+from sessions import SessionRegistry, HotBuffer
+from context import ContextBuilder, RollingSummaries, count_tokens
+from retrieval import expansion_terms, merge_matches, rerank, split_doc
+from streaming import stream_reply, delta_printer
 
 # Set up logging
 # logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -20,6 +30,11 @@ logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s -
 
 CONFIG_DIR = os.path.expanduser('~/.config/llama3-chat')
 CONFIG_FILE = os.path.join(CONFIG_DIR, 'config.json')
+EMBED_JOURNAL = os.path.join(CONFIG_DIR, 'embed-journal.jsonl')
+VECTOR_DIR = os.path.join(CONFIG_DIR, 'vectors')
+EMBED_CACHE = os.path.join(CONFIG_DIR, 'embeddings.sqlite')
+SESSIONS_FILE = os.path.join(CONFIG_DIR, 'sessions.json')
+SUMMARY_DIR = os.path.join(CONFIG_DIR, 'summaries')
 
 def load_or_create_config():
     try:
@@ -27,7 +42,13 @@ def load_or_create_config():
             with open(CONFIG_FILE, 'r') as f:
                 config = json.load(f)
             logging.info(f"Config loaded from {CONFIG_FILE}")
+            # The environment's key wins, the other settings still come from the file
+            if os.environ.get('SUBSTRATE_API_KEY'):
+                config['api_key'] = os.environ['SUBSTRATE_API_KEY']
             return config
+        # Lets scripted and offline runs skip the prompt
+        if os.environ.get('SUBSTRATE_API_KEY'):
+            return {'api_key': os.environ['SUBSTRATE_API_KEY']}
         else:
             api_key = input("Please enter your Substrate API key: ")
             config = {'api_key': api_key}
@@ -47,7 +68,7 @@ def generate_time_hash():
 
 import ast
 
-def extract_key_terms(text, llm_client, attempt=1, max_attempts=3):
+async def extract_key_terms(text, llm_client, attempt=1, max_attempts=3):
     if attempt > max_attempts:
         logging.error(f"Failed to extract key terms after {max_attempts} attempts.")
         return []
@@ -80,7 +101,7 @@ keyterms = ["term1", "term2", "term3"]
         temperature=0.2,
         max_tokens=200,
     )
-    response = llm_client.run(llama3_query)
+    response = await llm_client.async_run(llama3_query)
     llm_response = response.get(llama3_query).choices[0].text.strip()
     
     # Try to extract the list from between triple backticks
@@ -89,13 +110,12 @@ keyterms = ["term1", "term2", "term3"]
     if start != -1 and end != -1:
         code_block = llm_response[start+3:end].strip()
         try:
-            # Execute the code block to get the keyterms
-            local_vars = {}
-            exec(code_block, {}, local_vars)
-            if 'keyterms' in local_vars and isinstance(local_vars['keyterms'], list):
-                return local_vars['keyterms']
+            # Parse the list literal after "keyterms =" rather than running model output
+            keyterms = ast.literal_eval(code_block.split('=', 1)[-1].strip())
+            if isinstance(keyterms, list):
+                return keyterms
         except Exception as e:
-            logging.error(f"Failed to execute code block: {code_block}. Error: {str(e)}")
+            logging.error(f"Failed to parse code block: {code_block}. Error: {str(e)}")
     
     # If we couldn't extract a list, try to parse the whole response
     try:
@@ -106,128 +126,289 @@ keyterms = ["term1", "term2", "term3"]
         logging.error(f"Failed to parse full response as list: {llm_response}. Error: {str(e)}")
     
     # If we still don't have a valid list, recurse
-    return extract_key_terms(text, llm_client, attempt + 1, max_attempts)
+    return await extract_key_terms(text, llm_client, attempt + 1, max_attempts)
 
 
 class VectorStore:
-    def __init__(self, substrate):
+    """
+    A session's memory in three tiers:
+
+    - hot: the last `hot_turns` entries in RAM, always in the prompt
+    - warm: a local index on disk (LocalBackend), searched without a round trip
+    - cold: the session's Substrate collection (RemoteBackend)
+
+    Writes go to the cold tier, and to the warm tier with the vectors the
+    cold write returns. Reads stop at the first tier that fills the
+    context budget. The cold tier is only queried when the warm index is
+    missing entries the collection has, such as on a new machine.
+    """
+
+    def __init__(self, substrate, warm=None, cold=None, collection_name=None, batch_size=16, flush_interval=2.0,
+                 journal_path=None, recency_half_life=1800.0, recency_weight=0.3, hot_turns=12,
+                 context_budget=3000, known_entries=0, summaries=None):
         self.substrate = substrate
-        self.collection_name = generate_slug(2)
+        self.collection_name = collection_name or generate_slug(2)
         self.embedding_model = "jina-v2"
+        if warm is None and cold is None:
+            cold = RemoteBackend(substrate, self.embedding_model)
+        self.warm = warm
+        self.cold = cold
+        self.recency_half_life = recency_half_life
+        self.recency_weight = recency_weight
+        self.hot = HotBuffer(hot_turns)
+        # Entries that leave the hot tier are collapsed into rolling summaries (context.py)
+        self.summaries = summaries
+        self.context_budget = context_budget
+        # Entries the collection had when the session was opened (None if unknown),
+        # to tell whether the warm tier has them all
+        self.known_entries = known_entries
+        self.warm_complete = True
+        # time_hash -> (timestamp, key terms) of every entry in the collection, for query expansion
+        self.key_terms = {}
+        # How many turns each tier was the last one needed for
+        self.tier_reads = {"hot": 0, "warm": 0, "cold": 0}
+        # Entries are embedded in the background, several per call, so turns don't wait on them
+        self.writer = WriteBehindEmbedder(self._write, batch_size, flush_interval, journal_path)
 
     def initialize(self):
-        # Delete existing vector store if it exists
-        print(f"Initialized vector store: {self.collection_name}")
-
-        # TODO list different collections and then manage
-        """
-        delete = DeleteVectorStore(
-            collection_name=self.collection_name,
-            model=self.embedding_model,
-        )
-        self.substrate.run(delete)
-        """
-
-        # Create a new vector store
-        create = FindOrCreateVectorStore(
-            collection_name=self.collection_name,
-            model=self.embedding_model,
-        )
-        self.substrate.run(create)
+        for tier in (self.cold, self.warm):
+            if tier is not None:
+                tier.create(self.collection_name)
+        if self.warm is not None:
+            for metadata in self.warm.entries(self.collection_name):
+                if 'time_hash' in metadata:
+                    self.key_terms[metadata['time_hash']] = (
+                        metadata.get('timestamp', 0), json.loads(metadata.get('key_terms', '[]')))
+            # The hot tier picks up where the session left off, and so do summaries of the turns before it
+            summary_run = self.summaries.run_length if self.summaries is not None else 0
+            for metadata in self.warm.recent(self.collection_name, self.hot.entries.maxlen + summary_run):
+                if 'time_hash' in metadata:
+                    self._add_hot(metadata['time_hash'], metadata.get('role', 'Unknown'), split_doc(metadata['doc']),
+                                  metadata.get('timestamp', 0), json.loads(metadata.get('key_terms', '[]')))
+            self.warm_complete = self.cold is None or (
+                self.known_entries is not None and self.warm.count(self.collection_name) >= self.known_entries)
+        print(f"Initialized vector store: {self.collection_name} ({len(self.key_terms)} entries)")
+        self.writer.start()
+
+    def _write(self, entries):
+        vectors = self.cold.write(entries) if self.cold is not None else None
+        if self.warm is not None:
+            self.warm.write(entries, vectors)
+
+    def _add_hot(self, entry_id, role, content, timestamp, key_terms):
+        evicted = self.hot.add(entry_id, role, content, timestamp, key_terms)
+        if evicted is not None and self.summaries is not None:
+            self.summaries.add_turn(evicted)
 
     def add_entry(self, role, content, key_terms):
         time_hash = generate_time_hash()
-        embed = EmbedText(
-            text=f"{role}: {content}",
-            collection_name=self.collection_name,
-            model=self.embedding_model,
-            metadata={
+        timestamp = time.time()
+        self.key_terms[time_hash] = (timestamp, key_terms)
+        self._add_hot(time_hash, role, content, timestamp, key_terms)
+        self.writer.add(
+            self.collection_name,
+            time_hash,
+            f"{role}: {content}",
+            {
                 "role": role,
                 "time_hash": time_hash,
-                "timestamp": time.time(),
+                "timestamp": timestamp,
                 "key_terms": json.dumps(key_terms)
             }
         )
-        self.substrate.run(embed)
-
-    def get_recent_history(self, query_terms, limit=50):
-        query = QueryVectorStore(
-            query_strings=[" ".join(query_terms)] if query_terms else [""],
-            collection_name=self.collection_name,
-            model=self.embedding_model,
-            include_metadata=True,
-            top_k=limit,
-        )
-        query_res = self.substrate.run(query)
-        query_out = query_res.get(query)
-        
-        history = []
-        for result in query_out.results[0]:
-            metadata = result.metadata
-            role = metadata.get('role', 'Unknown')
-            content = metadata.get('doc', '').split(': ', 1)[-1] if ': ' in metadata.get('doc', '') else metadata.get('doc', '')
-            timestamp = metadata.get('timestamp', 0)
-            key_terms = json.loads(metadata.get('key_terms', '[]'))
-            history.append((timestamp, role, content, tuple(key_terms)))
-        
-        # Sort history by timestamp in ascending order
-        history.sort(key=lambda x: x[0])
-        
-        # Extract key terms from top 10 results
-        top_10_key_terms = set()
-        for _, _, _, terms in history[:10]:
-            top_10_key_terms.update(terms)
-        
-        # Perform second query with combined key terms
-        combined_terms = list(set(query_terms) | top_10_key_terms)
-        second_query = QueryVectorStore(
-            query_strings=[" ".join(combined_terms)],
-            collection_name=self.collection_name,
-            model=self.embedding_model,
-            include_metadata=True,
-            top_k=limit,
-        )
-        second_query_res = self.substrate.run(second_query)
-        second_query_out = second_query_res.get(second_query)
-        
-        # Combine results
-        for result in second_query_out.results[0]:
-            metadata = result.metadata
-            role = metadata.get('role', 'Unknown')
-            content = metadata.get('doc', '').split(': ', 1)[-1] if ': ' in metadata.get('doc', '') else metadata.get('doc', '')
-            timestamp = metadata.get('timestamp', 0)
-            key_terms = json.loads(metadata.get('key_terms', '[]'))
-            history.append((timestamp, role, content, tuple(key_terms)))  # Convert key_terms list to tuple
-        
-        # Remove duplicates while preserving order
-        seen = set()
-        unique_history = []
-        for item in history:
-            item_hash = hash((item[0], item[1], item[2]))  # Hash based on timestamp, role, and content
-            if item_hash not in seen:
-                seen.add(item_hash)
-                unique_history.append(item)
-        
-        # Sort unique history by timestamp
-        unique_history.sort(key=lambda x: x[0])
-        
-        # Remove timestamp and key_terms from the final output
-        return [(role, content) for _, role, content, _ in unique_history]
-
-def process_user_input(text, llm_client, vector_store):
-    key_terms = extract_key_terms(text, llm_client)
+
+    def entry_count(self):
+        """Entries in the collection: those there at the start plus those written since, or None if unknown."""
+        if self.known_entries is None:
+            return None
+        return self.known_entries + self.writer.stats()["written"]
+
+    def stats(self):
+        stats = {"writes": self.writer.stats(), "tiers": {"hot_entries": len(self.hot),
+                                                          "warm_complete": self.warm_complete,
+                                                          "reads": self.tier_reads}}
+        if self.summaries is not None:
+            stats["summaries"] = self.summaries.stats()
+        for tier in (self.cold, self.warm):
+            if tier is not None:
+                stats.update(tier.stats())
+        return stats
+
+    def close(self):
+        self.writer.close()
+        logging.info(f"Vector store stats: {json.dumps(self.stats())}")
+        for tier in (self.cold, self.warm):
+            if tier is not None:
+                tier.close()
+
+    async def get_recent_history(self, query_terms, limit=50):
+        """
+        Candidate entries for the prompt, for ContextBuilder to pack: the hot
+        entries (marked 'hot'), then the best `limit` matches from the warm and
+        cold tiers if the hot ones don't fill the context budget.
+        """
+        hot = [dict(entry, similarity=1.0, hot=True) for entry in self.hot.entries]
+        remaining = self.context_budget - self.hot.tokens()
+        if remaining <= 0:
+            # The latest turns fill the budget on their own: no query
+            self.tier_reads["hot"] += 1
+            return hot
+
+        # The query, and the query expanded with key terms of related entries, in one round trip
+        expanded = expansion_terms(query_terms, self.key_terms.values())
+        query_strings = [" ".join(query_terms) if query_terms else ""]
+        if expanded:
+            query_strings.append(" ".join(list(query_terms) + expanded))
+
+        hot_ids = self.hot.ids()
+        candidates = {}
+        tier = "hot"
+        for name, backend in (("warm", self.warm), ("cold", self.cold)):
+            if backend is None:
+                continue
+            if name == "cold" and self.warm is not None:
+                filled = sum(c['tokens'] for c in candidates.values()) >= remaining
+                if filled or self.warm_complete:
+                    break
+            results = await backend.query(self.collection_name, query_strings, limit)
+            for key, candidate in merge_matches(results).items():
+                if key not in hot_ids and key not in candidates:
+                    candidates[key] = candidate
+            tier = name
+        self.tier_reads[tier] += 1
+
+        # Entries still waiting to be embedded that have left the hot tier; the query can't see them yet
+        for entry in self.writer.unwritten(self.collection_name):
+            if entry['id'] in hot_ids:
+                continue
+            metadata = entry['metadata']
+            candidates[entry['id']] = {
+                'id': entry['id'],
+                'similarity': 1.0,
+                'timestamp': metadata['timestamp'],
+                'role': metadata['role'],
+                'content': split_doc(entry['text']),
+                'key_terms': tuple(json.loads(metadata['key_terms'])),
+                'tokens': count_tokens(entry['text']),
+            }
+
+        return rerank(candidates, time.time(), limit, self.recency_half_life, self.recency_weight) + hot
+
+def key_term_extractor(config, llm_client):
+    """The key term function for turns: local by default, the LLM with "key_terms": "llm"."""
+    local = KeywordExtractor(max_terms=config.get('key_terms_max', 8))
+    use_llm = config.get('key_terms', 'local') == 'llm'
+
+    async def extract(text):
+        # The local extractor still sees every turn, and covers for the LLM when it fails
+        local_terms = local.extract(text)
+        if not use_llm:
+            return local_terms
+        return await extract_key_terms(text, llm_client) or local_terms
+    return extract
+
+async def process_user_input(text, extract, vector_store):
+    key_terms = await extract(text)
     vector_store.add_entry("Human", text, key_terms)
     return key_terms
 
-def process_llm_response(text, llm_client, vector_store):
-    key_terms = extract_key_terms(text, llm_client)
+async def process_llm_response(text, extract, vector_store):
+    key_terms = await extract(text)
     vector_store.add_entry("Assistant", text, key_terms)
     return key_terms
 
-def build_context(recent_history):
-    return "\n".join([f"{role}: {content}" for role, content in recent_history])
+def print_stats(timings, background, vector_store, context_builder, style):
+    lines = [timings.format(), f"background: {json.dumps(background.stats())}",
+             f"context: {json.dumps(context_builder.stats())}"]
+    for name, value in vector_store.stats().items():
+        lines.append(f"{name}: {json.dumps(value)}")
+    print_formatted_text(FormattedText([('class:llm-response', '\n'.join(lines))]), style=style)
+
+def turn_summarizer(llm_client, max_words=80):
+    """summarize(run) for RollingSummaries, with Llama3Instruct8B: cheaper, and it runs in the background."""
+    async def summarize(run):
+        transcript = "\n".join(f"{e['role']}: {e['content']}" for e in run)
+        query = Llama3Instruct8B(
+            prompt=f"""Summarize this part of a conversation in at most {max_words} words. Keep names, facts,
+decisions and open questions; leave out pleasantries. Reply with the summary only.
+
+{transcript}
+
+Summary:""",
+            num_choices=1,
+            temperature=0.2,
+            max_tokens=max_words * 2,
+        )
+        response = await llm_client.async_run(query)
+        return response.get(query).choices[0].text
+    return summarize
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Llama3Instruct70B chat with memory.")
+    parser.add_argument("--session", help="Resume the named session, or start one with that name")
+    parser.add_argument("--resume", action="store_true", help="Resume the most recently used session")
+    parser.add_argument("--list", action="store_true", help="List sessions and exit")
+    parser.add_argument("--gc", action="store_true",
+                        help="Delete sessions unused for session_max_age_days (default 30) and exit")
+    parser.add_argument("--gc-untracked", action="store_true",
+                        help="With --gc, also delete Substrate collections that belong to no session, after confirming")
+    return parser.parse_args(argv)
+
+def list_sessions(registry, cold):
+    sessions = registry.list()
+    for name, record in sessions:
+        last_used = time.strftime('%Y-%m-%d %H:%M', time.localtime(record.get('last_used', 0)))
+        entries = record.get('entries')
+        print(f"{name:32s} {record.get('backend', '?'):10s} {'?' if entries is None else entries:>7} entries  "
+              f"last used {last_used}")
+    if not sessions:
+        print("No sessions yet")
+    if cold is not None:
+        tracked = {record['collection'] for _, record in sessions}
+        untracked = [name for name in cold.collections() if name not in tracked]
+        if untracked:
+            print(f"{len(untracked)} Substrate collections belong to no session (--gc --gc-untracked deletes them): "
+                  f"{', '.join(untracked)}")
+
+def collect_garbage(registry, cold, warm, max_age_days, untracked=False):
+    for name, record in registry.stale(max_age_days):
+        try:
+            if cold is not None and record.get('backend') == 'substrate':
+                cold.delete(record['collection'])
+            if warm is not None and warm.exists(record['collection']):
+                warm.delete(record['collection'])
+            summary_path = os.path.join(SUMMARY_DIR, f"{record['collection']}.jsonl")
+            if os.path.exists(summary_path):
+                os.remove(summary_path)
+            registry.remove(name)
+            print(f"Deleted session {name}")
+        except Exception as e:
+            logging.error(f"Error deleting session {name}: {str(e)}")
+    if untracked and cold is not None:
+        tracked = {record['collection'] for _, record in registry.list()}
+        names = [name for name in cold.collections() if name not in tracked]
+        if not names:
+            return
+        # Other tools on the same API key may have jina-v2 collections too, so ask before deleting any
+        print(f"{len(names)} Substrate collections belong to no session:")
+        for name in names:
+            print(f"  {name}")
+        try:
+            answer = input("Delete them? [y/N] ")
+        except EOFError:
+            answer = ''
+        if answer.strip().lower() not in ('y', 'yes'):
+            print("Kept them")
+            return
+        for name in names:
+            try:
+                cold.delete(name)
+                print(f"Deleted collection {name}")
+            except Exception as e:
+                logging.error(f"Error deleting collection {name}: {str(e)}")
 
-async def main():
+async def main(args=None):
+    args = args or parse_args([])
     config = load_or_create_config()
     if not config:
         logging.error("Failed to load or create config. Exiting.")
@@ -239,14 +420,91 @@ async def main():
         return
 
     try:
-        substrate = Substrate(api_key=api_key)
-        vector_store = VectorStore(substrate)
+        substrate = Substrate(api_key=api_key, base_url=os.environ.get('SUBSTRATE_BASE_URL', 'https://api.substrate.run'))
+        backend_name = config.get('vector_backend', 'substrate')
+        # The cold tier is the session's Substrate collection; the "local" backend keeps everything on disk
+        cold = RemoteBackend(substrate, "jina-v2") if backend_name != 'local' else None
+        # The warm tier: a local index of the session, kept across sessions
+        warm = LocalBackend(
+            substrate, "jina-v2", os.path.expanduser(config.get('vector_dir', VECTOR_DIR)),
+            index=config.get('vector_index', 'auto'),
+            ann_threshold=config.get('vector_ann_threshold', 50000),
+            # Repeated texts (greetings, retries, recurring key terms) are embedded once
+            cache=EmbeddingCache(
+                os.path.expanduser(config.get('embed_cache_path', EMBED_CACHE)),
+                config.get('embed_cache_entries', 100000),
+            ) if config.get('embed_cache', True) else None,
+        ) if cold is None or config.get('warm_tier', True) else None
+
+        registry = SessionRegistry(SESSIONS_FILE)
+        if args.list:
+            list_sessions(registry, cold)
+            return
+        if args.gc:
+            collect_garbage(registry, cold, warm, config.get('session_max_age_days', 30), args.gc_untracked)
+            return
+
+        if args.session:
+            session_name = args.session
+        elif args.resume and registry.latest():
+            session_name = registry.latest()
+        elif config.get('session'):
+            session_name = config['session']
+        elif cold is None:
+            # The local store's fixed collection from before sessions existed
+            session_name = config.get('memory_collection', 'memory')
+        else:
+            session_name = generate_slug(2)
+        record = registry.open(session_name, backend_name)
+        # "summaries": "llm" (the default), "local" for first sentences only, or false
+        summary_mode = config.get('summaries', 'llm')
+        summaries = RollingSummaries(
+            os.path.join(SUMMARY_DIR, f"{record['collection']}.jsonl"),
+            config.get('summary_run', 8),
+            turn_summarizer(substrate) if summary_mode == 'llm' else None,
+        ) if summary_mode else None
+        if cold is not None and record.get('entries') == 0 and session_name in cold.collections():
+            # A collection from before sessions were tracked: its size isn't known, so the cold tier stays in play
+            registry.update(session_name, entries=None)
+            record['entries'] = None
+
+        vector_store = VectorStore(
+            substrate,
+            warm=warm,
+            cold=cold,
+            collection_name=record['collection'],
+            batch_size=config.get('embed_batch_size', 16),
+            flush_interval=config.get('embed_flush_interval', 2.0),
+            # Keeps unwritten entries on disk until they are stored, so a crash doesn't lose them
+            journal_path=EMBED_JOURNAL if config.get('embed_journal', True) else None,
+            recency_half_life=config.get('recency_half_life', 1800.0),
+            recency_weight=config.get('recency_weight', 0.3),
+            hot_turns=config.get('hot_turns', 12),
+            context_budget=config.get('context_budget', 3000),
+            known_entries=record.get('entries', 0),
+            summaries=summaries,
+        )
         vector_store.initialize()
-        logging.info("Vector store initialized and reset.")
+        print(f"Session {session_name}; resume it with --session {session_name}")
+        logging.info("Vector store initialized.")
     except Exception as e:
         logging.error(f"Error initializing Substrate or Vector Store: {str(e)}")
         return
-    
+
+    extract_terms = key_term_extractor(config, substrate)
+    # Per-stage turn timings for /stats; the reply's bookkeeping runs after the prompt is back
+    timings = StageTimings()
+    background = BackgroundQueue(timings).start()
+    # Replies are printed token by token unless "stream" is false in the config
+    stream = config.get('stream', True)
+    # Packs the history into context_budget tokens, most relevant and recent first
+    context_builder = ContextBuilder(
+        config.get('context_budget', 3000),
+        config.get('recency_half_life', 1800.0),
+        config.get('recency_weight', 0.3),
+        vector_store.summaries,
+    )
+
     bindings = KeyBindings()
 
     @bindings.add('c-c')
@@ -270,41 +528,72 @@ async def main():
     print_formatted_text(FormattedText([('class:username', f"Your generated username is: {username}")]), style=style)
     print_formatted_text(FormattedText([('class:llm-response', "Welcome to Llama3Instruct70B Chat! Type 'exit' or 'quit' to end the session.")]), style=style)
 
-    while True:
-        try:
-            user_input = await session.prompt_async(
-                FormattedText([
-                    ('class:username', f'{username}'),
-                    ('class:prompt', '> ')
-                ])
-            )
-            if user_input.lower() in ['exit', 'quit', None]:
+    # Queued embeddings, reply bookkeeping and the session record are saved however the loop ends
+    try:
+        while True:
+            try:
+                user_input = await session.prompt_async(
+                    FormattedText([
+                        ('class:username', f'{username}'),
+                        ('class:prompt', '> ')
+                    ])
+                )
+                # Ctrl-C exits the prompt without a result
+                if user_input is None or user_input.lower() in ['exit', 'quit']:
+                    print_formatted_text(FormattedText([('class:llm-response', 'Goodbye!')]), style=style)
+                    break
+                if user_input.strip() == '/stats':
+                    print_stats(timings, background, vector_store, context_builder, style)
+                    continue
+
+                turn_start = time.perf_counter()
+                with timings.stage('key_terms'):
+                    key_terms = await process_user_input(user_input, extract_terms, vector_store)
+                # The message itself is embedded by the background writer while this runs
+                with timings.stage('retrieve'):
+                    recent_history = await vector_store.get_recent_history(key_terms)
+                with timings.stage('context'):
+                    context, _ = context_builder.build(recent_history, time.time())
+
+                llama3_query = Llama3Instruct70B(
+                    prompt=f"{context}\n\nAssistant:",
+                    num_choices=1,
+                    temperature=0.4,
+                    max_tokens=800,
+                )
+
+                try:
+                    if stream:
+                        # Printed as it is generated; the full text is still kept for memory
+                        with timings.stage('generate'):
+                            llm_response, reply_stats = await stream_reply(substrate, llama3_query, delta_printer(style))
+                        print()
+                        if reply_stats.ttft is not None:
+                            timings.record('first_token', reply_stats.ttft)
+                        timings.record('turn', time.perf_counter() - turn_start)
+                        print_formatted_text(FormattedText([('class:prompt', f"{reply_stats.format()} {context_builder.format()}")]), style=style)
+                    else:
+                        with timings.stage('generate'):
+                            response = await substrate.async_run(llama3_query)
+                        llm_response = response.get(llama3_query).choices[0].text
+                        timings.record('turn', time.perf_counter() - turn_start)
+                        print_formatted_text(FormattedText([('class:llm-response', f"Llama3: {llm_response.strip()}")]), style=style)
+                        print_formatted_text(FormattedText([('class:prompt', context_builder.format())]), style=style)
+                    background.submit('reply_bookkeeping', process_llm_response, llm_response.strip(), extract_terms, vector_store)
+                    if vector_store.summaries is not None:
+                        # After the bookkeeping, so a run the reply completes is summarized now
+                        background.submit('summarize', vector_store.summaries.summarize_ready)
+                except Exception as e:
+                    logging.error(f"Error querying Llama3Instruct70B: {str(e)}")
+                    print_formatted_text(FormattedText([('class:llm-response', "Sorry, I encountered an error. Please try again.")]), style=style)
+
+            except EOFError:
                 print_formatted_text(FormattedText([('class:llm-response', 'Goodbye!')]), style=style)
                 break
-
-            key_terms = process_user_input(user_input, substrate, vector_store)
-            recent_history = vector_store.get_recent_history(key_terms)
-            context = build_context(recent_history)
-
-            llama3_query = Llama3Instruct70B(
-                prompt=f"{context}\n\nAssistant:",
-                num_choices=1,
-                temperature=0.4,
-                max_tokens=800,
-            )
-
-            try:
-                response = substrate.run(llama3_query)
-                llm_response = response.get(llama3_query).choices[0].text
-                print_formatted_text(FormattedText([('class:llm-response', f"Llama3: {llm_response.strip()}")]), style=style)
-                process_llm_response(llm_response.strip(), substrate, vector_store)
-            except Exception as e:
-                logging.error(f"Error querying Llama3Instruct70B: {str(e)}")
-                print_formatted_text(FormattedText([('class:llm-response', "Sorry, I encountered an error. Please try again.")]), style=style)
-
-        except EOFError:
-            print_formatted_text(FormattedText([('class:llm-response', 'Goodbye!')]), style=style)
-            break
+    finally:
+        await background.aclose()
+        vector_store.close()
+        registry.update(session_name, entries=vector_store.entry_count(), last_used=time.time())
 
 if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main(parse_args()))
\ No newline at end of file
@@ -11,6 +11,8 @@ from prompt_toolkit.styles import Style
 from prompt_toolkit.shortcuts import print_formatted_text
 from coolname import generate_slug
 from substrate import Substrate, Llama3Instruct70B, sb, Box, ComputeText, Llama3Instruct8B
+from streaming import stream_reply, stream_first, delta_printer
+from bestof import candidate_nodes, best_of
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -24,7 +26,13 @@ def load_or_create_config():
             with open(CONFIG_FILE, 'r') as f:
                 config = json.load(f)
             logging.info(f"Config loaded from {CONFIG_FILE}")
+            # The environment's key wins, the other settings still come from the file
+            if os.environ.get('SUBSTRATE_API_KEY'):
+                config['api_key'] = os.environ['SUBSTRATE_API_KEY']
             return config
+        # Lets scripted and offline runs skip the prompt
+        if os.environ.get('SUBSTRATE_API_KEY'):
+            return {'api_key': os.environ['SUBSTRATE_API_KEY']}
         else:
             api_key = input("Please enter your Substrate API key: ")
             config = {'api_key': api_key}
@@ -49,11 +57,18 @@ async def main():
         return
 
     try:
-        substrate = Substrate(api_key=api_key)
+        substrate = Substrate(api_key=api_key, base_url=os.environ.get('SUBSTRATE_BASE_URL', 'https://api.substrate.run'))
     except Exception as e:
         logging.error(f"Error initializing Substrate: {str(e)}")
         return
 
+    # Replies are printed token by token unless "stream" is false in the config
+    stream = config.get('stream', True)
+    # "best_of": N generates N candidates per turn; "best_of_mode" is "quality"
+    # (score them all and show the best) or "latency" (stream the first to start)
+    best_of_n = config.get('best_of', 1)
+    best_of_mode = config.get('best_of_mode', 'quality')
+
     bindings = KeyBindings()
 
     @bindings.add('c-c')
@@ -89,20 +104,36 @@ async def main():
                 print_formatted_text(FormattedText([('class:llm-response', 'Goodbye!')]), style=style)
                 break
             
-            print("setup query")
-            llama3_query = Llama3Instruct8B(
-                prompt=user_input,
-                num_choices=2,
-                temperature=0.4,
-                max_tokens=800,
-            )
-            print("querying")
             try:
-                response = substrate.run(llama3_query)
-                print("got response")
-                llm_response = response.get(llama3_query).choices[0].text
-                print("printing response")
-                print_formatted_text(FormattedText([('class:llm-response', f"Llama3: {llm_response.strip()}")]), style=style)
+                if best_of_n > 1 and best_of_mode == 'latency':
+                    # Candidates run in parallel; the one that starts first is shown
+                    candidates = candidate_nodes(Llama3Instruct8B, best_of_n, prompt=user_input, max_tokens=800)
+                    index, llm_response, reply_stats = await stream_first(substrate, candidates, delta_printer(style))
+                    print()
+                    print_formatted_text(FormattedText([('class:prompt', f"{reply_stats.format()} candidate {index + 1} of {best_of_n}")]), style=style)
+                elif best_of_n > 1:
+                    # All candidates are generated, and the best by the local scorer is shown
+                    candidates = candidate_nodes(Llama3Instruct8B, best_of_n, prompt=user_input, max_tokens=800)
+                    index, llm_response, scores, reply_stats = await best_of(substrate, candidates, user_input)
+                    print_formatted_text(FormattedText([('class:llm-response', f"Llama3: {llm_response}")]), style=style)
+                    print_formatted_text(FormattedText([('class:prompt', f"[{reply_stats.ttft * 1000:.0f}ms] candidate {index + 1} of {best_of_n}, "
+                                                                         f"scores {', '.join(f'{score:.2f}' for score, _ in scores)}")]), style=style)
+                else:
+                    llama3_query = Llama3Instruct8B(
+                        prompt=user_input,
+                        num_choices=1,
+                        temperature=0.4,
+                        max_tokens=800,
+                    )
+                    if stream:
+                        # Printed as it is generated
+                        llm_response, reply_stats = await stream_reply(substrate, llama3_query, delta_printer(style))
+                        print()
+                        print_formatted_text(FormattedText([('class:prompt', reply_stats.format())]), style=style)
+                    else:
+                        response = await substrate.async_run(llama3_query)
+                        llm_response = response.get(llama3_query).choices[0].text
+                        print_formatted_text(FormattedText([('class:llm-response', f"Llama3: {llm_response.strip()}")]), style=style)
             except Exception as e:
                 logging.error(f"Error querying Llama3Instruct70B: {str(e)}")
                 print_formatted_text(FormattedText([('class:llm-response', "Sorry, I encountered an error. Please try again.")]), style=style)
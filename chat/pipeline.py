@@ -0,0 +1,99 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+class StageTimings:
+    """Recent durations of each named turn stage, for /stats."""
+
+    def __init__(self, window=200):
+        self.window = window
+        self._samples = {}
+        self._counts = {}
+
+    def record(self, name, seconds):
+        samples = self._samples.get(name)
+        if samples is None:
+            samples = self._samples[name] = deque(maxlen=self.window)
+            self._counts[name] = 0
+        samples.append(seconds)
+        self._counts[name] += 1
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def stats(self):
+        stats = {}
+        for name, samples in self._samples.items():
+            ordered = sorted(samples)
+            stats[name] = {
+                "count": self._counts[name],
+                "last_ms": round(samples[-1] * 1000, 2),
+                "mean_ms": round(sum(ordered) / len(ordered) * 1000, 2),
+                "p50_ms": round(ordered[len(ordered) // 2] * 1000, 2),
+                "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 2),
+            }
+        return stats
+
+    def format(self):
+        lines = [f"{'stage':18s} {'count':>6s} {'last':>9s} {'mean':>9s} {'p50':>9s} {'p95':>9s}"]
+        for name, s in self.stats().items():
+            lines.append(f"{name:18s} {s['count']:6d} {s['last_ms']:8.1f}ms {s['mean_ms']:8.1f}ms "
+                         f"{s['p50_ms']:8.1f}ms {s['p95_ms']:8.1f}ms")
+        return '\n'.join(lines)
+
+
+class BackgroundQueue:
+    """
+    Runs bookkeeping jobs after the turn has been answered, one at a time
+    and in submission order, so the next prompt doesn't wait for them.
+    Each job is a coroutine function; its time is recorded as a stage.
+    """
+
+    def __init__(self, timings):
+        self.timings = timings
+        self._queue = asyncio.Queue()
+        self._task = None
+        self.done = 0
+        self.failed = 0
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+        return self
+
+    def submit(self, name, job, *args):
+        self._queue.put_nowait((name, job, args))
+
+    async def _run(self):
+        while True:
+            name, job, args = await self._queue.get()
+            try:
+                with self.timings.stage(name):
+                    await job(*args)
+                self.done += 1
+            except Exception as e:
+                self.failed += 1
+                logging.error(f"Background job {name} failed: {str(e)}")
+            finally:
+                self._queue.task_done()
+
+    async def drain(self):
+        await self._queue.join()
+
+    async def aclose(self, timeout=30.0):
+        try:
+            await asyncio.wait_for(self.drain(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"{self._queue.qsize()} background jobs still queued at exit")
+        if self._task is not None:
+            self._task.cancel()
+
+    def stats(self):
+        return {"queued": self._queue.qsize(), "done": self.done, "failed": self.failed}
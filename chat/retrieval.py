@@ -0,0 +1,74 @@
+import json
+import math
+
+from context import count_tokens
+
+
+def expansion_terms(query_terms, entries, top=10):
+    """
+    Key terms of the `top` entries that share the most terms with the query,
+    most recent first on ties. This is the feedback step the second vector
+    query used to need a round trip for; every entry in the collection was
+    written by this process, so their key terms are already known here.
+    """
+    query = {t.lower() for t in query_terms}
+    scored = []
+    for timestamp, key_terms in entries:
+        overlap = len(query & {t.lower() for t in key_terms})
+        if overlap:
+            scored.append((overlap, timestamp, key_terms))
+    scored.sort(key=lambda s: (s[0], s[1]), reverse=True)
+    terms = []
+    seen = set(query)
+    for _, _, key_terms in scored[:top]:
+        for term in key_terms:
+            if term.lower() not in seen:
+                seen.add(term.lower())
+                terms.append(term)
+    return terms
+
+
+def split_doc(doc):
+    return doc.split(': ', 1)[-1] if ': ' in doc else doc
+
+
+def merge_matches(result_lists):
+    """
+    One candidate per stored entry across all query results, keyed by its
+    time_hash (or the match id), keeping the best similarity.
+    """
+    candidates = {}
+    for results in result_lists:
+        for result in results:
+            metadata = result.metadata or {}
+            key = metadata.get('time_hash') or result.id
+            similarity = 1.0 - result.distance if result.distance is not None else 0.0
+            current = candidates.get(key)
+            if current is not None:
+                current['similarity'] = max(current['similarity'], similarity)
+                continue
+            candidates[key] = {
+                'id': key,
+                'similarity': similarity,
+                'timestamp': metadata.get('timestamp', 0),
+                'role': metadata.get('role', 'Unknown'),
+                'content': split_doc(metadata.get('doc', '')),
+                'key_terms': tuple(json.loads(metadata.get('key_terms', '[]'))),
+                'tokens': count_tokens(metadata.get('doc', '')),
+            }
+    return candidates
+
+
+def rerank(candidates, now, limit, half_life=1800.0, recency_weight=0.3):
+    """
+    The `limit` best candidates by similarity blended with an exponential
+    recency decay (halving every `half_life` seconds), in chronological order.
+    """
+    def score(candidate):
+        age = max(0.0, now - candidate['timestamp'])
+        recency = math.pow(0.5, age / half_life) if half_life else 0.0
+        return (1.0 - recency_weight) * candidate['similarity'] + recency_weight * recency
+
+    best = sorted(candidates.values(), key=score, reverse=True)[:limit]
+    best.sort(key=lambda c: c['timestamp'])
+    return best
@@ -0,0 +1,114 @@
+import os
+import re
+import json
+import time
+import logging
+from collections import deque
+
+from context import count_tokens, line
+
+_NAME = re.compile(r'^[a-z0-9][a-z0-9_-]{0,63}$')
+
+
+def valid_name(name):
+    return bool(_NAME.match(name or ''))
+
+
+class SessionRegistry:
+    """
+    Named chat sessions and the vector store collection each one uses, in
+    one JSON file. The file is re-read before every change, so two chats
+    running at once don't undo each other's updates.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f).get('sessions', {})
+        except Exception as e:
+            logging.error(f"Error reading {self.path}: {str(e)}")
+            return {}
+
+    def _save(self, sessions):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump({'sessions': sessions}, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.path)
+
+    def get(self, name):
+        return self._load().get(name)
+
+    def list(self):
+        """(name, record) pairs, most recently used first."""
+        return sorted(self._load().items(), key=lambda item: item[1].get('last_used', 0), reverse=True)
+
+    def latest(self):
+        sessions = self.list()
+        return sessions[0][0] if sessions else None
+
+    def open(self, name, backend):
+        """The session's record, created if it is new; marks it used now."""
+        if not valid_name(name):
+            raise ValueError(f"Invalid session name {name!r}: use lowercase letters, digits, '-' and '_'")
+        sessions = self._load()
+        now = time.time()
+        record = sessions.get(name)
+        if record is None:
+            record = sessions[name] = {'collection': name, 'backend': backend, 'created': now, 'entries': 0}
+        record['last_used'] = now
+        self._save(sessions)
+        return dict(record)
+
+    def update(self, name, **fields):
+        sessions = self._load()
+        if name in sessions:
+            sessions[name].update(fields)
+            self._save(sessions)
+
+    def remove(self, name):
+        sessions = self._load()
+        if sessions.pop(name, None) is not None:
+            self._save(sessions)
+
+    def stale(self, max_age_days):
+        cutoff = time.time() - max_age_days * 86400
+        return [(name, record) for name, record in self.list() if record.get('last_used', 0) < cutoff]
+
+
+class HotBuffer:
+    """
+    The last `size` entries of the session in RAM, always part of the
+    prompt without a vector query. Each entry carries its token count.
+    """
+
+    def __init__(self, size=12):
+        self.entries = deque(maxlen=size)
+
+    def add(self, entry_id, role, content, timestamp, key_terms):
+        """Adds an entry; returns the one it pushed out, if the buffer was full."""
+        evicted = self.entries[0] if len(self.entries) == self.entries.maxlen else None
+        self.entries.append({
+            'id': entry_id,
+            'role': role,
+            'content': content,
+            'timestamp': timestamp,
+            'key_terms': tuple(key_terms),
+            'tokens': count_tokens(line(role, content)),
+        })
+        return evicted
+
+    def ids(self):
+        return {entry['id'] for entry in self.entries}
+
+    def tokens(self):
+        return sum(entry['tokens'] for entry in self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
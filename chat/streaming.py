@@ -0,0 +1,110 @@
+import time
+
+from prompt_toolkit.formatted_text import FormattedText
+from prompt_toolkit.shortcuts import print_formatted_text
+
+
+class StreamError(Exception):
+    pass
+
+
+class ReplyStats:
+    """Timing of one streamed reply. Each node.delta is counted as a token."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.first_token = None
+        self.end = None
+        self.tokens = 0
+
+    @property
+    def ttft(self):
+        return self.first_token - self.start if self.first_token is not None else None
+
+    @property
+    def tokens_per_second(self):
+        if self.first_token is None or self.end is None or self.tokens < 2:
+            return 0.0
+        # The first token's wait is TTFT; the rate is over the ones after it
+        elapsed = self.end - self.first_token
+        return (self.tokens - 1) / elapsed if elapsed > 0 else 0.0
+
+    def format(self):
+        ttft = f"{self.ttft * 1000:.0f}ms" if self.ttft is not None else "-"
+        return f"[ttft {ttft}, {self.tokens_per_second:.1f} tok/s, {self.tokens} tokens]"
+
+
+async def stream_reply(substrate, node, on_delta):
+    """
+    Run `node` with async_stream, calling on_delta(text) for each node.delta
+    as it arrives. Returns the full text of the first choice and its
+    ReplyStats once the node finishes.
+    """
+    _, text, stats = await stream_first(substrate, [node], on_delta)
+    return text, stats
+
+
+async def stream_first(substrate, nodes, on_delta):
+    """
+    Run `nodes` in one streamed graph and follow whichever sends a delta
+    first, calling on_delta(text) for its deltas only. Returns as soon as
+    that node finishes, with its index in `nodes`, its text and ReplyStats;
+    the other nodes' output is not waited for.
+    """
+    ids = {node.id: i for i, node in enumerate(nodes)}
+    stats = ReplyStats()
+    parts = []
+    chosen = None
+    result = None
+    response = await substrate.async_stream(*nodes)
+    try:
+        async for event in response.async_iter():
+            data = event.data
+            kind = data.get('object')
+            node_id = data.get('nodeId')
+            if kind == 'node.delta' and node_id in ids and chosen in (None, node_id):
+                text = data.get('data', {}).get('text', '')
+                if not text:
+                    continue
+                if stats.first_token is None:
+                    stats.first_token = time.perf_counter()
+                chosen = node_id
+                stats.tokens += 1
+                parts.append(text)
+                on_delta(text)
+            elif kind == 'node.result' and node_id in ids and chosen in (None, node_id):
+                chosen = node_id
+                result = data.get('data') or {}
+                break
+            elif kind == 'error':
+                raise StreamError(data.get('data', {}).get('message', 'stream failed'))
+            elif kind == 'graph.result':
+                break
+    finally:
+        # Leaving early closes the connection instead of reading the rest of the graph
+        await response.iterator.aclose()
+    stats.end = time.perf_counter()
+    if chosen is None:
+        raise StreamError("stream ended without output")
+
+    text = ''.join(parts)
+    # Without deltas (a node that doesn't stream) the whole reply is in its result
+    if not text and result and result.get('choices'):
+        text = result['choices'][0].get('text', '')
+        on_delta(text)
+    return ids[chosen], text, stats
+
+
+def delta_printer(style, prefix="Llama3: "):
+    """on_delta for stream_reply: prints the reply as it arrives, after `prefix`."""
+    started = []
+
+    def on_delta(text):
+        if not started:
+            text = text.lstrip()
+            if not text:
+                return
+            started.append(True)
+            print_formatted_text(FormattedText([('class:llm-response', prefix)]), style=style, end='')
+        print_formatted_text(FormattedText([('class:llm-response', text)]), style=style, end='', flush=True)
+    return on_delta
@@ -0,0 +1,208 @@
+import os
+import json
+import time
+import logging
+import threading
+
+
+class Journal:
+    """
+    Append-only JSON-lines log of entries waiting to be embedded.
+
+    Each entry is written (and fsynced) before add() returns, and an ack line
+    is written once its batch is stored upstream. Entries without an ack are
+    replayed on the next start. The file is emptied whenever nothing is left
+    unacknowledged.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def load(self):
+        entries = {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A torn last line from a crash mid-write
+                        continue
+                    if 'ack' in record:
+                        for entry_id in record['ack']:
+                            entries.pop(entry_id, None)
+                    else:
+                        entries[record['id']] = record
+        except FileNotFoundError:
+            pass
+        return list(entries.values())
+
+    def _write(self, record):
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def append(self, entry):
+        self._write(entry)
+
+    def ack(self, entry_ids, drained=False):
+        if drained:
+            self._file.truncate(0)
+            self._file.seek(0)
+            os.fsync(self._file.fileno())
+        else:
+            self._write({'ack': entry_ids})
+
+    def close(self):
+        self._file.close()
+
+
+class WriteBehindEmbedder:
+    """
+    Embeds vector store entries in the background, many per upstream call.
+
+    add() only queues the entry. A writer thread hands everything queued to
+    `write_batch(entries)` (one upstream call, see backends.py) once
+    `batch_size` entries are waiting or the oldest has waited
+    `flush_interval` seconds.
+    Failed batches stay queued and are retried with backoff. With a journal,
+    queued entries survive a crash and are written on the next start.
+    Entries use their id as doc_id, so a replayed batch overwrites rather
+    than duplicates.
+    """
+
+    def __init__(self, write_batch, batch_size=16, flush_interval=2.0, journal_path=None):
+        self.write_batch = write_batch
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.journal = Journal(journal_path) if journal_path else None
+        self._cond = threading.Condition()
+        self._pending = []
+        self._inflight = []
+        self._oldest = None
+        self._flush_requested = False
+        self._closing = False
+        self._thread = threading.Thread(target=self._run, name='embed-writer', daemon=True)
+        self.batches = 0
+        self.written = 0
+        self.failures = 0
+        self.replayed = 0
+        self.flush_seconds = 0.0
+
+        if self.journal is not None:
+            replay = self.journal.load()
+            if replay:
+                logging.info(f"Replaying {len(replay)} unwritten entries from {journal_path}")
+                self._pending.extend(replay)
+                self._oldest = time.monotonic()
+                self.replayed = len(replay)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def add(self, collection_name, entry_id, text, metadata):
+        entry = {'id': entry_id, 'collection_name': collection_name, 'text': text, 'metadata': metadata}
+        with self._cond:
+            # Under the lock, so a drained journal can't be emptied between this line and the queue
+            if self.journal is not None:
+                self.journal.append(entry)
+            if not self._pending:
+                self._oldest = time.monotonic()
+            self._pending.append(entry)
+            # The first entry starts the writer's flush timer; a full batch goes right away
+            if len(self._pending) == 1 or len(self._pending) >= self.batch_size:
+                self._cond.notify_all()
+
+    def unwritten(self, collection_name):
+        """Entries for the collection that a query may not find yet."""
+        with self._cond:
+            return [e for e in self._inflight + self._pending if e['collection_name'] == collection_name]
+
+    def flush(self, timeout=None):
+        """Send everything queued now and wait until it is written; returns False on timeout."""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._cond:
+            self._flush_requested = True
+            self._cond.notify_all()
+            while self._pending or self._inflight:
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            self._flush_requested = False
+        return True
+
+    def close(self, timeout=10.0):
+        drained = self.flush(timeout)
+        if not drained:
+            logging.warning("Embedding writes still pending at exit" +
+                            (", they stay in the journal" if self.journal is not None else " and are lost"))
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self._thread.join(1.0)
+        if self.journal is not None:
+            self.journal.close()
+
+    def _due(self):
+        if not self._pending:
+            return False
+        return (self._flush_requested or len(self._pending) >= self.batch_size
+                or time.monotonic() - self._oldest >= self.flush_interval)
+
+    def _run(self):
+        backoff = 0.5
+        while True:
+            with self._cond:
+                while not self._closing and not self._due():
+                    wait = None
+                    if self._pending:
+                        wait = max(0.0, self._oldest + self.flush_interval - time.monotonic())
+                    self._cond.wait(wait)
+                if self._closing:
+                    return
+                self._inflight, self._pending = self._pending, []
+                batch = self._inflight
+
+            try:
+                self._send(batch)
+            except Exception as e:
+                self.failures += 1
+                logging.error(f"Writing {len(batch)} embeddings failed, retrying in {backoff:.1f}s: {str(e)}")
+                with self._cond:
+                    self._pending = batch + self._pending
+                    self._inflight = []
+                    self._oldest = time.monotonic()
+                    self._cond.wait(backoff)
+                backoff = min(backoff * 2, 30.0)
+                continue
+
+            backoff = 0.5
+            with self._cond:
+                self._inflight = []
+                if self.journal is not None:
+                    self.journal.ack([e['id'] for e in batch], drained=not self._pending)
+                self._cond.notify_all()
+
+    def _send(self, batch):
+        start = time.perf_counter()
+        self.write_batch(batch)
+        self.batches += 1
+        self.written += len(batch)
+        self.flush_seconds += time.perf_counter() - start
+
+    def stats(self):
+        with self._cond:
+            pending = len(self._pending) + len(self._inflight)
+        return {
+            "pending": pending,
+            "batches": self.batches,
+            "written": self.written,
+            "avg_batch": round(self.written / self.batches, 2) if self.batches else 0.0,
+            "failures": self.failures,
+            "replayed": self.replayed,
+            "flush_seconds": round(self.flush_seconds, 3),
+        }
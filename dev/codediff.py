@@ -64,7 +64,7 @@ if not api_key:
     logging.error("API key not found in config. Exiting.")
     exit(1)
 
-substrate = Substrate(api_key=api_key)
+substrate = Substrate(api_key=api_key, base_url=os.environ.get('SUBSTRATE_BASE_URL', 'https://api.substrate.run'))
 
 models = [
     "gpt-4o-mini",
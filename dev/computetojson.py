@@ -15,7 +15,7 @@ def load_config():
 config = load_config()
 api_key = config['api_key']
 
-substrate = Substrate(api_key=api_key)
+substrate = Substrate(api_key=api_key, base_url=os.environ.get('SUBSTRATE_BASE_URL', 'https://api.substrate.run'))
 
 # Define the JSON schema
 json_schema = {
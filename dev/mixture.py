@@ -18,6 +18,9 @@ CONFIG_FILE = os.path.join(CONFIG_DIR, 'config.json')
 
 def load_or_create_config():
     try:
+        # Lets scripted and offline runs skip the prompt
+        if os.environ.get('SUBSTRATE_API_KEY'):
+            return {'api_key': os.environ['SUBSTRATE_API_KEY']}
         if os.path.exists(CONFIG_FILE):
             with open(CONFIG_FILE, 'r') as f:
                 config = json.load(f)
@@ -45,7 +48,7 @@ if not api_key:
     logging.error("API key not found in config. Exiting.")
     exit(1)
 
-substrate = Substrate(api_key=api_key, timeout=60 * 5)
+substrate = Substrate(api_key=api_key, base_url=os.environ.get('SUBSTRATE_BASE_URL', 'https://api.substrate.run'), timeout=60 * 5)
 
 AVAILABLE_MODELS = [
     "Mistral7BInstruct",
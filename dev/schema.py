@@ -35,7 +35,7 @@ if not config:
     raise Exception("Failed to load or create configuration")
 
 # Initialize Substrate client
-substrate = Substrate(api_key=config['api_key'])
+substrate = Substrate(api_key=config['api_key'], base_url=os.environ.get('SUBSTRATE_BASE_URL', 'https://api.substrate.run'))
 
 # Define the input query
 query = """Hippy types who buy chips and guac, and kale, who are are sporatic in buying during sales, having at least ordered 20 times via app, over total 50 times in e-comm and spend at least 200 to 400 dollars at a time, and drive mini vans with peace signs"""
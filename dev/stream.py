@@ -17,7 +17,7 @@ config = load_config()
 api_key = config['api_key']
 
 # Initialize Substrate
-substrate = Substrate(api_key=api_key)
+substrate = Substrate(api_key=api_key, base_url=os.environ.get('SUBSTRATE_BASE_URL', 'https://api.substrate.run'))
 
 @app.get("/chat")
 async def chat():
@@ -43,7 +43,7 @@ async def amain():
 
     try:
         # Initialize Substrate client with the API key from config
-        substrate = Substrate(api_key=api_key, timeout=60 * 5)
+        substrate = Substrate(api_key=api_key, base_url=os.environ.get('SUBSTRATE_BASE_URL', 'https://api.substrate.run'), timeout=60 * 5)
 
         # Define the query using Llama3Instruct70B
         query = Llama3Instruct70B(
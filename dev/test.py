@@ -19,7 +19,7 @@ api_key = config['api_key']
 
 # Initialize Substrate
 logger.info("Initializing Substrate with provided API key.")
-substrate = Substrate(api_key=api_key)
+substrate = Substrate(api_key=api_key, base_url=os.environ.get('SUBSTRATE_BASE_URL', 'https://api.substrate.run'))
 
 # Create initial computations
 logger.info("Creating initial computation for GPT-4o.")
@@ -0,0 +1,4 @@
+from .runtime import PROFILES, FailureInjector, FakeSubstrateRuntime, GraphError, Profile
+from .server import FakeSubstrateServer
+
+__all__ = ['PROFILES', 'FailureInjector', 'FakeSubstrateRuntime', 'FakeSubstrateServer', 'GraphError', 'Profile']
@@ -0,0 +1,787 @@
+"""
+Deterministic stand-in for the Substrate graph runtime.
+
+Executes the graph that substrate.Substrate.serialize() produces: resolves
+futures (trace, string-concat, format, jq, jinja), runs nodes in dependency
+order and returns the same output shapes as the hosted API. Generated text
+is derived from a hash of the node's arguments, so the same graph always gets
+the same answer. Embeddings are hashed bags of words, so text that shares
+words lands close together in the in-memory vector stores.
+"""
+import asyncio
+import base64
+import contextlib
+import hashlib
+import io
+import json
+import math
+import random
+import re
+import traceback
+
+FUTURE_REF = '__$$SB_GRAPH_OP_ID$$__'
+EMBEDDING_DIM = 768
+# Deltas a stream gets before an injected disconnect drops it
+DISCONNECT_AFTER = 3
+
+WORDS = """
+the of and to in is that it for as with was on be by this are from at or an have not
+they which one you had but all were when there can we what your more about their will
+said if do each how up out them then she many some so these would other into has her
+two like him see time could no make than first been its who now people my made over
+did down only way find use may water long little very after words called just where most
+know get through back much before go good new write our used me man too any day same
+right look think also around another came come work three word must because does part
+even place well such here take why things help put years different away again off went
+old number great tell men say small every found still between name should home big give
+air line set own under read last never us left end along while might next sound below
+saw something thought both few those always looked show large often together asked house
+world going want school important until form food keep children feet land side without
+""".split()
+
+# Relative generation speed, so bigger models are slower under the same profile
+MODEL_SPEED = {
+    'Llama3Instruct8B': 1.5,
+    'Mistral7BInstruct': 1.5,
+    'Mixtral8x7BInstruct': 1.0,
+    'Firellava13B': 1.0,
+    'Llama3Instruct70B': 0.6,
+    'Llama3Instruct405B': 0.3,
+}
+
+TEXT_NODES = {'ComputeText', 'Firellava13B'}
+CHOICE_NODES = {'MultiComputeText', 'Mistral7BInstruct', 'Mixtral8x7BInstruct', 'Llama3Instruct8B', 'Llama3Instruct70B'}
+
+
+class GraphError(Exception):
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+class Profile:
+    """
+    How long the fake takes: `latency` before the first token, `token_rate`
+    tokens per second after that (scaled per model by MODEL_SPEED), `jitter`
+    as a +/- fraction of both, and `node_latency` for non-generating nodes.
+    A rate of 0 means no delay at all.
+    """
+
+    def __init__(self, name, latency=0.0, token_rate=0.0, jitter=0.0, node_latency=0.0, reply_tokens=48):
+        self.name = name
+        self.latency = latency
+        self.token_rate = token_rate
+        self.jitter = jitter
+        self.node_latency = node_latency
+        self.reply_tokens = reply_tokens
+
+    def with_overrides(self, **overrides):
+        fields = {k: getattr(self, k) for k in ('latency', 'token_rate', 'jitter', 'node_latency', 'reply_tokens')}
+        fields.update({k: v for k, v in overrides.items() if v is not None})
+        return Profile(self.name, **fields)
+
+    def speed(self, model):
+        return self.token_rate * MODEL_SPEED.get(model, 1.0)
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'latency': self.latency,
+            'token_rate': self.token_rate,
+            'jitter': self.jitter,
+            'node_latency': self.node_latency,
+            'reply_tokens': self.reply_tokens,
+        }
+
+
+PROFILES = {
+    'instant': Profile('instant'),
+    'fast': Profile('fast', latency=0.02, token_rate=2000, node_latency=0.005),
+    'realistic': Profile('realistic', latency=0.35, token_rate=80, jitter=0.25, node_latency=0.05),
+    'slow': Profile('slow', latency=1.5, token_rate=15, jitter=0.5, node_latency=0.3),
+}
+
+
+class FailureInjector:
+    """
+    Fails a fraction of requests: with an HTTP error, by hanging until the
+    client gives up, or by dropping the connection a few deltas into a
+    stream. Draws come from a seeded generator, so the same sequence of
+    requests fails the same way on every run.
+    """
+
+    def __init__(self, error_rate=0.0, error_status=500, timeout_rate=0.0, disconnect_rate=0.0, seed=0):
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.timeout_rate = timeout_rate
+        self.disconnect_rate = disconnect_rate
+        self._random = random.Random(seed)
+
+    @staticmethod
+    def parse(value):
+        """Parse a forced failure such as 'error:503', 'timeout' or 'disconnect' (the X-Fake-Failure header)."""
+        kind, _, status = value.strip().partition(':')
+        if kind == 'error':
+            return ('error', int(status or 500))
+        if kind in ('timeout', 'disconnect'):
+            return (kind, None)
+        return None
+
+    def draw(self, forced=None):
+        if forced:
+            return self.parse(forced)
+        r = self._random.random()
+        if r < self.error_rate:
+            return ('error', self.error_status)
+        r -= self.error_rate
+        if r < self.timeout_rate:
+            return ('timeout', None)
+        r -= self.timeout_rate
+        if r < self.disconnect_rate:
+            return ('disconnect', None)
+        return None
+
+    def to_dict(self):
+        return {
+            'error_rate': self.error_rate,
+            'error_status': self.error_status,
+            'timeout_rate': self.timeout_rate,
+            'disconnect_rate': self.disconnect_rate,
+        }
+
+
+def _seed(*parts):
+    raw = json.dumps(parts, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(raw.encode('utf-8')).digest()
+
+
+def generate_text(seed, max_tokens=None, reply_tokens=48):
+    """Deterministic filler text of roughly reply_tokens words, capped at max_tokens."""
+    rng = random.Random(seed)
+    count = max(1, reply_tokens // 2 + rng.randrange(max(1, reply_tokens)))
+    if max_tokens:
+        count = min(count, max_tokens)
+    words = []
+    sentence = 0
+    for _ in range(count):
+        word = rng.choice(WORDS)
+        words.append(word.capitalize() if sentence == 0 else word)
+        sentence += 1
+        if sentence >= 6 and rng.random() < 0.2:
+            words[-1] += '.'
+            sentence = 0
+    if not words[-1].endswith('.'):
+        words[-1] += '.'
+    return ' '.join(words)
+
+
+def generate_json(schema, rng, depth=0):
+    """A value that satisfies the common parts of a JSON schema."""
+    if not isinstance(schema, dict):
+        return None
+    if 'const' in schema:
+        return schema['const']
+    if schema.get('enum'):
+        return rng.choice(schema['enum'])
+    for key in ('anyOf', 'oneOf', 'allOf'):
+        if schema.get(key):
+            return generate_json(schema[key][0], rng, depth)
+    kind = schema.get('type')
+    if isinstance(kind, list):
+        kind = next((k for k in kind if k != 'null'), 'null')
+    if kind == 'object' or (kind is None and 'properties' in schema):
+        if depth > 8:
+            return {}
+        return {name: generate_json(sub, rng, depth + 1) for name, sub in schema.get('properties', {}).items()}
+    if kind == 'array':
+        count = max(schema.get('minItems', 2), 1)
+        if 'maxItems' in schema:
+            count = min(count, schema['maxItems'])
+        return [generate_json(schema.get('items', {'type': 'string'}), rng, depth + 1) for _ in range(count)]
+    if kind == 'integer':
+        return rng.randint(schema.get('minimum', 0), schema.get('maximum', 100))
+    if kind == 'number':
+        return round(rng.uniform(schema.get('minimum', 0), schema.get('maximum', 100)), 2)
+    if kind == 'boolean':
+        return rng.random() < 0.5
+    if kind == 'null':
+        return None
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 4)))
+
+
+_TERMS = re.compile(r"\w+")
+
+
+def embed(text, dim=EMBEDDING_DIM):
+    """Sparse unit vector {index: weight} from hashed words (a signed bag-of-words embedding)."""
+    weights = {}
+    for term in _TERMS.findall(text.lower()):
+        h = int.from_bytes(hashlib.blake2b(term.encode('utf-8'), digest_size=8).digest(), 'little')
+        index = h % dim
+        weights[index] = weights.get(index, 0.0) + (1.0 if h >> 63 else -1.0)
+    return _normalize(weights)
+
+
+def _normalize(weights):
+    norm = math.sqrt(sum(v * v for v in weights.values()))
+    if not norm:
+        return {}
+    return {i: v / norm for i, v in weights.items() if v}
+
+
+def _dense(sparse, dim=EMBEDDING_DIM):
+    vector = [0.0] * dim
+    for i, v in sparse.items():
+        vector[i] = v
+    return vector
+
+
+def _cosine(a, b):
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(v * b.get(i, 0.0) for i, v in a.items())
+
+
+def _matches(metadata, filters):
+    for key, condition in (filters or {}).items():
+        value = metadata.get(key)
+        if not isinstance(condition, dict):
+            condition = {'$eq': condition}
+        for op, expected in condition.items():
+            try:
+                ok = {
+                    '$eq': lambda: value == expected,
+                    '$ne': lambda: value != expected,
+                    '$in': lambda: value in expected,
+                    '$nin': lambda: value not in expected,
+                    '$gt': lambda: value is not None and value > expected,
+                    '$gte': lambda: value is not None and value >= expected,
+                    '$lt': lambda: value is not None and value < expected,
+                    '$lte': lambda: value is not None and value <= expected,
+                }[op]()
+            except KeyError:
+                raise GraphError(f"Unsupported filter operator {op}")
+            except TypeError:
+                ok = False
+            if not ok:
+                return False
+    return True
+
+
+class VectorCollection:
+    def __init__(self, name, model):
+        self.name = name
+        self.model = model
+        self.docs = {}  # doc_id -> (sparse vector, metadata)
+
+    def upsert(self, doc_id, vector, metadata):
+        self.docs[doc_id] = (vector, metadata)
+
+    def query(self, vector, top_k, filters=None):
+        scored = []
+        for doc_id, (doc_vector, metadata) in self.docs.items():
+            if filters and not _matches(metadata, filters):
+                continue
+            scored.append((1.0 - _cosine(vector, doc_vector), doc_id))
+        scored.sort()
+        return scored[:top_k]
+
+    def describe(self):
+        return {'collection_name': self.name, 'model': self.model, 'num_leaves': max(1, len(self.docs) // 1000)}
+
+
+class FakeSubstrateRuntime:
+    """Executes serialized graphs. Vector stores live for as long as the runtime does."""
+
+    def __init__(self, profile='instant', failures=None, execute_python=True):
+        self.profile = PROFILES[profile] if isinstance(profile, str) else profile
+        self.failures = failures or FailureInjector()
+        self.execute_python = execute_python
+        self.stores = {}  # (collection_name, model) -> VectorCollection
+        self.graphs = 0
+        self.nodes = 0
+        self.injected = {}
+
+    def draw_failure(self, forced=None):
+        failure = self.failures.draw(forced)
+        if failure is not None:
+            label = failure[0] if failure[1] is None else f"{failure[0]}:{failure[1]}"
+            self.injected[label] = self.injected.get(label, 0) + 1
+        return failure
+
+    def reset(self):
+        self.stores.clear()
+
+    def stats(self):
+        return {
+            'profile': self.profile.to_dict(),
+            'failures': self.failures.to_dict(),
+            'graphs': self.graphs,
+            'nodes': self.nodes,
+            'injected': dict(self.injected),
+            'vector_stores': [dict(c.describe(), count=len(c.docs)) for c in self.stores.values()],
+        }
+
+    # -- graph --------------------------------------------------------------
+
+    def plan(self, dag):
+        """Validate a serialized graph and work out what each node waits for."""
+        try:
+            nodes = {node['id']: node for node in dag['nodes']}
+            futures = {future['id']: future['directive'] for future in dag.get('futures', [])}
+        except (KeyError, TypeError):
+            raise GraphError("Malformed graph")
+        for node in nodes.values():
+            if node.get('node') not in NODE_HANDLERS:
+                raise GraphError(f"Unsupported node type {node.get('node')}")
+
+        deps = {node_id: set() for node_id in nodes}
+        for node_id, node in nodes.items():
+            for future_id in _refs(node.get('args', {})):
+                deps[node_id] |= self._future_nodes(future_id, futures, set())
+        for edge in dag.get('edges', []):
+            deps[edge[1]].add(edge[0])
+        for node_id, needs in deps.items():
+            missing = needs - nodes.keys()
+            if missing:
+                raise GraphError(f"Node {node_id} depends on unknown node {missing.pop()}")
+
+        # Reject cycles up front rather than deadlocking
+        remaining = {node_id: set(needs) for node_id, needs in deps.items()}
+        while remaining:
+            ready = [node_id for node_id, needs in remaining.items() if not needs]
+            if not ready:
+                raise GraphError("Graph has a cycle")
+            for node_id in ready:
+                del remaining[node_id]
+            for needs in remaining.values():
+                needs.difference_update(ready)
+        return nodes, futures, deps
+
+    def _future_nodes(self, future_id, futures, seen):
+        if future_id in seen:
+            return set()
+        seen.add(future_id)
+        directive = futures.get(future_id)
+        if directive is None:
+            raise GraphError(f"Unknown future {future_id}")
+        found = set()
+        kind = directive.get('type')
+        items = []
+        if kind == 'trace':
+            found.add(directive['origin_node_id'])
+            items = directive['op_stack']
+        elif kind == 'string-concat':
+            items = directive['items']
+        elif kind == 'format':
+            items = [directive['f_string']]
+        elif kind == 'jq':
+            items = [directive['target']]
+        elif kind == 'jinja':
+            items = [directive['template']]
+        else:
+            raise GraphError(f"Unsupported future directive {kind}")
+        for item in items:
+            if item.get('future_id'):
+                found |= self._future_nodes(item['future_id'], futures, seen)
+        for nested in _refs(directive.get('variables', {})):
+            found |= self._future_nodes(nested, futures, seen)
+        return found
+
+    async def execute(self, dag, emit=None, plan=None):
+        """
+        Run a graph and return {node_id: output} for the nodes marked for
+        output. Independent nodes run concurrently. If given, the async
+        `emit(event)` receives node.delta and node.result events as they happen.
+        """
+        nodes, futures, deps = plan or self.plan(dag)
+        self.graphs += 1
+        outputs = {}
+        loop = asyncio.get_running_loop()
+        done = {node_id: loop.create_future() for node_id in nodes}
+
+        async def run_node(node_id):
+            try:
+                for dep in deps[node_id]:
+                    await done[dep]
+                node = nodes[node_id]
+                args = _Resolver(futures, outputs).resolve(node.get('args', {}))
+                output = await NODE_HANDLERS[node['node']](self, node_id, node['node'], args, emit)
+                outputs[node_id] = output
+                self.nodes += 1
+                if emit is not None:
+                    await emit({'object': 'node.result', 'nodeId': node_id, 'data': output})
+                done[node_id].set_result(None)
+            except BaseException as e:
+                done[node_id].set_exception(e)
+                raise
+
+        tasks = [asyncio.ensure_future(run_node(node_id)) for node_id in nodes]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            for future in done.values():
+                if future.done() and not future.cancelled():
+                    future.exception()  # mark retrieved
+        return {node_id: outputs[node_id] for node_id, node in nodes.items() if node.get('_should_output_globally')}
+
+    async def stream(self, dag, plan=None):
+        """Yield the event payloads of a streamed graph, ending with graph.result (or error)."""
+        queue = asyncio.Queue()
+        finished = object()
+        task = asyncio.ensure_future(self.execute(dag, emit=queue.put, plan=plan))
+        task.add_done_callback(lambda _: queue.put_nowait(finished))
+        try:
+            while True:
+                event = await queue.get()
+                if event is finished:
+                    break
+                yield event
+            try:
+                yield {'object': 'graph.result', 'data': task.result()}
+            except GraphError as e:
+                yield {'object': 'error', 'data': {'type': 'invalid_request_error', 'message': e.message}}
+        finally:
+            task.cancel()
+
+    # -- timing -------------------------------------------------------------
+
+    def _jitter(self, seed):
+        if not self.profile.jitter:
+            return 1.0
+        return 1.0 + self.profile.jitter * (2 * random.Random(seed).random() - 1)
+
+    async def _generate(self, node_id, model, texts, seed, emit):
+        """Wait as long as generating `texts` would take, streaming the first one as deltas."""
+        profile = self.profile
+        factor = self._jitter(seed)
+        rate = profile.speed(model) / factor if profile.token_rate else 0.0
+        latency = profile.latency * factor
+        words = texts[0].split(' ') if texts else []
+
+        if emit is None:
+            longest = max((len(t.split(' ')) for t in texts), default=0)
+            delay = latency + (longest / rate if rate else 0.0)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            return
+
+        if latency > 0:
+            await asyncio.sleep(latency)
+        # One delta per word, but sleep in steps of at least 5ms so a fast
+        # profile doesn't schedule a timer per token
+        per_word = 1.0 / rate if rate else 0.0
+        owed = 0.0
+        for i, word in enumerate(words):
+            owed += per_word
+            if owed >= 0.005:
+                await asyncio.sleep(owed)
+                owed = 0.0
+            text = word if i == len(words) - 1 else word + ' '
+            await emit({'object': 'node.delta', 'nodeId': node_id, 'data': {'text': text}})
+
+    async def _pause(self):
+        if self.profile.node_latency > 0:
+            await asyncio.sleep(self.profile.node_latency)
+
+    def _store(self, collection_name, model, create=True):
+        key = (collection_name, model or 'jina-v2')
+        if key not in self.stores:
+            if not create:
+                return None
+            self.stores[key] = VectorCollection(*key)
+        return self.stores[key]
+
+
+def _refs(value):
+    """Future ids referenced anywhere inside a node's args."""
+    if isinstance(value, dict):
+        if len(value) == 1 and FUTURE_REF in value:
+            yield value[FUTURE_REF]
+            return
+        for v in value.values():
+            yield from _refs(v)
+    elif isinstance(value, list):
+        for v in value:
+            yield from _refs(v)
+
+
+class _Resolver:
+    def __init__(self, futures, outputs):
+        self.futures = futures
+        self.outputs = outputs
+        self.cache = {}
+
+    def resolve(self, value):
+        if isinstance(value, dict):
+            if len(value) == 1 and FUTURE_REF in value:
+                return self.future(value[FUTURE_REF])
+            return {k: self.resolve(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self.resolve(v) for v in value]
+        return value
+
+    def item(self, item):
+        if item.get('future_id'):
+            return self.future(item['future_id'])
+        return item.get('val')
+
+    def future(self, future_id):
+        if future_id not in self.cache:
+            self.cache[future_id] = self._evaluate(self.futures[future_id])
+        return self.cache[future_id]
+
+    def _evaluate(self, directive):
+        kind = directive['type']
+        if kind == 'trace':
+            value = self.outputs[directive['origin_node_id']]
+            for op in directive['op_stack']:
+                key = self.item({'future_id': op.get('future_id'), 'val': op.get('key')})
+                try:
+                    value = value[key]
+                except (KeyError, IndexError, TypeError):
+                    raise GraphError(f"Cannot read {key!r} from output of {directive['origin_node_id']}")
+            return value
+        if kind == 'string-concat':
+            return ''.join(_as_text(self.item(item)) for item in directive['items'])
+        if kind == 'format':
+            variables = self.resolve(directive['variables'])
+            try:
+                return self.item(directive['f_string']).format(**variables)
+            except (KeyError, IndexError, ValueError) as e:
+                raise GraphError(f"Format failed: {str(e)}")
+        if kind == 'jq':
+            return _jq(self.item(directive['target']), directive['query'])
+        if kind == 'jinja':
+            try:
+                import jinja2
+            except ImportError:
+                raise GraphError("jinja directives need jinja2 installed")
+            return jinja2.Template(self.item(directive['template'])).render(**self.resolve(directive['variables']))
+        raise GraphError(f"Unsupported future directive {kind}")
+
+
+def _as_text(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return '' if value is None else str(value)
+
+
+_JQ_STEP = re.compile(r'\.([A-Za-z_]\w*)|\.?\[(-?\d+)\]|\.?\["([^"]+)"\]|\.?\[\]')
+
+
+def _jq(value, query):
+    """The path subset of jq: .a.b, .[0], .["key"] and .[] (map over the rest of the path)."""
+    query = query.strip()
+    if query == '.':
+        return value
+    steps = []
+    pos = 0
+    while pos < len(query):
+        match = _JQ_STEP.match(query, pos)
+        if not match:
+            raise GraphError(f"Unsupported jq query {query}")
+        steps.append(match.groups())
+        pos = match.end()
+
+    def walk(value, steps):
+        for i, (name, index, quoted) in enumerate(steps):
+            if name is None and index is None and quoted is None:
+                return [walk(v, steps[i + 1:]) for v in (value.values() if isinstance(value, dict) else value)]
+            key = int(index) if index is not None else (name or quoted)
+            try:
+                value = value[key]
+            except (KeyError, IndexError, TypeError):
+                value = None
+        return value
+    return walk(value, steps)
+
+
+# -- nodes ------------------------------------------------------------------
+
+def _text_seed(kind, args, index=0):
+    return _seed(kind, args.get('model'), args.get('prompt'), args.get('system_prompt'),
+                 args.get('temperature'), args.get('json_schema'), index)
+
+
+async def _text(runtime, node_id, kind, args, emit):
+    seed = _text_seed(kind, args)
+    text = generate_text(seed, args.get('max_tokens'), runtime.profile.reply_tokens)
+    await runtime._generate(node_id, args.get('model') or 'Llama3Instruct8B', [text], seed, emit)
+    return {'text': text}
+
+
+async def _choices(runtime, node_id, kind, args, emit):
+    choices = []
+    for index in range(args.get('num_choices') or 1):
+        seed = _text_seed(kind, args, index)
+        if args.get('json_schema'):
+            json_object = generate_json(args['json_schema'], random.Random(seed))
+            choices.append({'text': json.dumps(json_object), 'json_object': json_object})
+        else:
+            choices.append({'text': generate_text(seed, args.get('max_tokens'), runtime.profile.reply_tokens)})
+    model = args.get('model') or (kind if kind != 'MultiComputeText' else 'Llama3Instruct8B')
+    await runtime._generate(node_id, model, [c['text'] for c in choices], _text_seed(kind, args), emit)
+    return {'choices': choices}
+
+
+async def _batch_text(runtime, node_id, kind, args, emit):
+    outputs = []
+    for prompt in args.get('prompts') or []:
+        seed = _text_seed(kind, dict(args, prompt=prompt))
+        outputs.append({'text': generate_text(seed, args.get('max_tokens'), runtime.profile.reply_tokens)})
+    await runtime._generate(node_id, args.get('model') or 'Llama3Instruct8B', [o['text'] for o in outputs],
+                            _text_seed(kind, args), None)
+    return {'outputs': outputs}
+
+
+def _json_output(kind, args, index=0):
+    json_object = generate_json(args.get('json_schema') or {}, random.Random(_text_seed(kind, args, index)))
+    return {'json_object': json_object, 'text': json.dumps(json_object)}
+
+
+async def _compute_json(runtime, node_id, kind, args, emit):
+    output = _json_output(kind, args)
+    await runtime._generate(node_id, args.get('model') or 'Llama3Instruct8B', [output['text']],
+                            _text_seed(kind, args), None)
+    return output
+
+
+async def _multi_json(runtime, node_id, kind, args, emit):
+    choices = [_json_output(kind, args, i) for i in range(args.get('num_choices') or 1)]
+    await runtime._generate(node_id, args.get('model') or 'Llama3Instruct8B', [c['text'] for c in choices],
+                            _text_seed(kind, args), None)
+    return {'choices': choices}
+
+
+async def _batch_json(runtime, node_id, kind, args, emit):
+    outputs = [_json_output(kind, dict(args, prompt=p)) for p in args.get('prompts') or []]
+    await runtime._generate(node_id, args.get('model') or 'Llama3Instruct8B', [o['text'] for o in outputs],
+                            _text_seed(kind, args), None)
+    return {'outputs': outputs}
+
+
+def _embed_item(runtime, text, collection_name, model, metadata, doc_id):
+    vector = embed(text)
+    metadata = dict(metadata or {})
+    if collection_name:
+        metadata['doc'] = text
+        doc_id = doc_id or hashlib.sha256(_seed(collection_name, text, metadata)).hexdigest()[:24]
+        runtime._store(collection_name, model).upsert(doc_id, vector, metadata)
+    embedding = {'vector': _dense(vector), 'doc_id': doc_id}
+    if metadata:
+        embedding['metadata'] = metadata
+    return embedding
+
+
+async def _embed_text(runtime, node_id, kind, args, emit):
+    await runtime._pause()
+    return {'embedding': _embed_item(runtime, args.get('text') or '', args.get('collection_name'),
+                                     args.get('model'), args.get('metadata'), args.get('doc_id'))}
+
+
+async def _multi_embed(runtime, node_id, kind, args, emit):
+    await runtime._pause()
+    model = args.get('model') or ('jina-v2' if kind == 'JinaV2' else None)
+    return {'embeddings': [
+        _embed_item(runtime, item.get('text') or '', args.get('collection_name'), model,
+                    item.get('metadata'), item.get('doc_id'))
+        for item in args.get('items') or []
+    ]}
+
+
+async def _find_or_create_store(runtime, node_id, kind, args, emit):
+    await runtime._pause()
+    return runtime._store(args['collection_name'], args.get('model')).describe()
+
+
+async def _list_stores(runtime, node_id, kind, args, emit):
+    await runtime._pause()
+    return {'items': [c.describe() for c in runtime.stores.values()]}
+
+
+async def _delete_store(runtime, node_id, kind, args, emit):
+    await runtime._pause()
+    runtime.stores.pop((args['collection_name'], args.get('model') or 'jina-v2'), None)
+    return {'collection_name': args['collection_name'], 'model': args.get('model') or 'jina-v2'}
+
+
+async def _query_store(runtime, node_id, kind, args, emit):
+    await runtime._pause()
+    store = runtime._store(args['collection_name'], args.get('model'), create=False)
+    vectors = [embed(q) for q in args.get('query_strings') or []]
+    vectors += [_normalize(dict(enumerate(v))) for v in args.get('query_vectors') or []]
+    if store is not None:
+        vectors += [store.docs[i][0] for i in args.get('query_ids') or [] if i in store.docs]
+
+    results = []
+    for vector in vectors:
+        matches = []
+        if store is not None:
+            for distance, doc_id in store.query(vector, args.get('top_k') or 10, args.get('filters')):
+                match = {'id': doc_id, 'distance': round(distance, 6)}
+                doc_vector, metadata = store.docs[doc_id]
+                if args.get('include_values'):
+                    match['vector'] = _dense(doc_vector)
+                if args.get('include_metadata'):
+                    match['metadata'] = metadata
+                matches.append(match)
+        results.append(matches)
+    return {'results': results, 'collection_name': args['collection_name'], 'model': args.get('model') or 'jina-v2'}
+
+
+async def _run_python(runtime, node_id, kind, args, emit):
+    await runtime._pause()
+    if not runtime.execute_python:
+        return {'output': None, 'stdout': '', 'stderr': 'RunPython is disabled on this fake server\n'}
+    try:
+        import cloudpickle
+    except ImportError:
+        raise GraphError("RunPython needs cloudpickle installed")
+    stdout, stderr = io.StringIO(), io.StringIO()
+    output = None
+    # Runs in-process and in the event loop, like a single-tenant sandbox
+    with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+        try:
+            function = cloudpickle.loads(base64.b64decode(args['pkl_function']))
+            output = function(**(args.get('kwargs') or {}))
+        except Exception:
+            traceback.print_exc()
+    try:
+        json.dumps(output)
+    except (TypeError, ValueError):
+        output = repr(output)
+    return {'output': output, 'stdout': stdout.getvalue(), 'stderr': stderr.getvalue()}
+
+
+async def _box(runtime, node_id, kind, args, emit):
+    return {'value': args.get('value')}
+
+
+async def _if(runtime, node_id, kind, args, emit):
+    return {'result': args.get('value_if_true') if args.get('condition') else args.get('value_if_false')}
+
+
+NODE_HANDLERS = {
+    **{kind: _text for kind in TEXT_NODES},
+    **{kind: _choices for kind in CHOICE_NODES},
+    'BatchComputeText': _batch_text,
+    'ComputeJSON': _compute_json,
+    'MultiComputeJSON': _multi_json,
+    'BatchComputeJSON': _batch_json,
+    'EmbedText': _embed_text,
+    'MultiEmbedText': _multi_embed,
+    'JinaV2': _multi_embed,
+    'FindOrCreateVectorStore': _find_or_create_store,
+    'ListVectorStores': _list_stores,
+    'DeleteVectorStore': _delete_store,
+    'QueryVectorStore': _query_store,
+    'RunPython': _run_python,
+    'Box': _box,
+    'If': _if,
+}
@@ -0,0 +1,187 @@
+"""
+HTTP front end for the fake runtime, speaking the same POST /compose protocol
+as api.substrate.run (JSON, or SSE when the client sends
+Accept: text/event-stream). It is a bare asyncio HTTP/1.1 server with
+keep-alive, so the fake costs far less CPU than the proxy it is measuring.
+
+    python -m fakesubstrate --port 9988 --profile realistic --error-rate 0.02
+
+Point anything at it with SUBSTRATE_BASE_URL=http://127.0.0.1:9988.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import uuid
+
+from .runtime import PROFILES, DISCONNECT_AFTER, FakeSubstrateRuntime, FailureInjector, GraphError
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 429: 'Too Many Requests',
+           500: 'Internal Server Error', 502: 'Bad Gateway', 503: 'Service Unavailable'}
+
+
+class FakeSubstrateServer:
+    def __init__(self, runtime, host='127.0.0.1', port=9988):
+        self.runtime = runtime
+        self.host = host
+        self.port = port
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self.handle, self.host, self.port, backlog=1024)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logging.info(f"Fake Substrate listening on http://{self.host}:{self.port} (profile {self.runtime.profile.name})")
+        return self
+
+    async def serve_forever(self):
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except asyncio.IncompleteReadError:
+                    return
+                lines = head.decode('latin-1').split('\r\n')
+                method, path, _ = lines[0].split(' ', 2)
+                headers = {}
+                for line in lines[1:]:
+                    if ':' in line:
+                        name, value = line.split(':', 1)
+                        headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                path = path.split('?', 1)[0]
+                if method == 'POST' and path == '/compose':
+                    keep_open = await self.compose(reader, writer, headers, body)
+                elif method == 'GET' and path in ('/', '/health'):
+                    keep_open = self.respond(writer, 200, self.runtime.stats())
+                elif method == 'POST' and path == '/reset':
+                    self.runtime.reset()
+                    keep_open = self.respond(writer, 200, {'reset': True})
+                else:
+                    keep_open = self.respond(writer, 404, {'error': {'type': 'not_found', 'message': path}})
+                await writer.drain()
+                if not keep_open or headers.get('connection', '').lower() == 'close':
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            logging.error(f"Fake Substrate request failed: {str(e)}")
+        finally:
+            writer.close()
+
+    def respond(self, writer, status, payload, request_id=None):
+        body = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+        head = (f"HTTP/1.1 {status} {REASONS.get(status, 'Error')}\r\n"
+                f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n")
+        if request_id:
+            head += f"x-substrate-request-id: {request_id}\r\n"
+        writer.write(head.encode('latin-1') + b'\r\n' + body)
+        return True
+
+    async def compose(self, reader, writer, headers, body):
+        request_id = uuid.uuid4().hex
+        try:
+            dag = json.loads(body)['dag']
+            plan = self.runtime.plan(dag)
+        except GraphError as e:
+            return self.respond(writer, e.status_code, {'error': {'type': 'invalid_request_error', 'message': e.message}})
+        except (ValueError, KeyError, TypeError):
+            return self.respond(writer, 400, {'error': {'type': 'invalid_request_error', 'message': 'Malformed body'}})
+
+        failure = self.runtime.draw_failure(headers.get('x-fake-failure'))
+        if failure and failure[0] == 'error':
+            return self.respond(writer, failure[1], {'error': {'type': 'api_error', 'message': 'Injected failure'}}, request_id)
+        if failure and failure[0] == 'timeout':
+            # Hang until the client gives up and closes the connection
+            await reader.read()
+            return False
+
+        if 'text/event-stream' not in headers.get('accept', ''):
+            if failure:
+                writer.transport.abort()
+                return False
+            try:
+                data = await self.runtime.execute(dag, plan=plan)
+            except GraphError as e:
+                return self.respond(writer, e.status_code, {'error': {'type': 'invalid_request_error', 'message': e.message}}, request_id)
+            return self.respond(writer, 200, {'data': data}, request_id)
+
+        writer.write((
+            "HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+            f"Transfer-Encoding: chunked\r\nx-substrate-request-id: {request_id}\r\n\r\n"
+        ).encode('latin-1'))
+        deltas = 0
+        events = self.runtime.stream(dag, plan=plan)
+        try:
+            async for event in events:
+                chunk = b'data: ' + json.dumps(event, separators=(',', ':')).encode('utf-8') + b'\n\n'
+                writer.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+                await writer.drain()
+                if event['object'] == 'node.delta':
+                    deltas += 1
+                    if failure and deltas >= DISCONNECT_AFTER:
+                        writer.transport.abort()
+                        return False
+        finally:
+            await events.aclose()
+        if failure:
+            # Fewer deltas than DISCONNECT_AFTER: drop before the terminating chunk
+            writer.transport.abort()
+            return False
+        writer.write(b'0\r\n\r\n')
+        return True
+
+
+def build_runtime(args):
+    profile = PROFILES[args.profile].with_overrides(
+        latency=args.latency, token_rate=args.token_rate, jitter=args.jitter, reply_tokens=args.reply_tokens)
+    failures = FailureInjector(
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        timeout_rate=args.timeout_rate,
+        disconnect_rate=args.disconnect_rate,
+        seed=args.seed,
+    )
+    return FakeSubstrateRuntime(profile, failures, execute_python=not args.no_python)
+
+
+def add_arguments(parser):
+    parser.add_argument("--profile", choices=sorted(PROFILES), default=os.environ.get('FAKE_SUBSTRATE_PROFILE', 'fast'),
+                        help="Latency/token-rate profile (default: fast)")
+    parser.add_argument("--latency", type=float, help="Override the profile's seconds before the first token")
+    parser.add_argument("--token-rate", type=float, help="Override the profile's tokens per second")
+    parser.add_argument("--jitter", type=float, help="Override the profile's +/- jitter fraction")
+    parser.add_argument("--reply-tokens", type=int, help="Typical reply length in tokens")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with --error-status")
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--timeout-rate", type=float, default=0.0, help="Fraction of requests that never answer")
+    parser.add_argument("--disconnect-rate", type=float, default=0.0, help="Fraction of requests whose connection drops")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for failure injection")
+    parser.add_argument("--no-python", action="store_true", help="Don't execute RunPython functions")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local fake Substrate API for benchmarks and offline runs.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9988)
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    async def run():
+        server = await FakeSubstrateServer(build_runtime(args), args.host, args.port).start()
+        await server.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,140 @@
+"""
+In-process drop-in for the Substrate SDK client.
+
+    from fakesubstrate.shim import Substrate, ComputeText, sb
+
+Nodes and `sb` are the SDK's own, so graphs serialize exactly as they would
+for the hosted API. Substrate runs them on a FakeSubstrateRuntime instead of
+posting them, and returns the SDK's response types. Injected failures surface
+as the exceptions the real client raises.
+"""
+import asyncio
+import json
+import threading
+
+import httpx
+import httpx_sse
+from substrate import Substrate as _Substrate
+from substrate import (  # noqa: F401 - re-exported so the shim can replace `from substrate import ...`
+    Box,
+    ComputeJSON,
+    ComputeText,
+    DeleteVectorStore,
+    EmbedText,
+    FindOrCreateVectorStore,
+    If,
+    ListVectorStores,
+    Llama3Instruct8B,
+    Llama3Instruct70B,
+    Mistral7BInstruct,
+    Mixtral8x7BInstruct,
+    MultiComputeText,
+    MultiEmbedText,
+    QueryVectorStore,
+    RunPython,
+    sb,
+)
+from substrate._client import APIResponse
+from substrate.streaming import SubstrateStreamingResponse
+from substrate.substrate_response import SubstrateResponse
+
+from .runtime import DISCONNECT_AFTER, FakeSubstrateRuntime, GraphError
+
+
+class Substrate:
+    """
+    Same methods as substrate.Substrate: run, async_run, stream, async_stream.
+
+    Pass `runtime` to share vector stores between clients, or `profile` and
+    `failures` to build a private one. The sync methods run on a background
+    event loop, so they also work when called from inside a coroutine.
+    """
+
+    def __init__(self, api_key=None, base_url=None, timeout=60 * 5.0, secrets=None, additional_headers=None,
+                 runtime=None, profile='instant', failures=None):
+        self.api_key = api_key
+        self.timeout = timeout
+        self.runtime = runtime or FakeSubstrateRuntime(profile, failures)
+        self._loop = None
+        self._lock = threading.Lock()
+
+    serialize = staticmethod(_Substrate.serialize)
+
+    def _call(self, coro):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name='fakesubstrate', daemon=True).start()
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def run(self, *nodes):
+        return self._call(self.async_run(*nodes))
+
+    async def async_run(self, *nodes):
+        dag = _Substrate.serialize(*nodes)
+        body = {'dag': dag}
+        failure = self.runtime.draw_failure()
+        if failure and failure[0] == 'error':
+            return _response(failure[1], {'error': {'type': 'api_error', 'message': 'Injected failure'}}, body)
+        if failure and failure[0] == 'timeout':
+            raise httpx.ReadTimeout("Injected timeout")
+        if failure:
+            raise httpx.RemoteProtocolError("Server disconnected without sending a response.")
+        try:
+            data = await self.runtime.execute(dag)
+        except GraphError as e:
+            return _response(e.status_code, {'error': {'type': 'invalid_request_error', 'message': e.message}}, body)
+        return _response(200, {'data': data}, body)
+
+    def stream(self, *nodes):
+        dag = _Substrate.serialize(*nodes)
+
+        def iterator():
+            events = self._events(dag)
+            try:
+                while True:
+                    try:
+                        yield self._call(events.__anext__())
+                    except StopAsyncIteration:
+                        return
+            finally:
+                self._call(events.aclose())
+
+        return SubstrateStreamingResponse(iterator=iterator())
+
+    async def async_stream(self, *nodes):
+        dag = _Substrate.serialize(*nodes)
+        return SubstrateStreamingResponse(iterator=self._events(dag))
+
+    async def _events(self, dag):
+        """The events the SDK's SSE reader would produce for this graph."""
+        failure = self.runtime.draw_failure()
+        if failure and failure[0] == 'error':
+            raise httpx_sse.SSEError(
+                "Expected response header Content-Type to contain 'text/event-stream', got 'application/json'")
+        if failure and failure[0] == 'timeout':
+            raise httpx.ReadTimeout("Injected timeout")
+        try:
+            plan = self.runtime.plan(dag)
+        except GraphError:
+            raise httpx_sse.SSEError(
+                "Expected response header Content-Type to contain 'text/event-stream', got 'application/json'")
+
+        deltas = 0
+        events = self.runtime.stream(dag, plan=plan)
+        try:
+            async for event in events:
+                yield httpx_sse.ServerSentEvent(data=json.dumps(event))
+                if event['object'] == 'node.delta':
+                    deltas += 1
+                    if failure and deltas >= DISCONNECT_AFTER:
+                        break
+        finally:
+            await events.aclose()
+        if failure:
+            raise httpx.RemoteProtocolError("peer closed connection without sending complete message body")
+
+
+def _response(status_code, payload, body):
+    headers = httpx.Headers({'content-type': 'application/json'})
+    return SubstrateResponse(api_response=APIResponse(status_code=status_code, json=payload, headers=headers, request=body))
@@ -25,7 +25,7 @@ def load_or_create_config():
 config = load_or_create_config()
 api_key = config['api_key']
 
-substrate = Substrate(api_key=api_key)
+substrate = Substrate(api_key=api_key, base_url=os.environ.get('SUBSTRATE_BASE_URL', 'https://api.substrate.run'))
 
 def load_functions_from_directory(directory):
     functions = {}
@@ -0,0 +1,89 @@
+import asyncio
+import logging
+
+
+class EmbeddingBatcher:
+    """
+    Micro-batches embedding inputs.
+
+    Inputs for the same model that arrive within `max_wait` seconds of the
+    first one are sent upstream together by `run_batch(model, texts)`, which
+    returns one vector per text. A batch goes out as soon as it reaches
+    `max_batch` inputs. Identical texts in a batch are embedded once.
+    """
+
+    def __init__(self, run_batch, max_batch=64, max_wait=0.01):
+        self.run_batch = run_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._pending = {}  # model -> [(text, future)]
+        self._timers = {}
+        self._tasks = set()
+        self.batches = 0
+        self.inputs = 0
+        self.sent = 0
+        self.failures = 0
+
+    async def embed(self, model, texts):
+        loop = asyncio.get_running_loop()
+        futures = []
+        for text in texts:
+            future = loop.create_future()
+            futures.append(future)
+            pending = self._pending.setdefault(model, [])
+            pending.append((text, future))
+            if len(pending) >= self.max_batch:
+                self._flush(model)
+            elif model not in self._timers:
+                self._timers[model] = loop.call_later(self.max_wait, self._flush, model)
+        self.inputs += len(texts)
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return results
+
+    def _flush(self, model):
+        timer = self._timers.pop(model, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(model, None)
+        if batch:
+            task = asyncio.ensure_future(self._send(model, batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, model, batch):
+        unique = list(dict.fromkeys(text for text, _ in batch))
+        self.batches += 1
+        self.sent += len(unique)
+        try:
+            vectors = dict(zip(unique, await self.run_batch(model, unique)))
+        except Exception as e:
+            logging.error(f"Embedding batch of {len(unique)} for {model} failed: {str(e)}")
+            self.failures += 1
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for text, future in batch:
+            # The caller may have gone away and cancelled its futures
+            if not future.done():
+                future.set_result(vectors[text])
+
+    async def aclose(self):
+        for timer in self._timers.values():
+            timer.cancel()
+        for task in list(self._tasks):
+            task.cancel()
+
+    def stats(self):
+        return {
+            "max_batch": self.max_batch,
+            "max_wait": self.max_wait,
+            "batches": self.batches,
+            "inputs": self.inputs,
+            "sent": self.sent,
+            "avg_batch": round(self.sent / self.batches, 2) if self.batches else 0.0,
+            "failures": self.failures,
+        }
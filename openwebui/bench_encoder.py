@@ -0,0 +1,88 @@
+"""
+Micro-benchmark for the NDJSON chunk path in proxy.py.
+
+Compares the original per-delta encoding (two datetime.utcnow() calls, a
+json.dumps of the nested dict, an f-string and an eagerly formatted debug
+message) with ChunkEncoder plus sampled debug logging.
+
+    python bench_encoder.py --deltas 200000
+"""
+import argparse
+import json
+import logging
+import time
+from datetime import datetime
+
+from encoder import DebugSampler, encoder_for
+
+MODEL = "Llama3Instruct70B"
+DELTAS = [" the", " quick", " brown", " fox", " said \"hi\"", "\n", " café", " 42."]
+
+
+def legacy_chunk(text):
+    created_at = datetime.utcnow().isoformat() + 'Z'
+    sse_data = json.dumps({
+        'model': f'Substrate:{MODEL}',
+        'created_at': created_at,
+        'message': {
+            'role': 'assistant',
+            'content': text
+        },
+        'done': False
+    })
+    logging.debug(f"Received event: {{'object': 'node.delta', 'data': {{'text': {text!r}}}}}")
+    logging.debug(f"Sending SSE data: {sse_data}")
+    return f"{sse_data}\n".encode('utf-8')
+
+
+def make_encoder_chunk(sample_every):
+    encoder = encoder_for(MODEL)
+    debug_sample = DebugSampler(sample_every)
+
+    def encoder_chunk(text):
+        chunk = encoder.delta(text)
+        if debug_sample():
+            logging.debug("Sending SSE data: %r", chunk)
+        return chunk
+
+    return encoder_chunk
+
+
+def run(fn, n):
+    deltas = DELTAS
+    count = len(deltas)
+    start = time.perf_counter()
+    for i in range(n):
+        fn(deltas[i % count])
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark NDJSON chunk encoding.")
+    parser.add_argument("--deltas", type=int, default=200000, help="Number of deltas to encode per run")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per variant, best is reported")
+    parser.add_argument("--sample-every", type=int, default=100, help="Debug sampling rate for the new path")
+    args = parser.parse_args()
+
+    for text in DELTAS:
+        assert json.loads(legacy_chunk(text))['message'] == json.loads(make_encoder_chunk(1)(text))['message']
+
+    # DEBUG on, as the proxy configures it, but discard the output
+    logging.basicConfig(level=logging.DEBUG, handlers=[logging.NullHandler()])
+
+    variants = [
+        ("legacy json.dumps", legacy_chunk),
+        ("ChunkEncoder", make_encoder_chunk(args.sample_every)),
+    ]
+    results = {}
+    for name, fn in variants:
+        best = min(run(fn, args.deltas) for _ in range(args.repeat))
+        results[name] = best
+        print(f"{name:20s} {best * 1e9 / args.deltas:8.0f} ns/delta  {args.deltas / best:12,.0f} deltas/s")
+
+    legacy, new = results["legacy json.dumps"], results["ChunkEncoder"]
+    print(f"speedup: {legacy / new:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+
+
+def normalize_prompt(prompt):
+    """Canonical form of a prompt for cache keys: unified newlines, no trailing whitespace."""
+    lines = prompt.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    return '\n'.join(line.rstrip() for line in lines).strip()
+
+
+def cache_key(model, prompt, temperature, max_tokens):
+    raw = json.dumps([model, normalize_prompt(prompt), temperature, max_tokens], separators=(',', ':'))
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class DiskTier:
+    """SQLite-backed second tier, shared by every process pointed at the same file."""
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=5.0, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, "
+            "expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)")
+        # Several workers may share the file; once serving, don't stall the event loop on a lock
+        self._db.execute("PRAGMA busy_timeout = 100")
+
+    def get(self, key, now):
+        """(value, expires_at) for a live entry, else None."""
+        row = self._db.execute(
+            "SELECT value, expires_at FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        value, expires_at = row
+        if expires_at <= now:
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            return None
+        self._db.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+        return value, expires_at
+
+    def put(self, key, value, expires_at, now):
+        self._db.execute(
+            "INSERT OR REPLACE INTO responses (key, value, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+            (key, value, len(value), expires_at, now),
+        )
+        self._evict(now)
+
+    def _evict(self, now):
+        self._db.execute("DELETE FROM responses WHERE expires_at <= ?", (now,))
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self._db.execute(
+            "SELECT key, size FROM responses ORDER BY accessed_at"
+        ).fetchall():
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def clear(self):
+        self._db.execute("DELETE FROM responses")
+
+    def close(self):
+        self._db.close()
+
+
+class ResponseCache:
+    """
+    Exact-match completion cache.
+
+    Entries live in an in-memory LRU bounded by total bytes, with an optional
+    SQLite tier behind it. Both tiers honour the same TTL; a disk hit is
+    promoted back into memory.
+    """
+
+    def __init__(self, ttl=3600, max_bytes=64 * 1024 * 1024, path=None, disk_max_bytes=512 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.disk = DiskTier(path, disk_max_bytes) if path else None
+        self._entries = OrderedDict()  # key -> (expires_at, value bytes)
+        self._bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.bypassed = 0
+
+    @classmethod
+    def from_config(cls, config):
+        if not config.get('cache_enabled', True):
+            return None
+        path = config.get('cache_path')
+        return cls(
+            ttl=config.get('cache_ttl', 3600),
+            max_bytes=config.get('cache_max_bytes', 64 * 1024 * 1024),
+            path=os.path.expanduser(path) if path else None,
+            disk_max_bytes=config.get('cache_disk_max_bytes', 512 * 1024 * 1024),
+        )
+
+    def get(self, key):
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return json.loads(value)
+            self._drop(key)
+
+        if self.disk is not None:
+            try:
+                stored = self.disk.get(key, now)
+            except sqlite3.Error as e:
+                logging.error(f"Response cache disk read failed: {str(e)}")
+                stored = None
+            if stored is not None:
+                value, expires_at = stored
+                # Keeps the stored expiry, so promotion doesn't extend the entry's life
+                self._remember(key, value, expires_at)
+                self.hits += 1
+                self.disk_hits += 1
+                return json.loads(value)
+
+        self.misses += 1
+        return None
+
+    def put(self, key, entry):
+        now = time.time()
+        value = json.dumps(entry, separators=(',', ':')).encode('utf-8')
+        expires_at = now + self.ttl
+        self._remember(key, value, expires_at)
+        if self.disk is not None:
+            try:
+                self.disk.put(key, value, expires_at, now)
+            except sqlite3.Error as e:
+                logging.error(f"Response cache disk write failed: {str(e)}")
+        self.stores += 1
+
+    def _remember(self, key, value, expires_at):
+        if len(value) > self.max_bytes:
+            return
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = (expires_at, value)
+        self._bytes += len(value)
+        while self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._drop(oldest)
+            self.evictions += 1
+
+    def _drop(self, key):
+        _, value = self._entries.pop(key)
+        self._bytes -= len(value)
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+        if self.disk is not None:
+            self.disk.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "bypassed": self.bypassed,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "disk": self.disk.path if self.disk is not None else None,
+        }
@@ -0,0 +1,41 @@
+import re
+
+# A sentence end (with any closing quote or bracket) plus the whitespace after it, or a line break
+_SENTENCE_END = re.compile(r'[.!?]["\')\]]*\s+|\n+')
+_WHITESPACE = re.compile(r'\s')
+
+
+def adaptive_chunks(text, first=24, largest=480, growth=2.0):
+    """
+    Split a finished completion into chunks for pseudo-streaming.
+
+    The first chunk is small so the client has something to render right
+    away; each following window is `growth` times larger, up to `largest`
+    characters, so long answers don't turn into hundreds of tiny writes.
+    Each chunk ends at the last sentence end in the second half of its
+    window, or failing that at the last whitespace. Words are never split;
+    a single word longer than the window becomes its own chunk.
+    """
+    chunks = []
+    pos = 0
+    size = max(1, first)
+    length = len(text)
+    while pos < length:
+        if length - pos <= size:
+            chunks.append(text[pos:])
+            break
+        end = pos + size
+        cut = None
+        for match in _SENTENCE_END.finditer(text, pos + size // 2, end):
+            cut = match.end()
+        if cut is None:
+            space = max(text.rfind(' ', pos + 1, end), text.rfind('\n', pos + 1, end))
+            if space > pos:
+                cut = space + 1
+        if cut is None:
+            match = _WHITESPACE.search(text, end)
+            cut = match.end() if match else length
+        chunks.append(text[pos:cut])
+        pos = cut
+        size = min(largest, int(size * growth))
+    return chunks
@@ -0,0 +1,263 @@
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+
+SUMMARY_PROMPT = (
+    "Summarize the conversation below for an assistant that will continue it. Keep names, facts, "
+    "decisions, code identifiers, open questions and anything the user asked to remember. "
+    "Write plain prose, at most {words} words. Return only the summary."
+)
+
+
+def format_message(message):
+    return f"{message['role'].capitalize()}: {message['content']}"
+
+
+def summary_line(summary):
+    return f"System: Summary of the earlier conversation: {summary}"
+
+
+def prefix_hashes(messages):
+    """One hash per message, each covering the conversation up to and including it."""
+    hashes = []
+    digest = b''
+    for message in messages:
+        h = hashlib.sha256(digest)
+        h.update(message['role'].encode('utf-8'))
+        h.update(b'\0')
+        h.update(str(message['content']).encode('utf-8', 'surrogatepass'))
+        digest = h.digest()
+        hashes.append(digest)
+    return hashes
+
+
+class PrefixTokenCache:
+    """
+    Token counts of conversation messages, keyed by conversation prefix hash.
+
+    Open WebUI resends the whole history on every turn; the earlier messages
+    hash to the same prefixes as last time, so only the new ones get tokenized.
+    """
+
+    def __init__(self, count_tokens, max_entries=100000):
+        self.count_tokens = count_tokens
+        self.max_entries = max_entries
+        self._counts = OrderedDict()  # prefix hash -> tokens in that message's prompt line
+        self.hits = 0
+        self.misses = 0
+
+    def counts(self, messages, hashes):
+        counts = []
+        for message, digest in zip(messages, hashes):
+            count = self._counts.get(digest)
+            if count is None:
+                count = self.count_tokens(format_message(message))
+                self._counts[digest] = count
+                self.misses += 1
+            else:
+                self._counts.move_to_end(digest)
+                self.hits += 1
+            counts.append(count)
+        while len(self._counts) > self.max_entries:
+            self._counts.popitem(last=False)
+        return counts
+
+    def clear(self):
+        self._counts.clear()
+
+
+class ConversationContext:
+    """
+    Fits a conversation into the model's context window.
+
+    The prompt budget is the model's window minus max_tokens and a reserve.
+    System messages and the latest message are always kept. If the rest
+    doesn't fit, the oldest turns are dropped ('truncate'), or replaced with a
+    summary of them ('summarize'). Summaries are made in the background by
+    `summarizer`, so the turn that first runs out of room is truncated and the
+    following ones use the summary. Each summary covers enough turns that
+    the next one is only needed after about `summary_keep_ratio` of the budget
+    has filled up again, and it extends the previous summary.
+    """
+
+    def __init__(self, count_tokens, windows=None, strategy='truncate', reserve=256, summary_model=None,
+                 summary_max_tokens=400, summary_keep_ratio=0.5, max_summaries=1000, max_entries=100000):
+        self.tokens = PrefixTokenCache(count_tokens, max_entries)
+        self.windows = windows or {}
+        self.window_overrides = {}
+        self.strategy = strategy
+        self.reserve = reserve
+        self.summary_model = summary_model
+        self.summary_max_tokens = summary_max_tokens
+        self.summary_keep_ratio = summary_keep_ratio
+        self.max_summaries = max_summaries
+        # Optional async callable(prompt, model, max_tokens) -> text, used for 'summarize'
+        self.summarizer = None
+        self._summaries = OrderedDict()  # prefix hash -> (summary text, tokens)
+        self._pending = {}
+        self.requests = 0
+        self.trimmed = 0
+        self.dropped_messages = 0
+        self.tokens_saved = 0
+        self.summaries_used = 0
+        self.summaries_made = 0
+        self.summaries_failed = 0
+
+    @classmethod
+    def from_config(cls, config, count_tokens, valid_models):
+        context = cls(
+            count_tokens,
+            strategy=config.get('context_strategy', 'truncate'),
+            reserve=config.get('context_reserve', 256),
+            summary_model=config.get('summary_model'),
+            summary_max_tokens=config.get('summary_max_tokens', 400),
+            summary_keep_ratio=config.get('summary_keep_ratio', 0.5),
+            max_summaries=config.get('summary_cache_entries', 1000),
+            max_entries=config.get('context_cache_entries', 100000),
+        )
+        context.window_overrides = config.get('context_windows') or {}
+        context.update_windows(valid_models)
+        return context
+
+    def update_windows(self, valid_models):
+        windows = {model: info['context'] for model, info in valid_models.items()}
+        windows.update(self.window_overrides)
+        self.windows = windows
+
+    def budget(self, model, max_tokens):
+        return max(0, self.windows.get(model, 8192) - max_tokens - self.reserve)
+
+    def build(self, model, messages, max_tokens):
+        """Return (prompt, prompt tokens) for the messages, trimmed to the model's budget."""
+        self.requests += 1
+        messages = [m for m in messages if 'content' in m]
+        hashes = prefix_hashes(messages)
+        counts = self.tokens.counts(messages, hashes)
+        total = sum(counts)
+        budget = self.budget(model, max_tokens)
+        if self.strategy == 'off' or total <= budget:
+            return '\n'.join(format_message(m) for m in messages), total
+
+        last = len(messages) - 1
+        fixed = sum(counts[i] for i, m in enumerate(messages) if m['role'] == 'system' or i == last)
+        # Index of the oldest non-system message kept, and the summary that stands in for those before it
+        start, summary, covered = 0, None, 0
+
+        if self.strategy == 'summarize':
+            # The most recent summary; turns after it are still dropped below if they don't fit
+            for end in range(last, 0, -1):
+                cached = self._summaries.get(hashes[end - 1])
+                if cached is not None:
+                    self._summaries.move_to_end(hashes[end - 1])
+                    start, summary, covered = end, cached, end
+                    break
+
+        used = fixed + (summary[1] if summary else 0)
+        used += sum(counts[i] for i in range(start, last) if messages[i]['role'] != 'system')
+        while used > budget and start < last:
+            if messages[start]['role'] != 'system':
+                used -= counts[start]
+                self.dropped_messages += 1
+            start += 1
+        if used > budget and summary is not None:
+            used -= summary[1]
+            summary = None
+        if summary is not None:
+            self.summaries_used += 1
+        if used > budget:
+            logging.warning(f"System prompt and latest message alone need {used} tokens, budget is {budget}")
+
+        # Turns were dropped that no summary covers yet
+        if self.strategy == 'summarize' and start > covered:
+            self._schedule_summary(model, messages, hashes, counts, budget - fixed)
+
+        lines = []
+        for i, message in enumerate(messages):
+            if message['role'] != 'system' and i < start:
+                continue
+            if summary is not None and i == start:
+                lines.append(summary_line(summary[0]))
+            lines.append(format_message(message))
+        self.trimmed += 1
+        self.tokens_saved += max(0, total - used)
+        return '\n'.join(lines), used
+
+    def _schedule_summary(self, model, messages, hashes, counts, room):
+        if self.summarizer is None:
+            return
+        last = len(messages) - 1
+        # Summarize far enough ahead that the next summary isn't needed for a while
+        cut, kept = last, 0
+        while cut > 1:
+            if messages[cut - 1]['role'] != 'system':
+                if kept + counts[cut - 1] > room * self.summary_keep_ratio:
+                    break
+                kept += counts[cut - 1]
+            cut -= 1
+        key = hashes[cut - 1]
+        if key in self._summaries or key in self._pending:
+            return
+
+        # Extend the latest earlier summary instead of starting over
+        base, begin = None, 0
+        for end in range(cut - 1, 0, -1):
+            if hashes[end - 1] in self._summaries:
+                base, begin = self._summaries[hashes[end - 1]], end
+                break
+
+        summary_model = self.summary_model or model
+        room = self.budget(summary_model, self.summary_max_tokens) - (base[1] if base else 0) - 100
+        lines = []
+        for i in range(cut - 1, begin - 1, -1):
+            if messages[i]['role'] == 'system':
+                continue
+            if counts[i] > room:
+                break
+            room -= counts[i]
+            lines.append(format_message(messages[i]))
+        if not lines:
+            return
+        lines.reverse()
+
+        prompt = SUMMARY_PROMPT.format(words=int(self.summary_max_tokens * 0.6))
+        if base is not None:
+            prompt += f"\n\nSUMMARY SO FAR:\n{base[0]}"
+        prompt += "\n\nCONVERSATION:\n" + '\n'.join(lines)
+        self._pending[key] = asyncio.ensure_future(self._summarize(key, prompt, summary_model))
+
+    async def _summarize(self, key, prompt, model):
+        try:
+            text = (await self.summarizer(prompt, model, self.summary_max_tokens)).strip()
+            self._summaries[key] = (text, self.tokens.count_tokens(summary_line(text)))
+            while len(self._summaries) > self.max_summaries:
+                self._summaries.popitem(last=False)
+            self.summaries_made += 1
+        except Exception as e:
+            logging.error(f"Conversation summary failed: {str(e)}")
+            self.summaries_failed += 1
+        finally:
+            self._pending.pop(key, None)
+
+    async def aclose(self):
+        for task in list(self._pending.values()):
+            task.cancel()
+
+    def stats(self):
+        lookups = self.tokens.hits + self.tokens.misses
+        return {
+            "strategy": self.strategy,
+            "requests": self.requests,
+            "trimmed": self.trimmed,
+            "dropped_messages": self.dropped_messages,
+            "tokens_saved": self.tokens_saved,
+            "token_cache_hits": self.tokens.hits,
+            "token_cache_misses": self.tokens.misses,
+            "token_cache_hit_ratio": round(self.tokens.hits / lookups, 4) if lookups else 0.0,
+            "token_cache_entries": len(self.tokens._counts),
+            "summaries": len(self._summaries),
+            "summaries_pending": len(self._pending),
+            "summaries_made": self.summaries_made,
+            "summaries_used": self.summaries_used,
+            "summaries_failed": self.summaries_failed,
+        }
@@ -0,0 +1,183 @@
+import base64
+import json
+import logging
+import sys
+import time
+import uuid
+from array import array
+from datetime import datetime, timezone
+from functools import lru_cache
+from json.encoder import encode_basestring_ascii
+
+
+class MillisecondClock:
+    """UTC ISO-8601 timestamps as bytes, formatted at most once per millisecond."""
+
+    def __init__(self):
+        self._ms = -1
+        self._stamp = b''
+
+    def now(self):
+        ms = time.time_ns() // 1_000_000
+        if ms != self._ms:
+            self._ms = ms
+            moment = datetime.fromtimestamp(ms / 1000, tz=timezone.utc)
+            self._stamp = moment.strftime('%Y-%m-%dT%H:%M:%S').encode('ascii') + b'.%03dZ' % (ms % 1000)
+        return self._stamp
+
+
+clock = MillisecondClock()
+
+
+class ChunkEncoder:
+    """
+    Ollama chat chunks as NDJSON bytes.
+
+    Everything except the timestamp and the delta text is fixed per model, so
+    it's rendered once into byte templates and each chunk is a single join.
+    Only the delta text goes through the JSON string escaper.
+    """
+
+    mimetype = 'application/x-ndjson'
+
+    def __init__(self, model):
+        self.model = f"Substrate:{model}"
+        self._head = b'{"model":' + json.dumps(self.model).encode('utf-8') + b',"created_at":"'
+        self._content = b'","message":{"role":"assistant","content":'
+        self._tail = b'},"done":false}\n'
+
+    def delta(self, text):
+        return b''.join((self._head, clock.now(), self._content, encode_basestring_ascii(text).encode('ascii'), self._tail))
+
+    def heartbeat(self):
+        # An empty delta is the only thing an Ollama client is guaranteed to ignore
+        return self.delta('')
+
+    def error(self, message):
+        return json.dumps({'error': message}).encode('utf-8') + b'\n'
+
+    @staticmethod
+    def error_body(message, error_type):
+        return {'error': message}
+
+    @classmethod
+    def for_model(cls, model):
+        return encoder_for(model)
+
+    def done(self, **fields):
+        # Sent once per response, so plain json.dumps is fine here
+        return json.dumps({
+            'model': self.model,
+            'created_at': clock.now().decode('ascii'),
+            'message': {
+                'role': 'assistant',
+                'content': ''
+            },
+            'done_reason': 'stop',
+            'done': True,
+            **fields,
+        }).encode('utf-8') + b'\n'
+
+
+@lru_cache(maxsize=64)
+def encoder_for(model):
+    return ChunkEncoder(model)
+
+
+class OpenAIChunkEncoder:
+    """
+    OpenAI chat.completion.chunk server-sent events, ending with `data: [DONE]`.
+
+    The id and creation time belong to one response, so unlike ChunkEncoder
+    this is made per request; the byte templates are still rendered once.
+    """
+
+    mimetype = 'text/event-stream'
+
+    def __init__(self, model, include_usage=False):
+        self.model = model
+        self.id = f"chatcmpl-{uuid.uuid4().hex}"
+        self.created = int(time.time())
+        self.include_usage = include_usage
+        self._started = False
+        prefix = json.dumps({'id': self.id, 'object': 'chat.completion.chunk', 'created': self.created,
+                             'model': model}, separators=(',', ':'))[:-1]
+        self._head = b'data: ' + prefix.encode('utf-8') + b',"choices":[{"index":0,"delta":{'
+        self._tail = b'},"finish_reason":null}]}\n\n'
+
+    @classmethod
+    def for_model(cls, model, include_usage=False):
+        return cls(model, include_usage)
+
+    def _chunk(self, choices, **extra):
+        chunk = {'id': self.id, 'object': 'chat.completion.chunk', 'created': self.created, 'model': self.model,
+                 'choices': choices, **extra}
+        return b'data: ' + json.dumps(chunk, separators=(',', ':')).encode('utf-8') + b'\n\n'
+
+    def delta(self, text):
+        content = b'"content":' + encode_basestring_ascii(text).encode('ascii')
+        if not self._started:
+            # The role is only sent with the first chunk
+            self._started = True
+            content = b'"role":"assistant",' + content
+        return b''.join((self._head, content, self._tail))
+
+    def heartbeat(self):
+        # SSE comment line, ignored by every client
+        return b': keep-alive\n\n'
+
+    def error(self, message):
+        return b'data: ' + json.dumps(self.error_body(message, 'upstream_error')).encode('utf-8') + b'\n\n'
+
+    @staticmethod
+    def error_body(message, error_type):
+        return {'error': {'message': message, 'type': error_type, 'code': None}}
+
+    @staticmethod
+    def usage(fields):
+        prompt_tokens = fields.get('prompt_eval_count') or 0
+        completion_tokens = fields.get('eval_count') or 0
+        return {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens + completion_tokens}
+
+    def done(self, **fields):
+        body = self._chunk([{'index': 0, 'delta': {}, 'finish_reason': 'stop'}])
+        if self.include_usage:
+            body += self._chunk([], usage=self.usage(fields))
+        return body + b'data: [DONE]\n\n'
+
+    def completion(self, text, **fields):
+        """A whole chat.completion object, for requests with stream=false."""
+        return json.dumps({
+            'id': self.id,
+            'object': 'chat.completion',
+            'created': self.created,
+            'model': self.model,
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}],
+            'usage': self.usage(fields),
+        }).encode('utf-8')
+
+
+def encode_embedding(vector, encoding_format='float'):
+    if encoding_format == 'base64':
+        # Little-endian float32, as the OpenAI client libraries decode it
+        packed = array('f', vector)
+        if sys.byteorder == 'big':
+            packed.byteswap()
+        return base64.b64encode(packed.tobytes()).decode('ascii')
+    return vector
+
+
+class DebugSampler:
+    """Decides whether a per-event debug message is worth formatting: DEBUG must be on, then one in `every` gets through."""
+
+    def __init__(self, every=100, logger=None):
+        self.every = max(1, every)
+        self.logger = logger or logging.getLogger()
+        self._count = 0
+
+    def __call__(self):
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return False
+        self._count += 1
+        return self._count % self.every == 1 or self.every == 1
@@ -0,0 +1,293 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+import httpx
+import httpx_sse
+from substrate import Substrate
+from substrate._client import APIResponse
+from substrate.streaming import SubstrateStreamingResponse
+from substrate.substrate_response import SubstrateResponse
+
+
+class QueueFullError(Exception):
+    """Raised when a request can't be admitted because the wait queue is full."""
+
+    def __init__(self, model, depth, status_code=429):
+        super().__init__(f"Upstream queue full for {model} ({depth} waiting)")
+        self.model = model
+        self.depth = depth
+        self.status_code = status_code
+
+
+class UpstreamStatusError(Exception):
+    """Substrate answered with an error status instead of a result or an event stream."""
+
+    def __init__(self, model, status_code, message):
+        super().__init__(f"Substrate returned {status_code} for {model}: {message}")
+        self.model = model
+        self.status_code = status_code
+
+
+def error_message(response):
+    try:
+        error = response.json().get('error')
+        return error.get('message') if isinstance(error, dict) else str(error)
+    except (ValueError, AttributeError):
+        return response.text[:200]
+
+
+class Reservation:
+    """
+    A place held for one request by UpstreamEngine.admit(). The first slot
+    opened with it takes the place over; release() gives it back if that
+    never happened (the client went away, or the call was never started).
+    """
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.held = True
+
+    def take(self):
+        held, self.held = self.held, False
+        return held
+
+    def release(self):
+        if self.take():
+            self.limiter.reserved -= 1
+
+
+class ModelLimiter:
+    """Per-model concurrency limit with a bounded waiting queue."""
+
+    def __init__(self, model, max_concurrency, max_queue):
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.active = 0
+        self.waiting = 0
+        self.reserved = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.recent_waits = deque(maxlen=256)
+
+    def is_full(self):
+        return self.active + self.reserved >= self.max_concurrency and self.queue_depth() >= self.max_queue
+
+    def queue_depth(self):
+        # Reserved requests have been admitted by the route but not started yet.
+        return self.waiting + max(0, self.active + self.reserved - self.max_concurrency)
+
+    def reserve(self):
+        if self.is_full():
+            self.rejected += 1
+            raise QueueFullError(self.model, self.queue_depth())
+        self.reserved += 1
+        return Reservation(self)
+
+    @asynccontextmanager
+    async def slot(self, reservation=None):
+        if reservation is not None and reservation.limiter is self and reservation.take():
+            self.reserved -= 1
+        elif self.is_full():
+            self.rejected += 1
+            raise QueueFullError(self.model, self.queue_depth())
+
+        self.waiting += 1
+        start = time.monotonic()
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        waited = time.monotonic() - start
+        self.admitted += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        self.recent_waits.append(waited)
+
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self._semaphore.release()
+
+    def stats(self):
+        recent = sorted(self.recent_waits)
+        p95 = recent[min(len(recent) - 1, int(len(recent) * 0.95))] if recent else 0.0
+        return {
+            "active": self.active,
+            "queue_depth": self.queue_depth(),
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "wait_avg_ms": round(self.total_wait / self.admitted * 1000, 3) if self.admitted else 0.0,
+            "wait_p95_ms": round(p95 * 1000, 3),
+            "wait_max_ms": round(self.max_wait * 1000, 3),
+        }
+
+
+class UpstreamEngine:
+    """
+    Shared upstream for the proxy.
+
+    Every call goes through one pooled keep-alive httpx.AsyncClient instead of
+    the per-call clients the Substrate SDK opens, and is admitted through a
+    per-model ModelLimiter. Requests are serialized and decoded with the SDK's
+    own types so callers get back the usual SubstrateResponse and
+    SubstrateStreamingResponse objects.
+    """
+
+    def __init__(
+        self,
+        api_key,
+        base_url="https://api.substrate.run",
+        timeout=60 * 5,
+        max_connections=64,
+        max_keepalive_connections=32,
+        keepalive_expiry=30.0,
+        model_concurrency=8,
+        model_queue=32,
+        max_backlog=256,
+        model_limits=None,
+    ):
+        self.substrate = Substrate(api_key=api_key, base_url=base_url, timeout=timeout)
+        self.url = f"{base_url}/compose"
+        self.timeout = timeout
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.model_concurrency = model_concurrency
+        self.model_queue = model_queue
+        self.max_backlog = max_backlog
+        self.model_limits = model_limits or {}
+        self._limiters = {}
+        self._client = None
+        # Optional callable(model, seconds) told how long each upstream call took to answer
+        self.observer = None
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            api_key=config['api_key'],
+            base_url=config.get('base_url', "https://api.substrate.run"),
+            timeout=config.get('timeout', 60 * 5),
+            max_connections=config.get('max_connections', 64),
+            max_keepalive_connections=config.get('max_keepalive_connections', 32),
+            keepalive_expiry=config.get('keepalive_expiry', 30.0),
+            model_concurrency=config.get('model_concurrency', 8),
+            model_queue=config.get('model_queue', 32),
+            max_backlog=config.get('max_backlog', 256),
+            model_limits=config.get('model_limits'),
+        )
+
+    @property
+    def client(self):
+        # Created lazily so the pool binds to the serving event loop.
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                limits=self.limits,
+                timeout=httpx.Timeout(self.timeout, connect=10.0),
+                follow_redirects=True,
+            )
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def limiter(self, model):
+        limiter = self._limiters.get(model)
+        if limiter is None:
+            overrides = self.model_limits.get(model, {})
+            limiter = ModelLimiter(
+                model,
+                overrides.get('concurrency', self.model_concurrency),
+                overrides.get('queue', self.model_queue),
+            )
+            self._limiters[model] = limiter
+        return limiter
+
+    def backlog(self):
+        return sum(limiter.queue_depth() for limiter in self._limiters.values())
+
+    def admit(self, model):
+        """
+        Reserve a place for a request before its response is started, so a
+        full queue fails fast with 429 (model queue full) or 503 (proxy
+        saturated). Pass the Reservation to run/stream(..., reservation=...),
+        and release() it once the request is over in case they never ran.
+        """
+        limiter = self.limiter(model)
+        if self.backlog() >= self.max_backlog:
+            limiter.rejected += 1
+            raise QueueFullError(model, self.backlog(), status_code=503)
+        return limiter.reserve()
+
+    async def run(self, model, *nodes, reservation=None):
+        body = {"dag": Substrate.serialize(*nodes)}
+        async with self.limiter(model).slot(reservation):
+            start = time.perf_counter()
+            http_response = await self.client.post(
+                self.url, headers=self.substrate._client.default_headers, json=body
+            )
+            if self.observer is not None:
+                self.observer(model, time.perf_counter() - start)
+        if http_response.status_code >= 400:
+            raise UpstreamStatusError(model, http_response.status_code, error_message(http_response))
+        _json = None
+        try:
+            _json = http_response.json()
+        except Exception as e:
+            logging.debug(f"Could not read JSON from upstream response: {str(e)}")
+        return SubstrateResponse(api_response=APIResponse(
+            status_code=http_response.status_code,
+            json=_json,
+            headers=http_response.headers,
+            request=body,
+        ))
+
+    def stream(self, model, *nodes, reservation=None):
+        body = {"dag": Substrate.serialize(*nodes)}
+        headers = self.substrate._client.streaming_headers
+
+        async def iterator():
+            # The model slot is held for the life of the stream.
+            async with self.limiter(model).slot(reservation):
+                start = time.perf_counter()
+                async with httpx_sse.aconnect_sse(
+                    self.client, "POST", self.url, json=body, headers=headers
+                ) as event_source:
+                    if self.observer is not None:
+                        self.observer(model, time.perf_counter() - start)
+                    response = event_source.response
+                    if response.status_code >= 400:
+                        await response.aread()
+                        raise UpstreamStatusError(model, response.status_code, error_message(response))
+                    async for sse in event_source.aiter_sse():
+                        yield sse
+
+        return SubstrateStreamingResponse(iterator=iterator())
+
+    def stats(self):
+        pool = self.limits
+        return {
+            "pool": {
+                "max_connections": pool.max_connections,
+                "max_keepalive_connections": pool.max_keepalive_connections,
+                "keepalive_expiry": pool.keepalive_expiry,
+            },
+            "backlog": self.backlog(),
+            "max_backlog": self.max_backlog,
+            "models": {model: limiter.stats() for model, limiter in self._limiters.items()},
+        }
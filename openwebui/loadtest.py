@@ -0,0 +1,148 @@
+"""
+Throughput of the proxy at different worker counts.
+
+Starts the fake Substrate upstream (../fakesubstrate), then for each worker
+count launches serve.py against it and drives concurrent /api/chat streams for
+a fixed time. No API key or network access is needed.
+
+    python loadtest.py --workers 1 2 4 --concurrency 64 --duration 10
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(HERE)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def wait_for(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+async def drive(base_url, concurrency, duration, model):
+    latencies = []
+    errors = 0
+    deadline = time.monotonic() + duration
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        async def user(n):
+            nonlocal errors
+            i = 0
+            while time.monotonic() < deadline:
+                i += 1
+                payload = {
+                    "model": model,
+                    "messages": [{"role": "user", "content": f"load test {n}-{i}"}],
+                    "stream": True,
+                }
+                start = time.perf_counter()
+                try:
+                    async with client.stream('POST', '/api/chat', json=payload) as response:
+                        async for _ in response.aiter_bytes():
+                            pass
+                    if response.status_code == 200:
+                        latencies.append(time.perf_counter() - start)
+                    else:
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(user(n) for n in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    return latencies, errors, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure proxy throughput across worker counts.")
+    parser.add_argument("--workers", type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--profile", default="fast", help="Fake upstream latency profile (default: fast)")
+    parser.add_argument("--reply-tokens", type=int, default=20, help="Typical upstream reply length")
+    parser.add_argument("--model", default="Llama3Instruct8B")
+    args = parser.parse_args()
+
+    upstream_port = free_port()
+    upstream = subprocess.Popen(
+        [sys.executable, '-m', 'fakesubstrate', '--port', str(upstream_port),
+         '--profile', args.profile, '--reply-tokens', str(args.reply_tokens)],
+        cwd=REPO)
+    asyncio.run(wait_for(f'http://127.0.0.1:{upstream_port}/health'))
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        config_file = os.path.join(tmp, 'config.json')
+        with open(config_file, 'w') as f:
+            # Every request must reach the upstream, so no cache and no coalescing
+            json.dump({
+                'cache_enabled': False,
+                'coalesce_requests': False,
+                'model_concurrency': args.concurrency,
+                'model_queue': args.concurrency * 4,
+                'max_backlog': args.concurrency * 8,
+            }, f)
+        env = dict(os.environ,
+                   SUBSTRATE_PROXY_CONFIG=config_file,
+                   SUBSTRATE_API_KEY='loadtest',
+                   SUBSTRATE_BASE_URL=f'http://127.0.0.1:{upstream_port}')
+
+        for workers in args.workers:
+            port = free_port()
+            proxy = subprocess.Popen(
+                [sys.executable, os.path.join(HERE, 'serve.py'), '--workers', str(workers),
+                 '--bind', f'127.0.0.1:{port}', '--log-level', 'warning', '--graceful-timeout', '5'],
+                env=env)
+            try:
+                base_url = f'http://127.0.0.1:{port}'
+                asyncio.run(wait_for(f'{base_url}/api/version'))
+                latencies, errors, elapsed = asyncio.run(
+                    drive(base_url, args.concurrency, args.duration, args.model))
+            finally:
+                proxy.terminate()
+                proxy.wait(timeout=30)
+
+            latencies.sort()
+            rps = len(latencies) / elapsed
+            p50 = statistics.median(latencies) if latencies else 0.0
+            p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else 0.0
+            results.append((workers, len(latencies), errors, rps, p50, p95))
+            print(f"workers={workers}: {len(latencies)} ok, {errors} errors, {rps:.1f} req/s, "
+                  f"p50 {p50 * 1000:.0f}ms, p95 {p95 * 1000:.0f}ms", flush=True)
+
+    upstream.terminate()
+    upstream.wait()
+
+    print()
+    print(f"{'workers':>8} {'req/s':>10} {'p50 ms':>8} {'p95 ms':>8} {'errors':>7}")
+    for workers, _, errors, rps, p50, p95 in results:
+        print(f"{workers:>8} {rps:>10.1f} {p50 * 1000:>8.0f} {p95 * 1000:>8.0f} {errors:>7}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+import json
+import os
+import time
+from bisect import bisect_left
+
+
+# Bucket upper bounds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+GAP_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+COUNT_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 128000)
+
+
+class Counter:
+    """Monotonic counter keyed by a tuple of label values."""
+
+    type = 'counter'
+
+    def __init__(self, name, help, labelnames=('model',)):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def inc(self, labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in self._values.items():
+            yield self.name, dict(zip(self.labelnames, labels)), value
+
+    def dump(self):
+        return [[list(labels), value] for labels, value in self._values.items()]
+
+    def merge(self, state):
+        for labels, value in state:
+            self.inc(tuple(labels), value)
+
+    def empty_copy(self):
+        return type(self)(self.name, self.help, self.labelnames)
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def dec(self, labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) - amount
+
+    def set(self, labels, value):
+        self._values[labels] = value
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram with one series per model.
+
+    Observations are a bisect and two additions on plain lists; everything
+    runs on the event loop, so no locking is needed.
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._series = {}  # model -> [bucket counts..., +Inf count], [sum, count]
+
+    def observe(self, model, value):
+        series = self._series.get(model)
+        if series is None:
+            series = self._series[model] = ([0] * (len(self.buckets) + 1), [0.0, 0])
+        counts, totals = series
+        counts[bisect_left(self.buckets, value)] += 1
+        totals[0] += value
+        totals[1] += 1
+
+    def snapshot(self):
+        out = {}
+        for model, (counts, totals) in self._series.items():
+            cumulative, running = [], 0
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                running += n
+                cumulative.append((bound, running))
+            out[model] = {"buckets": cumulative, "sum": totals[0], "count": totals[1]}
+        return out
+
+    def dump(self):
+        return {model: [counts, totals] for model, (counts, totals) in self._series.items()}
+
+    def merge(self, state):
+        for model, (counts, totals) in state.items():
+            series = self._series.get(model)
+            if series is None:
+                series = self._series[model] = ([0] * (len(self.buckets) + 1), [0.0, 0])
+            for i, n in enumerate(counts):
+                series[0][i] += n
+            series[1][0] += totals[0]
+            series[1][1] += totals[1]
+
+    def empty_copy(self):
+        return Histogram(self.name, self.help, self.buckets)
+
+    def samples(self):
+        for model, series in self.snapshot().items():
+            for bound, count in series["buckets"]:
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                yield f"{self.name}_bucket", {'model': model, 'le': le}, count
+            yield f"{self.name}_sum", {'model': model}, series["sum"]
+            yield f"{self.name}_count", {'model': model}, series["count"]
+
+
+class UsageMetrics:
+    """Per-model response timing and token histograms."""
+
+    def __init__(self):
+        self.time_to_first_delta = Histogram(
+            "substrate_proxy_time_to_first_delta_seconds", "Time from request to first upstream delta.", LATENCY_BUCKETS)
+        self.inter_delta = Histogram(
+            "substrate_proxy_inter_delta_seconds", "Time between consecutive upstream deltas.", GAP_BUCKETS)
+        self.deltas = Histogram(
+            "substrate_proxy_deltas_per_response", "Number of deltas per streamed response.", COUNT_BUCKETS)
+        self.prompt_tokens = Histogram(
+            "substrate_proxy_prompt_tokens", "Estimated prompt tokens per request.", COUNT_BUCKETS)
+        self.completion_tokens = Histogram(
+            "substrate_proxy_completion_tokens", "Estimated completion tokens per response.", COUNT_BUCKETS)
+
+    def histograms(self):
+        return [self.time_to_first_delta, self.inter_delta, self.deltas, self.prompt_tokens, self.completion_tokens]
+
+    def snapshot(self):
+        return {h.name: h.snapshot() for h in self.histograms()}
+
+
+class ResponseUsage:
+    """
+    Timing and token accounting for one response.
+
+    Call delta() for each chunk of text as it arrives and finish() at the end
+    to get the Ollama duration and count fields. When metrics are given, the
+    inter-delta gaps and totals are recorded into its histograms too.
+    """
+
+    def __init__(self, model, prompt_tokens, count_tokens, metrics=None):
+        self.model = model
+        self.prompt_tokens = prompt_tokens
+        self.count_tokens = count_tokens
+        self.metrics = metrics
+        self.start = time.perf_counter_ns()
+        self.first_delta = None
+        self.last_delta = None
+        self.delta_count = 0
+        self.completion_tokens = None
+        self._parts = []
+
+    def delta(self, text):
+        now = time.perf_counter_ns()
+        if self.first_delta is None:
+            self.first_delta = now
+        elif self.metrics is not None:
+            self.metrics.inter_delta.observe(self.model, (now - self.last_delta) / 1e9)
+        self.last_delta = now
+        self.delta_count += 1
+        self._parts.append(text)
+
+    def finish(self, total_duration=None):
+        end = time.perf_counter_ns()
+        completion_tokens = self.completion_tokens = self.count_tokens(''.join(self._parts))
+        first = self.first_delta or end
+        last = self.last_delta or end
+        fields = {
+            'total_duration': total_duration if total_duration is not None else end - self.start,
+            'load_duration': 0,  # Models are hosted by Substrate, nothing is loaded here
+            'prompt_eval_count': self.prompt_tokens,
+            'prompt_eval_duration': first - self.start,
+            'eval_count': completion_tokens,
+            'eval_duration': last - first,
+        }
+        if self.metrics is not None:
+            m = self.metrics
+            if self.first_delta is not None:
+                m.time_to_first_delta.observe(self.model, (self.first_delta - self.start) / 1e9)
+            m.deltas.observe(self.model, self.delta_count)
+            m.prompt_tokens.observe(self.model, self.prompt_tokens)
+            m.completion_tokens.observe(self.model, completion_tokens)
+        return fields
+
+
+class ProxyMetrics:
+    """Request-level series for the /metrics endpoint, plus the usage histograms."""
+
+    def __init__(self, usage):
+        self.usage = usage
+        self.requests = Counter(
+            "substrate_proxy_requests_total", "Chat requests by model, stream flag and where the answer came from.",
+            ("model", "stream", "source"))
+        self.errors = Counter(
+            "substrate_proxy_errors_total", "Failed chat requests by model and error type.", ("model", "type"))
+        self.active_streams = Gauge(
+            "substrate_proxy_active_streams", "Responses currently being written.")
+        self.time_to_first_byte = Histogram(
+            "substrate_proxy_time_to_first_byte_seconds", "Time from request to the first response byte.", LATENCY_BUCKETS)
+        self.duration = Histogram(
+            "substrate_proxy_request_duration_seconds", "Time from request to the last response byte.", LATENCY_BUCKETS)
+        self.bytes_streamed = Counter(
+            "substrate_proxy_bytes_streamed_total", "Response body bytes written.")
+        self.upstream_latency = Histogram(
+            "substrate_proxy_upstream_latency_seconds",
+            "Time for Substrate to answer: full body for runs, response headers for streams.", LATENCY_BUCKETS)
+        self.queue_depth = Gauge(
+            "substrate_proxy_upstream_queue_depth", "Requests waiting for an upstream slot.")
+        self.upstream_active = Gauge(
+            "substrate_proxy_upstream_active", "Upstream calls in progress.")
+
+    def refresh_engine(self, engine):
+        # Queue state is read from the engine when needed rather than tracked on the hot path
+        for model, stats in engine.stats()['models'].items():
+            self.queue_depth.set((model,), stats['queue_depth'])
+            self.upstream_active.set((model,), stats['active'])
+
+    def collect(self):
+        return [
+            self.requests, self.errors, self.active_streams, self.time_to_first_byte,
+            self.duration, self.bytes_streamed, self.upstream_latency, self.queue_depth,
+            self.upstream_active,
+        ] + self.usage.histograms()
+
+
+class WorkerMetricsStore:
+    """
+    Shares metric state between worker processes.
+
+    Each worker periodically writes its own series to <directory>/<pid>.json
+    and the worker that answers a scrape merges every file: counters and
+    histograms are summed, and so are gauges, since each worker reports only
+    its own share. A stopping worker writes its gauges as zero, so its
+    counters stay in the totals after it exits.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"{os.getpid()}.json")
+
+    def write(self, metrics):
+        state = {metric.name: metric.dump() for metric in metrics}
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, self.path)
+
+    def retire(self, metrics):
+        state = {}
+        for metric in metrics:
+            if metric.type == 'gauge':
+                metric = metric.empty_copy()
+            state[metric.name] = metric.dump()
+        with open(self.path, 'w') as f:
+            json.dump(state, f)
+
+    def aggregate(self, metrics):
+        """Return merged copies of `metrics` across every worker's file."""
+        merged = [metric.empty_copy() for metric in metrics]
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                # A worker may be mid-write; its next flush will be picked up
+                continue
+            for metric in merged:
+                if metric.name in state:
+                    metric.merge(state[metric.name])
+        return merged
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_prometheus(metrics):
+    """Render metrics in the Prometheus text exposition format (version 0.0.4)."""
+    lines = []
+    for metric in metrics:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for name, labels, value in metric.samples():
+            if labels:
+                rendered = ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+                lines.append(f"{name}{{{rendered}}} {value}")
+            else:
+                lines.append(f"{name} {value}")
+    return '\n'.join(lines) + '\n'
@@ -1,40 +1,36 @@
 import os
 import json
+import asyncio
 import logging
-import time
-from datetime import datetime
 from quart import Quart, request, jsonify, Response
 from quart.helpers import stream_with_context
-from substrate import Substrate, ComputeText
+from substrate import ComputeText, MultiEmbedText
+from engine import UpstreamEngine, QueueFullError, UpstreamStatusError
+from cache import ResponseCache, cache_key
+from tee import replay_deltas
+from singleflight import SingleFlight
+from encoder import DebugSampler, ChunkEncoder, OpenAIChunkEncoder, encode_embedding
+from chunker import adaptive_chunks
+from batcher import EmbeddingBatcher
+from context import ConversationContext
+from registry import ModelRegistry
+from resilience import UpstreamPolicies, CircuitOpenError, FirstDeltaTimeout
+from metrics import UsageMetrics, ResponseUsage, ProxyMetrics, WorkerMetricsStore, render_prometheus
+from tokens import count_tokens
+from tracing import Span, SpanLog, new_request_id, request_id_var, install_request_id_logging
+from settings import load_or_create_config
 
 # Set up logging
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+logging.basicConfig(
+    level=os.environ.get('SUBSTRATE_PROXY_LOG_LEVEL', 'DEBUG').upper(),
+    format='%(asctime)s - %(levelname)s - [%(request_id)s] %(message)s'
+)
+install_request_id_logging()
 
 app = Quart(__name__)
 
-CONFIG_DIR = os.path.expanduser('~/.config/substrate-chat')
-CONFIG_FILE = os.path.join(CONFIG_DIR, 'config.json')
-
-def load_or_create_config():
-    try:
-        if os.path.exists(CONFIG_FILE):
-            with open(CONFIG_FILE, 'r') as f:
-                config = json.load(f)
-            logging.info(f"Config loaded from {CONFIG_FILE}")
-            return config
-        else:
-            api_key = input("Please enter your Substrate API key: ")
-            config = {'api_key': api_key}
-            os.makedirs(CONFIG_DIR, exist_ok=True)
-            with open(CONFIG_FILE, 'w') as f:
-                json.dump(config, f)
-            logging.info(f"Config file created at {CONFIG_FILE}")
-            return config
-    except Exception as e:
-        logging.error(f"Error loading or creating config: {str(e)}")
-        return None
-
-config = load_or_create_config()
+# Only ask for a key on the terminal when run directly; ASGI workers read env/file
+config = load_or_create_config(interactive=__name__ == '__main__')
 if not config:
     logging.error("Failed to load or create config. Exiting.")
     exit(1)
@@ -44,276 +40,768 @@ if not api_key:
     logging.error("API key not found in config. Exiting.")
     exit(1)
 
-substrate = Substrate(api_key=api_key, timeout=60 * 5)
+# Shared pooled upstream: keep-alive connections plus per-model concurrency limits
+engine = UpstreamEngine.from_config(config)
+
+# Exact-match completion cache (None when disabled in config)
+response_cache = ResponseCache.from_config(config)
+# Seconds between replayed deltas on a streaming cache hit (0 sends them back to back)
+replay_delay = config.get('cache_replay_delay', 0.0)
+# Identical in-flight requests share one upstream call
+coalesce_requests = config.get('coalesce_requests', True)
+flights = SingleFlight()
+# How completions from models that can't stream are sent: 'adaptive' sends
+# heartbeats while waiting, then growing word/sentence-aligned chunks;
+# 'burst' sends the whole answer in one write. X-Stream-Mode overrides it.
+non_stream_mode = config.get('non_stream_mode', 'adaptive')
+heartbeat_interval = config.get('heartbeat_interval', 5.0)
+chunk_first_chars = config.get('chunk_first_chars', 24)
+chunk_max_chars = config.get('chunk_max_chars', 480)
+# Per-event debug logging is sampled so DEBUG doesn't dominate the streaming path
+debug_sample = DebugSampler(config.get('debug_sample_every', 100))
+# Timing and token histograms per model
+usage_metrics = UsageMetrics()
+# Request counters and latency histograms for /metrics
+proxy_metrics = ProxyMetrics(usage_metrics)
+engine.observer = proxy_metrics.upstream_latency.observe
+# Per-model retries, hedging and circuit breakers around upstream calls
+upstream_policies = UpstreamPolicies.from_config(config)
+# Optional JSON-lines log of every finished request
+span_log = SpanLog(os.path.expanduser(config['span_log'])) if config.get('span_log') else None
+# With several workers, metrics are merged across processes through this directory
+metrics_dir = os.environ.get('SUBSTRATE_PROXY_METRICS_DIR', config.get('metrics_dir'))
+metrics_store = WorkerMetricsStore(os.path.expanduser(metrics_dir)) if metrics_dir else None
+metrics_flush_interval = config.get('metrics_flush_interval', 5.0)
+metrics_flush_task = None
+# Embedding models /v1/embeddings accepts, and the one used when a request names none
+EMBEDDING_MODELS = ('jina-v2', 'clip')
+embedding_model = config.get('embedding_model', 'jina-v2')
+
+@app.before_request
+async def assign_request_id():
+    new_request_id(request.headers.get('X-Request-Id'))
+
+@app.after_request
+async def add_request_id(response):
+    response.headers['X-Request-Id'] = request_id_var.get()
+    return response
+
+def collect_metrics():
+    return proxy_metrics.collect() + upstream_policies.collect()
+
+async def flush_metrics():
+    while True:
+        await asyncio.sleep(metrics_flush_interval)
+        try:
+            proxy_metrics.refresh_engine(engine)
+            metrics_store.write(collect_metrics())
+        except OSError as e:
+            logging.error(f"Failed to write worker metrics: {str(e)}")
+
+async def refresh_registry():
+    while True:
+        await asyncio.sleep(registry_refresh_interval)
+        if registry.reload():
+            conversation_context.update_windows(registry.models)
+
+@app.before_serving
+async def start_metrics_flush():
+    global metrics_flush_task, registry_refresh_task
+    if metrics_store is not None:
+        metrics_flush_task = asyncio.ensure_future(flush_metrics())
+    if registry.path:
+        registry_refresh_task = asyncio.ensure_future(refresh_registry())
+
+@app.after_serving
+async def close_engine():
+    # The ASGI server has already drained open connections by now (see serve.py)
+    if metrics_store is not None:
+        metrics_flush_task.cancel()
+        metrics_store.retire(collect_metrics())
+    if registry_refresh_task is not None:
+        registry_refresh_task.cancel()
+    await conversation_context.aclose()
+    await embedding_batcher.aclose()
+    await engine.aclose()
+    if response_cache is not None and response_cache.disk is not None:
+        response_cache.disk.close()
+
+# Models on offer, reloaded from models_file, with per-model latency and error tracking for routes
+registry = ModelRegistry.from_config(config)
+registry_refresh_interval = config.get('models_refresh_interval', 60.0)
+registry_refresh_task = None
+# Routes skip models whose circuit breaker is open
+registry.unavailable = lambda model: upstream_policies.breaker(model).is_open()
+
+# Per-model prompt budgets, with token counts cached per conversation prefix
+conversation_context = ConversationContext.from_config(config, count_tokens, registry.models)
+
+async def summarize_text(prompt, model, max_tokens):
+    query = ComputeText(prompt=prompt, temperature=0.2, max_tokens=max_tokens, num_choices=1, model=model)
+    return await fetch_text(query, model)
+
+conversation_context.summarizer = summarize_text
+
+async def upstream_deltas(query, model, reservation=None):
+    """Yield the text of each node.delta from an upstream stream until graph.result."""
+    response = engine.stream(model, query, reservation=reservation)
+    logging.debug("Opened upstream stream")
+    async for event in response.async_iter():
+        # event.data parses the JSON payload on every access, so read it once
+        try:
+            event_data = event.data
+        except ValueError:
+            logging.warning(f"Received unexpected event: {event}")
+            continue
+        if debug_sample():
+            logging.debug("Received event: %s", event_data)
+
+        if event_data['object'] == 'node.delta':
+            yield event_data['data']['text']
+        elif event_data['object'] == 'graph.result':
+            return
 
-# List of valid models with estimated parameter sizes and streaming support
-valid_models = {
-    "Mixtral8x7BInstruct": {"parameter_size": "56B", "stream": True},
-    "Llama3Instruct70B": {"parameter_size": "70B", "stream": True},
-    "Llama3Instruct8B": {"parameter_size": "8B", "stream": True},
-    "Mistral7BInstruct": {"parameter_size": "7B", "stream": True},
-    "Llama3Instruct405B": {"parameter_size": "405B", "stream": True},
-    "gpt-4o": {"parameter_size": "200B", "stream": False},
-    "gpt-4o-mini": {"parameter_size": "70B", "stream": False},
-    "claude-3-5-sonnet-20240620": {"parameter_size": "2T", "stream": False}
-}
 
-@app.route('/api/chat', methods=['POST'])
-async def chat():
-    @stream_with_context
-    async def sse_stream(query, model):
-        logging.debug("Entering sse_stream generator")
-        start_time = datetime.utcnow()
-        try:
-            response = await substrate.async_stream(query)
-            logging.debug("Received response from substrate.async_stream")
-        except Exception as e:
-            logging.error(f"Error in substrate.async_stream: {str(e)}", exc_info=True)
-            yield json.dumps({'error': 'Internal Server Error'}) + '\n'
+async def whole_answer(query, model, reservation):
+    # A model that can't stream, standing in for one that can (as a hedge or fallback)
+    yield await fetch_text(query, model, reservation=reservation)
+
+
+async def first_delta(deltas):
+    try:
+        return await deltas.__anext__()
+    except StopAsyncIteration:
+        return None
+
+
+async def resilient_deltas(query_for, model, span, reservation=None):
+    """upstream_deltas with retries, hedging and the circuit breaker (see resilience.py)."""
+    def start(target, reservation):
+        if registry.models.get(target, {}).get('stream', True):
+            deltas = upstream_deltas(query_for(target), target, reservation)
+        else:
+            deltas = whole_answer(query_for(target), target, reservation)
+        return first_delta(deltas), deltas
+
+    used, first, deltas = await upstream_policies.first(model, start, close=lambda d: d.aclose(),
+                                                        reservation=reservation)
+    span.answered_by = used
+    if used != model:
+        logging.info(f"Streaming the answer from {used} instead of {model}")
+    try:
+        if first is not None:
+            yield first
+            async for text in deltas:
+                yield text
+    finally:
+        await deltas.aclose()
+
+
+async def resilient_text(query_for, model, span, store_key=None, reservation=None):
+    """fetch_text with retries, hedging and the circuit breaker (see resilience.py)."""
+    def start(target, reservation):
+        return fetch_text(query_for(target), target, reservation=reservation), None
+
+    used, text, _ = await upstream_policies.first(model, start, stream=False, reservation=reservation)
+    span.answered_by = used
+    if used != model:
+        # The cache key is the requested model's; another model's answer isn't cached under it
+        logging.info(f"Answered by {used} instead of {model}, not caching")
+    elif store_key:
+        response_cache.put(store_key, {'text': text})
+    return text
+
+
+def store_deltas(key, span):
+    if not key:
+        return None
+
+    def on_complete(deltas):
+        if span.answered_by not in (None, span.model):
+            logging.info(f"Streamed by {span.answered_by} instead of {span.model}, not caching")
             return
+        response_cache.put(key, {'text': ''.join(deltas), 'deltas': deltas})
+    return on_complete
 
-        accumulated_text = ""
 
+async def traced(body, span):
+    """Wrap a response body so its span sees the first byte, the byte count and the end."""
+    proxy_metrics.active_streams.inc((span.model,))
+    completed = False
+    try:
+        async for chunk in body:
+            span.first_byte()
+            span.add_bytes(len(chunk))
+            yield chunk
+        completed = True
+    finally:
+        proxy_metrics.active_streams.dec((span.model,))
+        if not completed and span.error is None:
+            span.fail('client_disconnected')
+        span.finish()
+        if span.source == 'upstream' and span.error != 'client_disconnected':
+            # Time to first token as the client saw it; for non-streaming models that's the whole answer
+            first = span.usage.first_delta
+            latency = (first - span.usage.start) / 1e9 if first is not None else None
+            # Against the model that answered, so a fallback's timings don't count as the primary's
+            registry.observe(span.answered_by or span.model, latency, span.error is not None)
+        await body.aclose()
+
+
+class ReservedBody:
+    """A response body that releases the request's engine reservation when it is closed, started or not."""
+
+    def __init__(self, body, reservation):
+        self.body = body
+        self.reservation = reservation
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        return self.body.__anext__()
+
+    async def aclose(self):
         try:
-            async for event in response.async_iter():
-                logging.debug(f"Received event: {event}")
-                
-                if hasattr(event, 'data'):
-                    event_data = event.data  # event.data is already a dictionary
-                    logging.debug(f"Event data: {event_data}")
-
-                    if event_data['object'] == 'node.delta':
-                        text = event_data['data']['text']
-                        accumulated_text += text
-                        created_at = datetime.utcnow().isoformat() + 'Z'
-                        sse_data = json.dumps({
-                            'model': f'Substrate:{model}',
-                            'created_at': created_at,
-                            'message': {
-                                'role': 'assistant',
-                                'content': text
-                            },
-                            'done': False
-                        })
-                        logging.debug(f"Sending SSE data: {sse_data}")
-                        yield f"{sse_data}\n"
-                    elif event_data['object'] == 'graph.result':
-                        # Final message
-                        end_time = datetime.utcnow()
-                        total_duration = (end_time - start_time).total_seconds() * 1e9  # Convert to nanoseconds
-                        done_data = json.dumps({
-                            'model': f'Substrate:{model}',
-                            'created_at': end_time.isoformat() + 'Z',
-                            'message': {
-                                'role': 'assistant',
-                                'content': ''  # Empty content for final message, as per Ollama format
-                            },
-                            'done_reason': 'stop',
-                            'done': True,
-                            'total_duration': int(total_duration),
-                            'load_duration': 2986624900,  # Example value
-                            'prompt_eval_count': 16,  # Example value
-                            'prompt_eval_duration': 63076000,  # Example value
-                            'eval_count': 341,  # Example value
-                            'eval_duration': 10140732000  # Example value
-                        })
-                        logging.debug(f"Sending final SSE data: {done_data}")
-                        yield f"{done_data}\n"
-                else:
-                    logging.warning(f"Received unexpected event: {event}")
-        except Exception as e:
-            logging.error(f"Error in sse_stream generator: {str(e)}", exc_info=True)
-            yield json.dumps({'error': 'Stream processing error'}) + '\n'
-
-        logging.debug("Exiting sse_stream generator")
+            await self.body.aclose()
+        finally:
+            self.reservation.release()
+
+
+def respond(body, span, encoder, reservation=None):
+    body = traced(body, span)
+    if reservation is not None:
+        # A generator that never started skips its finally on aclose(), so this can't live in traced()
+        body = ReservedBody(body, reservation)
+    return Response(body, mimetype=encoder.mimetype)
+
+
+def rejected(model, stream, error_type, message, status, headers=None, wire=ChunkEncoder):
+    proxy_metrics.requests.inc((model, 'true' if stream else 'false', 'rejected'))
+    proxy_metrics.errors.inc((model, error_type))
+    return jsonify(wire.error_body(message, error_type)), status, headers or {}
+
+
+async def record_deltas(deltas, on_complete):
+    # Used when a stream isn't shared: pass deltas through and cache them at the end
+    recorded = []
+    async for text in deltas:
+        recorded.append(text)
+        yield text
+    on_complete(recorded)
+
+
+async def sse_stream(deltas, span, encoder):
+    logging.debug("Entering sse_stream generator")
+    usage = span.usage
 
-    logging.debug("Entering chat endpoint")
     try:
-        headers = request.headers
-        raw_data = await request.data
-        content_type = headers.get('Content-Type')
+        async for text in deltas:
+            usage.delta(text)
+            chunk = encoder.delta(text)
+            if debug_sample():
+                logging.debug("Sending SSE data: %r", chunk)
+            yield chunk
+
+        # Final message, empty content as per Ollama format
+        done_data = encoder.done(**usage.finish())
+        logging.debug("Sending final SSE data: %r", done_data)
+        yield done_data
+    except Exception as e:
+        logging.error(f"Error in sse_stream generator: {str(e)}", exc_info=True)
+        span.fail(type(e).__name__)
+        yield encoder.error('Stream processing error')
+    finally:
+        # Detach from a shared stream right away if the client went away
+        await deltas.aclose()
 
-        logging.debug(f"Headers: {headers}")
-        logging.debug(f"Content-Type: {content_type}")
-        logging.debug(f"Raw Data: {raw_data}")
+    logging.debug("Exiting sse_stream generator")
 
-        if content_type != 'application/json':
-            logging.debug("Content-Type is not application/json, attempting to parse raw data as JSON")
-            try:
-                data = json.loads(raw_data)
-            except json.JSONDecodeError:
-                logging.error("Failed to parse raw data as JSON")
-                return jsonify({'error': 'Invalid JSON'}), 400
-        else:
-            data = await request.get_json()
 
-        logging.debug(f"Parsed JSON Data: {data}")
+async def read_json(wire):
+    """The request body as JSON, or (None, rejection) if it isn't."""
+    headers = request.headers
+    raw_data = await request.data
+    content_type = headers.get('Content-Type')
 
-        if data is None:
-            logging.error("Parsed data is None")
-            return jsonify({'error': 'Invalid JSON'}), 400
+    logging.debug(f"Headers: {headers}")
+    logging.debug(f"Content-Type: {content_type}")
+    logging.debug(f"Raw Data: {raw_data}")
 
-        model = data.get('model', '').replace('Substrate:', '')
-        messages = data.get('messages', [])
-        temperature = data.get('temperature', 0.4)
-        max_tokens = data.get('max_tokens', 800)
-        stream = data.get('stream', True)
+    if content_type != 'application/json':
+        logging.debug("Content-Type is not application/json, attempting to parse raw data as JSON")
+        try:
+            data = json.loads(raw_data)
+        except json.JSONDecodeError:
+            logging.error("Failed to parse raw data as JSON")
+            return None, rejected('unknown', False, 'invalid_json', 'Invalid JSON', 400, wire=wire)
+    else:
+        data = await request.get_json()
 
-        logging.debug(f"Model: {model}, Temperature: {temperature}, Max Tokens: {max_tokens}, Stream: {stream}")
+    logging.debug(f"Parsed JSON Data: {data}")
 
-        if model not in valid_models:
-            logging.error(f"Unsupported model: {model}")
-            return jsonify({'error': 'Unsupported model'}), 400
+    if not isinstance(data, dict):
+        logging.error("Parsed data is not a JSON object")
+        return None, rejected('unknown', False, 'invalid_json', 'Invalid JSON', 400, wire=wire)
+    return data, None
 
-        if not messages:
-            logging.error("No messages provided")
-            return jsonify({'error': 'No messages provided'}), 400
 
-        # Check if streaming is supported for the model
-        model_info = valid_models[model]
-        supports_streaming = model_info['stream']
+@app.route('/api/chat', methods=['POST'])
+async def chat():
+    logging.debug("Entering chat endpoint")
+    try:
+        data, error = await read_json(ChunkEncoder)
+        if error is not None:
+            return error
+        return await complete_chat(data, ChunkEncoder.for_model, data.get('stream', True), ChunkEncoder)
+    except Exception as e:
+        logging.error(f"Error in chat endpoint: {str(e)}", exc_info=True)
+        return rejected('unknown', False, type(e).__name__, 'Internal Server Error', 500)
 
-        # If streaming is requested but not supported, set stream to False
-        if stream and not supports_streaming:
-            logging.warning(f"Streaming not supported for model {model}. Falling back to non-streaming request.")
-            stream = False
 
-        # Concatenate messages into a single prompt
-        prompt = '\n'.join([f"{msg['role'].capitalize()}: {msg['content']}" for msg in messages if 'content' in msg])
-        logging.debug(f"Generated prompt: {prompt}")
+@app.route('/v1/chat/completions', methods=['POST'])
+async def openai_chat():
+    wire = OpenAIChunkEncoder
+    try:
+        data, error = await read_json(wire)
+        if error is not None:
+            return error
+        messages = []
+        for message in data.get('messages') or []:
+            content = message.get('content')
+            if isinstance(content, list):
+                # Content parts: only the text ones can be sent on
+                content = '\n'.join(part.get('text', '') for part in content if part.get('type') == 'text')
+            if content is not None:
+                messages.append({'role': message.get('role', 'user'), 'content': content})
+        data = {**data, 'messages': messages,
+                'max_tokens': data.get('max_completion_tokens', data.get('max_tokens', 800))}
+        include_usage = bool((data.get('stream_options') or {}).get('include_usage'))
+        stream = data.get('stream', False)
+        return await complete_chat(data, lambda model: wire.for_model(model, include_usage), stream, wire,
+                                   whole=not stream)
+    except Exception as e:
+        logging.error(f"Error in chat completions endpoint: {str(e)}", exc_info=True)
+        return rejected('unknown', False, type(e).__name__, 'Internal Server Error', 500, wire=wire)
+
+
+async def complete_chat(data, encoder_for_model, stream, wire, whole=False):
+    """
+    Everything between a parsed chat request and its response, shared by the
+    Ollama and OpenAI endpoints: routing, context budget, cache, coalescing,
+    admission and the upstream call. `wire` is the encoder class used for
+    errors, and encoder_for_model(model) gives the encoder for the response.
+    With `whole`, the answer is sent as one JSON object (OpenAI, stream=false).
+    """
+    model = data.get('model', '').replace('Substrate:', '')
+    if model in registry.routes:
+        routed_from = model
+        try:
+            model = registry.route(model)
+        except KeyError as e:
+            logging.error(str(e))
+            return rejected('unknown', stream, 'unsupported_model', 'No model available for route', 400, wire=wire)
+        logging.info(f"Routed {routed_from} to {model}")
+    messages = data.get('messages', [])
+    temperature = data.get('temperature', 0.4)
+    max_tokens = data.get('max_tokens', 800)
+    cache_control = request.headers.get('Cache-Control', '')
+    fresh = not data.get('cache', True) or 'no-cache' in cache_control or 'no-store' in cache_control
+    mode = request.headers.get('X-Stream-Mode', non_stream_mode)
+    if mode not in ('adaptive', 'burst'):
+        mode = non_stream_mode
+    use_cache = response_cache is not None and not fresh
+    # Identical requests share one upstream call unless the client asked for a fresh answer
+    coalesce = coalesce_requests and not fresh
+
+    logging.debug(f"Model: {model}, Temperature: {temperature}, Max Tokens: {max_tokens}, Stream: {stream}")
+
+    if model not in registry.models:
+        logging.error(f"Unsupported model: {model}")
+        # Not labelled with the requested name, to keep series cardinality bounded
+        return rejected('unknown', stream, 'unsupported_model', 'Unsupported model', 400, wire=wire)
+
+    if not messages:
+        logging.error("No messages provided")
+        return rejected(model, stream, 'no_messages', 'No messages provided', 400, wire=wire)
 
-        # Initialize the appropriate model query
-        query = ComputeText(
+    try:
+        # The model itself, or its fallback while its circuit breaker is open
+        model = upstream_policies.select(model)
+    except CircuitOpenError as e:
+        logging.warning(str(e))
+        retry_after = str(int(upstream_policies.policy(model)['breaker_open_seconds']))
+        return rejected(model, stream, 'circuit_open', 'Model temporarily unavailable', 503,
+                        {'Retry-After': retry_after}, wire=wire)
+
+    # Check if streaming is supported for the model
+    model_info = registry.models[model]
+    supports_streaming = model_info['stream']
+
+    # If streaming is requested but not supported, set stream to False
+    if stream and not supports_streaming:
+        logging.warning(f"Streaming not supported for model {model}. Falling back to non-streaming request.")
+        stream = False
+
+    # Concatenate messages into a single prompt, dropping or summarizing old turns that don't fit
+    prompt, prompt_tokens = conversation_context.build(model, messages, max_tokens)
+    logging.debug(f"Generated prompt: {prompt}")
+
+    # Initialize the appropriate model query; retries and hedges may send it to another model
+    def query_for(target):
+        return ComputeText(
             prompt=prompt,
             temperature=temperature,
             max_tokens=max_tokens,
             num_choices=1,
-            model=model
+            model=target
         )
-        logging.debug(f"Created ComputeText query: {query}")
 
-        if stream:
-            logging.info("Starting streaming response")
-            return Response(sse_stream(query, model), mimetype='application/x-ndjson')
+    encoder = encoder_for_model(model)
+    stream_deltas = stream_with_context(sse_stream)
+
+    # Canonical request hash, shared by the cache and request coalescing
+    key = cache_key(model, prompt, temperature, max_tokens)
+    store_key = key if use_cache else None
+    if response_cache is not None and not use_cache:
+        response_cache.bypassed += 1
+
+    if use_cache:
+        cached = response_cache.get(key)
+        if cached is not None:
+            span = Span(proxy_metrics, model, stream, ResponseUsage(model, prompt_tokens, count_tokens), span_log)
+            span.source = 'cache'
+            if whole:
+                logging.info("Serving completion from cache")
+                return await whole_response(cached_text(cached), span, encoder)
+            if stream:
+                logging.info("Replaying streaming response from cache")
+                deltas = replay_deltas(cached.get('deltas') or [cached['text']], replay_delay)
+                return respond(stream_deltas(deltas, span, encoder), span, encoder)
+            logging.info("Serving non-streaming response from cache")
+            return respond(cached_response(cached, span, mode, encoder), span, encoder)
+
+    # Cache hits above are left out of the usage histograms, they'd skew upstream timings
+    usage = ResponseUsage(model, prompt_tokens, count_tokens, usage_metrics)
+    span = Span(proxy_metrics, model, stream, usage, span_log)
+
+    if coalesce and flights.has_stream(key) and stream:
+        logging.info("Joining in-flight streaming request")
+        span.source = 'coalesced'
+        return respond(stream_deltas(flights.stream(key), span, encoder), span, encoder)
+    if coalesce and flights.has_call(key) and not stream:
+        logging.info("Joining in-flight non-streaming request")
+        span.source = 'coalesced'
+        if whole:
+            return await whole_response(flights.call(key), span, encoder)
+        return respond(non_streaming_response(flights.call(key), span, mode, encoder), span, encoder)
+
+    try:
+        reservation = engine.admit(model)
+    except QueueFullError as e:
+        logging.warning(str(e))
+        return rejected(model, stream, 'queue_full', 'Too many requests, upstream queue is full',
+                        e.status_code, {'Retry-After': '1'}, wire=wire)
+
+    if stream:
+        logging.info("Starting streaming response")
+        if coalesce:
+            deltas = flights.stream(key, lambda: resilient_deltas(query_for, model, span, reservation),
+                                    store_deltas(store_key, span))
         else:
-            logging.info("Starting non-streaming response")
-            return Response(non_streaming_response(query, model), mimetype='application/x-ndjson')
+            deltas = resilient_deltas(query_for, model, span, reservation)
+            if store_key:
+                deltas = record_deltas(deltas, store_deltas(store_key, span))
+        return respond(stream_deltas(deltas, span, encoder), span, encoder, reservation)
+    else:
+        logging.info("Starting non-streaming response")
+        if coalesce:
+            result = flights.call(key, lambda: resilient_text(query_for, model, span, store_key, reservation))
+        else:
+            result = resilient_text(query_for, model, span, store_key, reservation)
+        if whole:
+            return await whole_response(result, span, encoder, reservation)
+        return respond(non_streaming_response(result, span, mode, encoder), span, encoder, reservation)
 
-    except Exception as e:
-        logging.error(f"Error in chat endpoint: {str(e)}", exc_info=True)
-        return jsonify({'error': 'Internal Server Error'}), 500
 
+def ndjson_chunks(text, encoder, done_fields, mode):
+    done = encoder.done(**done_fields)
+
+    if mode == 'burst':
+        # One write for clients that render the answer all at once anyway
+        yield encoder.delta(text) + done
+        return
 
-async def non_streaming_response(query, model):
+    # Create Ollama-compatible response in chunks cut at sentence or word boundaries
+    for piece in adaptive_chunks(text, chunk_first_chars, chunk_max_chars):
+        yield encoder.delta(piece)
+
+    # Send the final response
+    yield done
+
+
+async def cached_response(entry, span, mode, encoder):
+    span.usage.delta(entry['text'])
+    for chunk in ndjson_chunks(entry['text'], encoder, span.usage.finish(), mode):
+        yield chunk
+
+
+async def cached_text(entry):
+    return entry['text']
+
+
+async def single(body):
+    yield body
+
+
+async def whole_response(result, span, encoder, reservation=None):
+    """Wait for the whole answer and send it as one JSON object, with a real status code on failure."""
     try:
-        start_time = time.time()
-        response = await substrate.async_run(query)
-        end_time = time.time()
-        
-        logging.debug(f"Raw response from Substrate API: {response}")
-        
-        if hasattr(response, 'api_response'):
-            api_response = response.api_response
-            logging.debug(f"API Response type: {type(api_response)}")
-            logging.debug(f"API Response attributes: {dir(api_response)}")
-            
-            if hasattr(api_response, 'json') and isinstance(api_response.json, dict):
-                content = api_response.json
-                logging.debug(f"JSON content: {content}")
-            else:
-                logging.error(f"Unable to find JSON content in api_response: {api_response}")
-                yield json.dumps({'error': 'No JSON content found in API response'}).encode('utf-8') + b'\n'
-                return
-
-            # Extract text from content
-            if isinstance(content, dict):
-                data = content.get('data', {})
-                if data:
-                    first_key = next(iter(data))
-                    text = data[first_key].get('text')
-                else:
-                    text = None
-            else:
-                logging.error(f"Unexpected content type: {type(content)}")
-                yield json.dumps({'error': 'Unexpected content type in API response'}).encode('utf-8') + b'\n'
-                return
+        text = await result
+    except QueueFullError as e:
+        # A retry that couldn't get a queue slot of its own
+        logging.warning(f"Completion failed: {str(e)}")
+        span.fail(type(e).__name__)
+        body = json.dumps(encoder.error_body('Too many requests, upstream queue is full', 'queue_full')).encode('utf-8')
+        return Response(traced(single(body), span), status=e.status_code, headers={'Retry-After': '1'},
+                        mimetype='application/json')
+    except (UpstreamError, UpstreamStatusError, CircuitOpenError, FirstDeltaTimeout) as e:
+        logging.error(f"Completion failed: {str(e)}")
+        span.fail(type(e).__name__)
+        body = json.dumps(encoder.error_body(str(e), 'upstream_error')).encode('utf-8')
+        return Response(traced(single(body), span), status=502, mimetype='application/json')
+    except Exception as e:
+        # Such as a transport error left over when the retries ran out
+        logging.error(f"Error in completion: {str(e)}", exc_info=True)
+        span.fail(type(e).__name__)
+        body = json.dumps(encoder.error_body('Internal Server Error', 'upstream_error')).encode('utf-8')
+        return Response(traced(single(body), span), status=502, mimetype='application/json')
+    finally:
+        if reservation is not None:
+            reservation.release()
+    span.usage.delta(text)
+    body = encoder.completion(text, **span.usage.finish())
+    return Response(traced(single(body), span), mimetype='application/json')
+
+
+class UpstreamError(Exception):
+    """An upstream response we can't turn into text; the message is sent to the client."""
+
+
+async def fetch_text(query, model, reservation=None):
+    """Run a non-streaming completion and return its text."""
+    response = await engine.run(model, query, reservation=reservation)
+
+    logging.debug(f"Raw response from Substrate API: {response}")
+
+    text = None
+    if hasattr(response, 'api_response'):
+        api_response = response.api_response
+        logging.debug(f"API Response type: {type(api_response)}")
+        logging.debug(f"API Response attributes: {dir(api_response)}")
+
+        if hasattr(api_response, 'json') and isinstance(api_response.json, dict):
+            content = api_response.json
+            logging.debug(f"JSON content: {content}")
+        else:
+            logging.error(f"Unable to find JSON content in api_response: {api_response}")
+            raise UpstreamError('No JSON content found in API response')
 
-        if text is None:
-            logging.error(f"No text content found in response: {content}")
-            yield json.dumps({'error': 'No text content found in API response'}).encode('utf-8') + b'\n'
-            return
+        # Extract text from content
+        data = content.get('data', {})
+        if data:
+            first_key = next(iter(data))
+            text = data[first_key].get('text')
 
-        # Calculate durations
-        total_duration = int((end_time - start_time) * 1e9)  # Convert to nanoseconds
-        
-        # Create Ollama-compatible response in chunks
-        for i in range(0, len(text), 50):  # Chunk the response by 50 characters
-            chunk = text[i:i + 50]
-            result = {
-                "model": f"Substrate:{model}",
-                "created_at": datetime.utcnow().isoformat() + 'Z',
-                "message": {
-                    "role": "assistant",
-                    "content": chunk
-                },
-                "done": False
-            }
-            yield json.dumps(result).encode('utf-8') + b'\n'
-
-        # Send the final response
-        final_result = {
-            "model": f"Substrate:{model}",
-            "created_at": datetime.utcnow().isoformat() + 'Z',
-            "message": {
-                "role": "assistant",
-                "content": ""  # Final empty content
-            },
-            "done": True,
-            "total_duration": total_duration,
-            "load_duration": 0,
-            "prompt_eval_count": 0,
-            "prompt_eval_duration": 0,
-            "eval_count": 0,
-            "eval_duration": 0,
-            "done_reason": "stop"
-        }
-        
-        yield json.dumps(final_result).encode('utf-8') + b'\n'
+    if text is None:
+        logging.error(f"No text content found in response: {response}")
+        raise UpstreamError('No text content found in API response')
 
+    return text
+
+
+async def non_streaming_response(result, span, mode, encoder):
+    task = asyncio.ensure_future(result)
+    try:
+        if mode == 'adaptive':
+            # Empty deltas right away and then every heartbeat_interval seconds,
+            # so idle timeouts between us and the client don't cut the connection
+            yield encoder.heartbeat()
+            while not task.done():
+                await asyncio.wait((task,), timeout=heartbeat_interval)
+                if not task.done():
+                    yield encoder.heartbeat()
+        text = await task
+        # The whole completion arrives at once, so it counts as a single delta
+        span.usage.delta(text)
+
+        for chunk in ndjson_chunks(text, encoder, span.usage.finish(), mode):
+            yield chunk
+
+    except (UpstreamError, UpstreamStatusError) as e:
+        span.fail(type(e).__name__)
+        yield encoder.error(str(e))
     except Exception as e:
         logging.error(f"Error in non-streaming response: {str(e)}", exc_info=True)
-        error_response = {
-            "error": "Internal Server Error",
-            "done": True
-        }
-        yield json.dumps(error_response).encode('utf-8') + b'\n'
+        span.fail(type(e).__name__)
+        yield encoder.error('Internal Server Error')
+    finally:
+        # Only still running if the client went away; don't keep the upstream call alive for it
+        task.cancel()
+
+
+async def embed_batch(model, texts):
+    """One upstream MultiEmbedText call for a batch of texts; returns their vectors in order."""
+    async def run(target, reservation):
+        items = [{'text': text} for text in texts]
+        response = await engine.run(target, MultiEmbedText(items=items, model=target), reservation=reservation)
+        data = response.api_response.json.get('data') or {}
+        if not data:
+            raise UpstreamError('No embeddings found in API response')
+        embeddings = data[next(iter(data))].get('embeddings') or []
+        if len(embeddings) != len(texts):
+            raise UpstreamError(f"Expected {len(texts)} embeddings, got {len(embeddings)}")
+        return [embedding['vector'] for embedding in embeddings]
+
+    def start(target, reservation):
+        return run(target, reservation), None
+
+    _, vectors, _ = await upstream_policies.first(model, start, stream=False)
+    return vectors
+
+
+# Embedding inputs from concurrent requests go upstream together
+embedding_batcher = EmbeddingBatcher(
+    embed_batch,
+    max_batch=config.get('embedding_batch_size', 64),
+    max_wait=config.get('embedding_batch_wait', 0.01),
+)
+
+
+@app.route('/v1/embeddings', methods=['POST'])
+async def openai_embeddings():
+    wire = OpenAIChunkEncoder
+    try:
+        data, error = await read_json(wire)
+        if error is not None:
+            return error
+        model = data.get('model') or embedding_model
+        inputs = data.get('input')
+        encoding_format = data.get('encoding_format', 'float')
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        if model not in EMBEDDING_MODELS:
+            return rejected('unknown', False, 'unsupported_model', 'Unsupported embedding model', 400, wire=wire)
+        if not inputs or not all(isinstance(text, str) for text in inputs):
+            return rejected(model, False, 'invalid_input', 'input must be a string or a list of strings', 400,
+                            wire=wire)
+        if encoding_format not in ('float', 'base64'):
+            return rejected(model, False, 'invalid_input', 'encoding_format must be float or base64', 400, wire=wire)
+
+        vectors = [None] * len(inputs)
+        keys = [cache_key(f"embed:{model}", text, None, None) for text in inputs]
+        missing = []
+        for i, key in enumerate(keys):
+            cached = response_cache.get(key) if response_cache is not None else None
+            if cached is not None:
+                vectors[i] = cached['embedding']
+            else:
+                missing.append(i)
+        if missing:
+            try:
+                # Batches queue for an engine slot like any other upstream call
+                fetched = await embedding_batcher.embed(model, [inputs[i] for i in missing])
+            except QueueFullError as e:
+                logging.warning(str(e))
+                return rejected(model, False, 'queue_full', 'Too many requests, upstream queue is full',
+                                e.status_code, {'Retry-After': '1'}, wire=wire)
+            except (UpstreamError, UpstreamStatusError, CircuitOpenError, FirstDeltaTimeout) as e:
+                logging.error(f"Embedding failed: {str(e)}")
+                return rejected(model, False, type(e).__name__, str(e), 502, wire=wire)
+            for i, vector in zip(missing, fetched):
+                vectors[i] = vector
+                if response_cache is not None:
+                    response_cache.put(keys[i], {'embedding': vector})
+
+        tokens = sum(count_tokens(text) for text in inputs)
+        return jsonify({
+            "object": "list",
+            "data": [
+                {"object": "embedding", "index": i, "embedding": encode_embedding(vector, encoding_format)}
+                for i, vector in enumerate(vectors)
+            ],
+            "model": model,
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        })
+    except Exception as e:
+        logging.error(f"Error in embeddings endpoint: {str(e)}", exc_info=True)
+        return rejected('unknown', False, type(e).__name__, 'Internal Server Error', 500, wire=wire)
+
+
+@app.route('/v1/models', methods=['GET'])
+async def openai_models():
+    created = int(registry.loaded_at.timestamp())
+    names = list(registry.models) + list(registry.routes) + list(EMBEDDING_MODELS)
+    return jsonify({
+        "object": "list",
+        "data": [{"id": name, "object": "model", "created": created, "owned_by": "substrate"} for name in names],
+    })
+
+
+@app.route('/api/embeddings/stats', methods=['GET'])
+async def embedding_stats():
+    return jsonify({'worker': os.getpid(), **embedding_batcher.stats()})
 
 
-    
 @app.route('/api/tags', methods=['GET'])
 async def list_local_models():
-    try:
-        models = [
-            {
-                "name": f"Substrate:{model}",
-                "model": f"Substrate:{model}",
-                "modified_at": datetime.utcnow().isoformat() + 'Z',
-                "size": 4661226402,  # Example size, adjust accordingly
-                "digest": f"{model}-digest",  # Unique digest
-                "details": {
-                    "parent_model": "",
-                    "format": "gguf",
-                    "family": "llama",
-                    "families": ["llama"],
-                    "parameter_size": info["parameter_size"],
-                    "quantization_level": "Q4_0"
-                }
-            } for model, info in valid_models.items()
-        ]
-        return jsonify({"models": models})
-    except Exception as e:
-        logging.error(f"Error in list_local_models endpoint: {str(e)}")
-        return jsonify({'error': 'Internal Server Error'}), 500
+    # Built once per catalog load; Open WebUI polls this, so unchanged lists cost a 304
+    if request.if_none_match.contains(registry.tags_etag):
+        return Response(status=304, headers={'ETag': f'"{registry.tags_etag}"'})
+    return Response(registry.tags_body, mimetype='application/json', headers={'ETag': f'"{registry.tags_etag}"'})
+
+@app.route('/api/models', methods=['GET'])
+async def registry_stats():
+    return jsonify({'worker': os.getpid(), **registry.stats()})
+
+@app.route('/api/engine', methods=['GET'])
+async def engine_stats():
+    # Per worker: each process has its own engine, cache memory tier and coalescing
+    return jsonify({'worker': os.getpid(), **engine.stats(), 'coalescing': flights.stats()})
+
+@app.route('/metrics', methods=['GET'])
+async def prometheus_metrics():
+    proxy_metrics.refresh_engine(engine)
+    collected = collect_metrics()
+    if metrics_store is not None:
+        # Totals for every worker, not just the one that took the scrape
+        metrics_store.write(collected)
+        collected = metrics_store.aggregate(collected)
+    return Response(render_prometheus(collected), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/usage', methods=['GET'])
+async def usage_stats():
+    return jsonify({'worker': os.getpid(), **usage_metrics.snapshot()})
+
+@app.route('/api/upstream', methods=['GET'])
+async def upstream_policy_stats():
+    return jsonify({'worker': os.getpid(), **upstream_policies.stats()})
+
+@app.route('/api/context', methods=['GET'])
+async def context_stats():
+    return jsonify({'worker': os.getpid(), **conversation_context.stats()})
+
+@app.route('/api/cache', methods=['GET'])
+async def cache_stats():
+    if response_cache is None:
+        return jsonify({'enabled': False})
+    return jsonify({'enabled': True, 'worker': os.getpid(), **response_cache.stats()})
+
+@app.route('/api/cache', methods=['DELETE'])
+async def clear_cache():
+    if response_cache is not None:
+        response_cache.clear()
+    return jsonify({'cleared': response_cache is not None})
 
 @app.route('/api/version', methods=['GET'])
 async def get_version():
@@ -0,0 +1,257 @@
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import time
+from datetime import datetime, timezone
+
+# Built-in catalog, used when no models_file is configured. tier is a rough
+# quality grade (1 small, 2 medium, 3 large) for routes; latency is the
+# expected seconds to first token, used until real requests have been seen.
+DEFAULT_MODELS = {
+    "Mixtral8x7BInstruct": {"parameter_size": "56B", "stream": True, "context": 32768, "tier": 2, "latency": 0.6},
+    "Llama3Instruct70B": {"parameter_size": "70B", "stream": True, "context": 8192, "tier": 2, "latency": 0.8},
+    "Llama3Instruct8B": {"parameter_size": "8B", "stream": True, "context": 8192, "tier": 1, "latency": 0.3},
+    "Mistral7BInstruct": {"parameter_size": "7B", "stream": True, "context": 32768, "tier": 1, "latency": 0.3},
+    "Llama3Instruct405B": {"parameter_size": "405B", "stream": True, "context": 128000, "tier": 3, "latency": 1.5},
+    "gpt-4o": {"parameter_size": "200B", "stream": False, "context": 128000, "tier": 3, "latency": 4.0},
+    "gpt-4o-mini": {"parameter_size": "70B", "stream": False, "context": 128000, "tier": 2, "latency": 2.5},
+    "claude-3-5-sonnet-20240620": {"parameter_size": "2T", "stream": False, "context": 200000, "tier": 3, "latency": 5.0},
+}
+
+# Virtual model names, resolved per request to the fastest healthy model of at least min_tier
+DEFAULT_ROUTES = {
+    "auto-fast": {"min_tier": 2},
+}
+
+_PARAMS = re.compile(r'^([\d.]+)([KMBT])$', re.IGNORECASE)
+_SCALE = {'K': 1e3, 'M': 1e6, 'B': 1e9, 'T': 1e12}
+
+
+def estimated_size(parameter_size):
+    """Bytes of a 4-bit quantized model of that many parameters, for the size field of /api/tags."""
+    match = _PARAMS.match(parameter_size or '')
+    if not match:
+        return 0
+    return int(float(match.group(1)) * _SCALE[match.group(2).upper()] * 0.5625)
+
+
+class ModelHealth:
+    """Moving averages of one model's time to first token and error rate."""
+
+    def __init__(self, prior_latency, alpha=0.2, error_alpha=0.1):
+        self.latency = prior_latency
+        self.alpha = alpha
+        self.error_alpha = error_alpha
+        self.error_rate = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.consecutive_errors = 0
+        self.last_error_at = None
+        self.observed = False
+
+    def observe(self, latency, error):
+        self.requests += 1
+        if error:
+            self.errors += 1
+            self.consecutive_errors += 1
+            self.last_error_at = time.monotonic()
+        else:
+            self.consecutive_errors = 0
+        self.error_rate += self.error_alpha * ((1.0 if error else 0.0) - self.error_rate)
+        if latency is not None and not error:
+            if self.observed:
+                self.latency += self.alpha * (latency - self.latency)
+            else:
+                # The first real measurement replaces the prior outright
+                self.latency = latency
+                self.observed = True
+
+    def healthy(self, max_error_rate, max_consecutive_errors, cooldown):
+        if self.error_rate <= max_error_rate and self.consecutive_errors < max_consecutive_errors:
+            return True
+        # Let one request through now and then, so a recovered model can prove itself
+        return time.monotonic() - self.last_error_at >= cooldown
+
+    def stats(self):
+        return {
+            "latency": round(self.latency, 4),
+            "latency_observed": self.observed,
+            "error_rate": round(self.error_rate, 4),
+            "requests": self.requests,
+            "errors": self.errors,
+            "consecutive_errors": self.consecutive_errors,
+        }
+
+
+class ModelRegistry:
+    """
+    The models the proxy offers, loaded from `path` (or the built-in table).
+
+    reload() re-reads the file when it has changed and rebuilds the /api/tags
+    body and its ETag once, so serving the tags is a constant byte string.
+    observe() feeds per-model latency and errors from finished requests, and
+    route() resolves a virtual name such as auto-fast to the fastest healthy
+    model that meets the route's tier.
+    """
+
+    def __init__(self, path=None, routes=None, max_error_rate=0.5, max_consecutive_errors=3,
+                 cooldown=30.0, explore=0.05):
+        self.path = path
+        self.default_routes = routes if routes is not None else DEFAULT_ROUTES
+        self.max_error_rate = max_error_rate
+        self.max_consecutive_errors = max_consecutive_errors
+        self.cooldown = cooldown
+        self.explore = explore
+        self.models = {}
+        self.routes = {}
+        self.health = {}
+        self.routed = {}
+        # Optional callable(model) -> True for models that must not be routed to right now
+        self.unavailable = None
+        self.tags_body = b''
+        self.tags_etag = ''
+        self.loaded_at = None
+        self.reloads = 0
+        self._mtime = None
+        self._load(DEFAULT_MODELS, self.default_routes)
+        self.reload()
+
+    @classmethod
+    def from_config(cls, config):
+        path = config.get('models_file')
+        return cls(
+            path=os.path.expanduser(path) if path else None,
+            routes=config.get('routes'),
+            max_error_rate=config.get('route_max_error_rate', 0.5),
+            max_consecutive_errors=config.get('route_max_consecutive_errors', 3),
+            cooldown=config.get('route_cooldown', 30.0),
+            explore=config.get('route_explore', 0.05),
+        )
+
+    def reload(self):
+        """Re-read the models file if it changed; returns True if the catalog was replaced."""
+        if not self.path:
+            return False
+        try:
+            mtime = os.stat(self.path).st_mtime
+            if mtime == self._mtime:
+                return False
+            with open(self.path, 'r') as f:
+                catalog = json.load(f)
+            self._load(catalog.get('models', DEFAULT_MODELS), catalog.get('routes', self.default_routes))
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.error(f"Failed to load models file {self.path}, keeping the current catalog: {str(e)}")
+            return False
+        self._mtime = mtime
+        logging.info(f"Loaded {len(self.models)} models and {len(self.routes)} routes from {self.path}")
+        return True
+
+    def _load(self, models, routes):
+        loaded = {}
+        for name, entry in models.items():
+            if entry.get('enabled', True) is False:
+                continue
+            # Known models only need the fields that differ from the built-in table
+            entry = {**DEFAULT_MODELS.get(name, {}), **entry}
+            loaded[name] = {
+                "parameter_size": entry.get('parameter_size', ''),
+                "stream": entry.get('stream', True),
+                "context": int(entry.get('context', 8192)),
+                "tier": int(entry.get('tier', 1)),
+                "latency": float(entry.get('latency', 1.0)),
+                "family": entry.get('family', 'llama'),
+                "size": entry.get('size') or estimated_size(entry.get('parameter_size')),
+            }
+        self.models = loaded
+        self.routes = {name: route for name, route in routes.items() if name not in loaded}
+        # Keep what was learned about models that are still offered
+        health = {}
+        for name, info in loaded.items():
+            health[name] = self.health.get(name) or ModelHealth(info['latency'])
+            if not health[name].observed:
+                health[name].latency = info['latency']
+        self.health = health
+        self.loaded_at = datetime.now(timezone.utc)
+        self.reloads += 1
+        self._build_tags()
+
+    def _build_tags(self):
+        modified_at = self.loaded_at.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        entries = []
+        for name, info in self.models.items():
+            digest = hashlib.sha256(json.dumps([name, info], sort_keys=True).encode('utf-8')).hexdigest()
+            entries.append(self._tag(name, modified_at, info['size'], digest, info['family'], info['parameter_size']))
+        for name in self.routes:
+            digest = hashlib.sha256(json.dumps([name, self.routes[name]], sort_keys=True).encode('utf-8')).hexdigest()
+            entries.append(self._tag(name, modified_at, 0, digest, 'router', 'auto'))
+        self.tags_body = json.dumps({"models": entries}, separators=(',', ':')).encode('utf-8')
+        self.tags_etag = hashlib.sha256(self.tags_body).hexdigest()[:32]
+
+    @staticmethod
+    def _tag(name, modified_at, size, digest, family, parameter_size):
+        return {
+            "name": f"Substrate:{name}",
+            "model": f"Substrate:{name}",
+            "modified_at": modified_at,
+            "size": size,
+            "digest": digest,
+            "details": {
+                "parent_model": "",
+                "format": "gguf",
+                "family": family,
+                "families": [family],
+                "parameter_size": parameter_size,
+                "quantization_level": "Q4_0"
+            }
+        }
+
+    def observe(self, model, latency, error):
+        health = self.health.get(model)
+        if health is not None:
+            health.observe(latency, error)
+
+    def route(self, name):
+        """The model a virtual name should use for this request."""
+        route = self.routes[name]
+        candidates = [
+            model for model, info in self.models.items()
+            if info['tier'] >= route.get('min_tier', 1)
+            and (not route.get('stream') or info['stream'])
+            and ('models' not in route or model in route['models'])
+        ]
+        if self.unavailable is not None:
+            candidates = [model for model in candidates if not self.unavailable(model)] or candidates
+        if not candidates:
+            raise KeyError(f"No model matches route {name}")
+        healthy = [
+            model for model in candidates
+            if self.health[model].healthy(self.max_error_rate, self.max_consecutive_errors, self.cooldown)
+        ]
+        if not healthy:
+            # Everything is failing; use whichever is failing least
+            choice = min(candidates, key=lambda model: self.health[model].error_rate)
+        elif len(healthy) > 1 and random.random() < self.explore:
+            # A small share of traffic keeps the estimates of the other models current
+            choice = random.choice(healthy)
+        else:
+            choice = min(healthy, key=lambda model: self.health[model].latency)
+        counts = self.routed.setdefault(name, {})
+        counts[choice] = counts.get(choice, 0) + 1
+        return choice
+
+    def stats(self):
+        return {
+            "path": self.path,
+            "loaded_at": self.loaded_at.isoformat(),
+            "reloads": self.reloads,
+            "etag": self.tags_etag,
+            "models": {
+                name: {**info, **self.health[name].stats(), "healthy": self.health[name].healthy(
+                    self.max_error_rate, self.max_consecutive_errors, self.cooldown)}
+                for name, info in self.models.items()
+            },
+            "routes": {name: {**route, "routed": self.routed.get(name, {})} for name, route in self.routes.items()},
+        }
@@ -0,0 +1,366 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+
+import httpx
+import httpx_sse
+
+from engine import QueueFullError, UpstreamStatusError
+from metrics import Counter, Gauge
+
+DEFAULT_POLICY = {
+    # Extra attempts after a failure before the first delta (0 disables retries)
+    "retries": 2,
+    "backoff_base": 0.25,
+    "backoff_max": 4.0,
+    # Give up on a stream that hasn't produced its first delta by then
+    "first_delta_timeout": 60.0,
+    # Give up on a non-streaming call that hasn't answered by then
+    "response_timeout": 180.0,
+    # Model to hedge with, or to use while this one's breaker is open
+    "fallback": None,
+    "hedge": False,
+    # Hedge at the observed p95 time to first delta, never sooner than this
+    "hedge_min_delay": 0.5,
+    # Recent first-delta times kept per model, and how many are needed before hedging
+    "latency_window": 200,
+    "hedge_min_samples": 20,
+    "breaker_error_rate": 0.5,
+    "breaker_window": 50,
+    "breaker_min_requests": 10,
+    "breaker_open_seconds": 30.0,
+}
+
+BREAKER_STATES = {'closed': 0, 'half_open': 1, 'open': 2}
+
+
+class CircuitOpenError(Exception):
+    """The model's breaker is open and there is no usable fallback."""
+
+    def __init__(self, model):
+        super().__init__(f"Circuit open for {model}")
+        self.model = model
+
+
+class FirstDeltaTimeout(Exception):
+    def __init__(self, model, seconds):
+        super().__init__(f"No first delta from {model} after {seconds:.1f}s")
+        self.model = model
+
+
+def retryable(error):
+    """Failures before anything was sent to the client that another attempt may not hit."""
+    if isinstance(error, UpstreamStatusError):
+        return error.status_code >= 500 or error.status_code == 429
+    return isinstance(error, (httpx.TransportError, httpx_sse.SSEError, FirstDeltaTimeout))
+
+
+class CircuitBreaker:
+    """
+    Closed until the error rate over the last `window` outcomes reaches
+    `error_rate` (with at least `min_requests` of them); then open for
+    `open_seconds`. After that it is half open: admit() lets a single
+    request through as a probe and keeps turning the rest away, and the
+    probe's outcome closes the breaker or opens it for another period.
+    """
+
+    def __init__(self, error_rate=0.5, window=50, min_requests=10, open_seconds=30.0):
+        self.error_rate = error_rate
+        self.min_requests = min_requests
+        self.open_seconds = open_seconds
+        self.outcomes = deque(maxlen=window)
+        self.state = 'closed'
+        self.opened_at = None
+        self.opens = 0
+        self.probing = False
+
+    def is_open(self):
+        """Whether requests are turned away: open, or half open with the probe still out."""
+        if self.state == 'open' and time.monotonic() - self.opened_at >= self.open_seconds:
+            self.state = 'half_open'
+        return self.state == 'open' or (self.state == 'half_open' and self.probing)
+
+    def current(self):
+        self.is_open()
+        return self.state
+
+    def admit(self):
+        """Whether a request may be sent now; while half open, only the probe may."""
+        if self.is_open():
+            return False
+        if self.state == 'half_open':
+            self.probing = True
+        return True
+
+    def release(self):
+        """The probe ended without an outcome (cancelled, or never sent); let another through."""
+        self.probing = False
+
+    def record(self, ok, probe=False):
+        self.is_open()
+        if self.state == 'half_open':
+            # Requests sent before the breaker opened don't decide it, only the probe
+            if not probe:
+                return
+            self.probing = False
+            if ok:
+                self.state = 'closed'
+                self.outcomes.clear()
+            else:
+                self._open()
+            return
+        self.outcomes.append(ok)
+        failures = self.outcomes.count(False)
+        if len(self.outcomes) >= self.min_requests and failures / len(self.outcomes) >= self.error_rate:
+            self._open()
+
+    def _open(self):
+        self.state = 'open'
+        self.opened_at = time.monotonic()
+        self.opens += 1
+
+
+class _Attempt:
+    def __init__(self, model, hedge=False):
+        self.model = model
+        self.hedge = hedge
+        self.started = None
+        self.handle = None
+        self.task = None
+        self.reservation = None
+
+
+class UpstreamPolicies:
+    """
+    Retry, hedging and circuit breaking for upstream calls, per model.
+
+    first() runs `start(model, reservation)` until one attempt produces its first result
+    (the first delta of a stream, or a whole non-streaming answer). Failures
+    before that point are retried with jittered exponential backoff; an
+    attempt that is slower than the model's observed p95 gets a hedge on the
+    fallback model, and whichever answers first is used while the other is
+    closed. Once a result has been handed to the caller nothing is retried,
+    since part of it may already be on its way to the client.
+    """
+
+    def __init__(self, policies=None):
+        policies = policies or {}
+        self.default = {**DEFAULT_POLICY, **policies.get('default', {})}
+        self.overrides = {model: {**self.default, **policy} for model, policy in policies.items() if model != 'default'}
+        self.breakers = {}
+        self.latencies = {}
+        self.attempts = Counter(
+            "substrate_proxy_upstream_attempts_total", "Upstream attempts by model and kind (first, retry, hedge).",
+            ("model", "kind"))
+        self.failures = Counter(
+            "substrate_proxy_upstream_failures_total", "Upstream attempts that failed before their first delta.",
+            ("model", "type"))
+        self.hedge_wins = Counter(
+            "substrate_proxy_hedge_wins_total", "Requests answered by the hedge instead of the first attempt.")
+        self.breaker_rejections = Counter(
+            "substrate_proxy_breaker_rejections_total", "Requests turned away or rerouted by an open breaker.")
+        self.breaker_opens = Counter(
+            "substrate_proxy_breaker_opens_total", "Times a model's circuit breaker opened.")
+        self.breaker_state = Gauge(
+            "substrate_proxy_breaker_state", "Circuit breaker state per model: 0 closed, 1 half open, 2 open.")
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.get('upstream_policies'))
+
+    def policy(self, model):
+        return self.overrides.get(model, self.default)
+
+    def breaker(self, model):
+        breaker = self.breakers.get(model)
+        if breaker is None:
+            policy = self.policy(model)
+            breaker = self.breakers[model] = CircuitBreaker(
+                policy['breaker_error_rate'], policy['breaker_window'],
+                policy['breaker_min_requests'], policy['breaker_open_seconds'])
+        return breaker
+
+    def hedge_delay(self, model, stream):
+        policy = self.policy(model)
+        samples = self.latencies.get((model, stream))
+        if not policy['hedge'] or not policy['fallback'] or not samples or len(samples) < policy['hedge_min_samples']:
+            return None
+        ordered = sorted(samples)
+        p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+        return max(policy['hedge_min_delay'], p95)
+
+    def _observe(self, attempt, stream, seconds):
+        samples = self.latencies.get((attempt.model, stream))
+        if samples is None:
+            samples = self.latencies[(attempt.model, stream)] = deque(maxlen=self.policy(attempt.model)['latency_window'])
+        samples.append(seconds)
+
+    def select(self, model):
+        """The model to send a request for `model` to: itself, or its fallback while its breaker is open."""
+        if not self.breaker(model).is_open():
+            return model
+        self.breaker_rejections.inc((model,))
+        fallback = self.policy(model)['fallback']
+        if fallback and not self.breaker(fallback).is_open():
+            logging.warning(f"Circuit open for {model}, sending the request to {fallback}")
+            return fallback
+        raise CircuitOpenError(model)
+
+    def _record(self, model, ok, probe=False):
+        breaker = self.breaker(model)
+        opens = breaker.opens
+        breaker.record(ok, probe)
+        if breaker.opens != opens:
+            logging.warning(f"Circuit breaker opened for {model}")
+            self.breaker_opens.inc((model,))
+
+    async def first(self, model, start, close=None, stream=True, reservation=None):
+        """
+        Return (model used, first result, handle) for the first attempt that succeeds.
+
+        `model` should come from select(). start(model, reservation) returns
+        (awaitable, handle); close(handle) is awaited for attempts that are abandoned or
+        failed, if given. The first attempt uses the `reservation` the caller got
+        from engine.admit(); retries and hedges queue for their own.
+        Raises CircuitOpenError if the model's breaker is half open with
+        another request's probe out and there is no fallback to use instead.
+        """
+        policy = self.policy(model)
+        fallback = policy['fallback']
+        loop = asyncio.get_running_loop()
+        retries_left = policy['retries']
+        retried = 0
+        timeout = policy['first_delta_timeout'] if stream else policy['response_timeout']
+        hedge_delay = self.hedge_delay(model, stream) if fallback and fallback != model else None
+        hedge_at = loop.time() + hedge_delay if hedge_delay is not None else None
+        attempts = set()
+        last_error = None
+        # One breaker outcome per model for the whole request, not one per attempt:
+        # ok if any attempt on that model answered
+        outcomes = {}
+        # Models this request is the half-open probe for
+        probes = set()
+
+        def admit(target):
+            breaker = self.breaker(target)
+            if not breaker.admit():
+                return False
+            if breaker.state == 'half_open':
+                probes.add(target)
+            return True
+
+        async def run(attempt, delay):
+            if delay:
+                await asyncio.sleep(delay)
+            attempt.started = loop.time()
+            awaitable, attempt.handle = start(attempt.model, attempt.reservation)
+            if timeout:
+                try:
+                    return await asyncio.wait_for(awaitable, timeout)
+                except asyncio.TimeoutError:
+                    raise FirstDeltaTimeout(attempt.model, timeout)
+            return await awaitable
+
+        def launch(target, kind, delay=0.0):
+            attempt = _Attempt(target, hedge=kind == 'hedge')
+            attempt.reservation = reservation if kind == 'first' else None
+            attempt.task = asyncio.ensure_future(run(attempt, delay))
+            attempts.add(attempt)
+            self.attempts.inc((target, kind))
+
+        async def abandon(attempt):
+            attempt.task.cancel()
+            try:
+                await attempt.task
+            except BaseException:
+                pass
+            if close is not None and attempt.handle is not None:
+                await close(attempt.handle)
+
+        if admit(model):
+            launch(model, 'first')
+        elif fallback and fallback != model and admit(fallback):
+            # Another request is already probing the model
+            logging.warning(f"Circuit half open for {model}, sending the request to {fallback}")
+            launch(fallback, 'first')
+        else:
+            self.breaker_rejections.inc((model,))
+            raise CircuitOpenError(model)
+        try:
+            while attempts:
+                wait = hedge_at - loop.time() if hedge_at is not None else None
+                done, _ = await asyncio.wait(
+                    [a.task for a in attempts], timeout=max(0.0, wait) if wait is not None else None,
+                    return_when=asyncio.FIRST_COMPLETED)
+
+                for attempt in [a for a in attempts if a.task in done]:
+                    attempts.discard(attempt)
+                    error = attempt.task.exception()
+                    if error is None:
+                        outcomes[attempt.model] = True
+                        self._observe(attempt, stream, loop.time() - attempt.started)
+                        if attempt.hedge:
+                            self.hedge_wins.inc((model,))
+                        for other in list(attempts):
+                            attempts.discard(other)
+                            await abandon(other)
+                        return attempt.model, attempt.task.result(), attempt.handle
+
+                    last_error = error
+                    # A full local queue says nothing about the model's health
+                    if not isinstance(error, QueueFullError):
+                        outcomes.setdefault(attempt.model, False)
+                    self.failures.inc((attempt.model, type(error).__name__))
+                    logging.warning(f"Upstream attempt on {attempt.model} failed: {str(error)}")
+                    if close is not None and attempt.handle is not None:
+                        await close(attempt.handle)
+                    if (retryable(error) and retries_left > 0
+                            and (attempt.model in probes or not self.breaker(attempt.model).is_open())):
+                        retries_left -= 1
+                        backoff = min(policy['backoff_max'], policy['backoff_base'] * 2 ** retried)
+                        retried += 1
+                        # Full jitter, so retries from many requests don't line up
+                        launch(attempt.model, 'retry', random.uniform(0, backoff))
+                    elif not retryable(error) and not attempts:
+                        raise error
+
+                if hedge_at is not None and loop.time() >= hedge_at and attempts:
+                    hedge_at = None
+                    if admit(fallback):
+                        logging.info(f"No first delta from {model} after {hedge_delay:.2f}s, hedging with {fallback}")
+                        launch(fallback, 'hedge')
+        finally:
+            # Only reached with attempts left if the caller was cancelled
+            for attempt in list(attempts):
+                await abandon(attempt)
+            for target, ok in outcomes.items():
+                self._record(target, ok, target in probes)
+            for target in probes - set(outcomes):
+                self.breaker(target).release()
+
+        raise last_error
+
+    def collect(self):
+        for model, breaker in self.breakers.items():
+            self.breaker_state.set((model,), BREAKER_STATES[breaker.current()])
+        return [self.attempts, self.failures, self.hedge_wins, self.breaker_rejections, self.breaker_opens,
+                self.breaker_state]
+
+    def stats(self):
+        models = {}
+        for model, breaker in self.breakers.items():
+            models[model] = {
+                "breaker": breaker.current(),
+                "recent_error_rate": round(breaker.outcomes.count(False) / len(breaker.outcomes), 4)
+                if breaker.outcomes else 0.0,
+                "breaker_opens": breaker.opens,
+                "hedge_delay": self.hedge_delay(model, True),
+                "policy": self.policy(model),
+            }
+        return {
+            "default": self.default,
+            "models": models,
+            "counters": {counter.name: counter.dump() for counter in self.collect() if counter.type == 'counter'},
+        }
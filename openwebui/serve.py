@@ -0,0 +1,76 @@
+"""
+Production entry point for the proxy: several worker processes under Hypercorn.
+
+    python serve.py --workers 4 --bind 0.0.0.0:11435
+
+Config is read without prompting, from SUBSTRATE_PROXY_CONFIG (or
+~/.config/substrate-chat/config.json) with SUBSTRATE_API_KEY and
+SUBSTRATE_BASE_URL overriding it. On SIGTERM or SIGINT the workers stop
+accepting connections and give open streams up to --graceful-timeout
+seconds to finish before shutting down.
+"""
+import argparse
+import glob
+import logging
+import os
+import tempfile
+
+from hypercorn.config import Config
+from hypercorn.run import run
+
+from settings import load_or_create_config
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the Substrate Open WebUI proxy with multiple workers.")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get('SUBSTRATE_PROXY_WORKERS', os.cpu_count() or 1)),
+                        help="Number of worker processes (default: CPU count)")
+    parser.add_argument("--bind", default=os.environ.get('SUBSTRATE_PROXY_BIND', '0.0.0.0:11435'),
+                        help="Address to listen on (default: 0.0.0.0:11435)")
+    parser.add_argument("--graceful-timeout", type=float, default=120.0,
+                        help="Seconds open streams get to finish on shutdown (default: 120)")
+    parser.add_argument("--config", help="Config file (default: SUBSTRATE_PROXY_CONFIG or ~/.config/substrate-chat/config.json)")
+    parser.add_argument("--metrics-dir", help="Directory used to merge /metrics across workers (default: a temp dir)")
+    parser.add_argument("--log-level", default="info", help="Proxy log level (default: info)")
+    parser.add_argument("--access-log", action="store_true", help="Write an access log line per request to stdout")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s - %(levelname)s - %(message)s')
+
+    # Workers inherit the environment, so everything they need goes through it
+    os.environ['SUBSTRATE_PROXY_LOG_LEVEL'] = args.log_level
+    if args.config:
+        os.environ['SUBSTRATE_PROXY_CONFIG'] = os.path.abspath(args.config)
+
+    # Fail here, once, rather than in every worker
+    config = load_or_create_config()
+    if not config or not config.get('api_key'):
+        logging.error("API key not found in config or SUBSTRATE_API_KEY. Exiting.")
+        exit(1)
+
+    if args.workers > 1 or args.metrics_dir:
+        metrics_dir = args.metrics_dir or tempfile.mkdtemp(prefix='substrate-proxy-metrics-')
+        os.makedirs(metrics_dir, exist_ok=True)
+        # Series from a previous run would otherwise be added to this one
+        for stale in glob.glob(os.path.join(metrics_dir, '*.json')):
+            os.remove(stale)
+        os.environ['SUBSTRATE_PROXY_METRICS_DIR'] = metrics_dir
+        logging.info(f"Merging metrics across workers in {metrics_dir}")
+
+    hypercorn_config = Config()
+    hypercorn_config.application_path = f"{os.path.join(HERE, 'proxy')}:app"
+    hypercorn_config.bind = [args.bind]
+    hypercorn_config.workers = args.workers
+    hypercorn_config.graceful_timeout = args.graceful_timeout
+    hypercorn_config.accesslog = '-' if args.access_log else None
+    # Streams can be long-lived; don't let idle keep-alive checks cut them off
+    hypercorn_config.keep_alive_timeout = 75
+
+    logging.info(f"Starting {args.workers} worker(s) on {args.bind}")
+    exit(run(hypercorn_config))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+import os
+import sys
+import json
+import logging
+
+CONFIG_DIR = os.path.expanduser('~/.config/substrate-chat')
+CONFIG_FILE = os.path.join(CONFIG_DIR, 'config.json')
+
+
+def load_or_create_config(interactive=True):
+    """
+    Load the proxy config.
+
+    The file is SUBSTRATE_PROXY_CONFIG if set, otherwise ~/.config/substrate-chat/config.json.
+    SUBSTRATE_API_KEY and SUBSTRATE_BASE_URL override the values in it, so
+    workers can be configured from the environment alone. The API key is only
+    prompted for when `interactive` is set and stdin is a terminal.
+    """
+    config_file = os.environ.get('SUBSTRATE_PROXY_CONFIG', CONFIG_FILE)
+    try:
+        config = {}
+        if os.path.exists(config_file):
+            with open(config_file, 'r') as f:
+                config = json.load(f)
+            logging.info(f"Config loaded from {config_file}")
+
+        if os.environ.get('SUBSTRATE_API_KEY'):
+            config['api_key'] = os.environ['SUBSTRATE_API_KEY']
+        if os.environ.get('SUBSTRATE_BASE_URL'):
+            config['base_url'] = os.environ['SUBSTRATE_BASE_URL']
+
+        if not config.get('api_key') and interactive and sys.stdin.isatty():
+            api_key = input("Please enter your Substrate API key: ")
+            config['api_key'] = api_key
+            os.makedirs(os.path.dirname(config_file), exist_ok=True)
+            with open(config_file, 'w') as f:
+                json.dump(config, f)
+            logging.info(f"Config file created at {config_file}")
+        return config
+    except Exception as e:
+        logging.error(f"Error loading or creating config: {str(e)}")
+        return None
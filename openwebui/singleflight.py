@@ -0,0 +1,88 @@
+import asyncio
+import logging
+
+from tee import StreamTee
+
+
+class Flight:
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Coalesces identical in-flight requests by key.
+
+    The first request for a key becomes the leader and starts the upstream
+    work as its own task; followers await the same task (non-streaming) or
+    subscribe to the same StreamTee (streaming). Because the work isn't owned
+    by the leader's handler, a client disconnect only drops that client. The
+    upstream call is cancelled only when nobody is waiting on it any more.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._streams = {}
+        self.leaders = 0
+        self.followers = 0
+        self.abandoned = 0
+
+    def has_call(self, key):
+        return key in self._calls
+
+    def has_stream(self, key):
+        return key in self._streams
+
+    def call(self, key, fn=None):
+        """Return an awaitable for the result of fn(), shared with any identical in-flight call."""
+        flight = self._calls.get(key)
+        if flight is None:
+            flight = Flight(asyncio.ensure_future(fn()))
+            self._calls[key] = flight
+            self.leaders += 1
+            flight.task.add_done_callback(lambda _: self._finish(self._calls, key, flight))
+        else:
+            self.followers += 1
+        return self._wait(flight)
+
+    async def _wait(self, flight):
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                logging.info("All waiters left, cancelling upstream call")
+                self.abandoned += 1
+                flight.task.cancel()
+
+    def stream(self, key, source_factory=None, on_complete=None):
+        """Return a delta iterator, shared with any identical in-flight stream."""
+        tee = self._streams.get(key)
+        if tee is None:
+            tee = StreamTee(source_factory(), on_complete)
+            self._streams[key] = tee
+            self.leaders += 1
+            tee.task.add_done_callback(lambda _: self._finish_stream(key, tee))
+        else:
+            self.followers += 1
+        return tee.subscribe()
+
+    def _finish_stream(self, key, tee):
+        if tee.abandoned:
+            self.abandoned += 1
+        self._finish(self._streams, key, tee)
+
+    def _finish(self, flights, key, flight):
+        if flights.get(key) is flight:
+            del flights[key]
+
+    def stats(self):
+        return {
+            "in_flight_calls": len(self._calls),
+            "in_flight_streams": len(self._streams),
+            "leaders": self.leaders,
+            "followers": self.followers,
+            "abandoned": self.abandoned,
+        }
@@ -0,0 +1,73 @@
+import asyncio
+import logging
+
+
+async def replay_deltas(deltas, delay=0.0):
+    """Yield recorded deltas, optionally paced so clients still see a typing effect."""
+    for i, text in enumerate(deltas):
+        if delay and i:
+            await asyncio.sleep(delay)
+        yield text
+
+
+class StreamTee:
+    """
+    Fans one upstream delta stream out to any number of subscribers.
+
+    The source is drained by its own task, so it doesn't belong to any single
+    client: it keeps running while at least one subscriber is attached and is
+    cancelled once the last one goes away. Every subscriber starts from the
+    first delta, however late it attaches.
+    """
+
+    def __init__(self, source, on_complete=None):
+        self.deltas = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.abandoned = False
+        self._changed = asyncio.Event()
+        self._on_complete = on_complete
+        self.task = asyncio.ensure_future(self._pump(source))
+
+    async def _pump(self, source):
+        try:
+            async for text in source:
+                self.deltas.append(text)
+                self._notify()
+        except Exception as e:
+            logging.error(f"Upstream stream failed: {str(e)}")
+            self.error = e
+        finally:
+            self.done = True
+            self._notify()
+
+        if self.error is None and self._on_complete is not None:
+            try:
+                self._on_complete(self.deltas)
+            except Exception as e:
+                logging.error(f"Error completing tee'd stream: {str(e)}", exc_info=True)
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def subscribe(self):
+        self.subscribers += 1
+        i = 0
+        try:
+            while True:
+                while i < len(self.deltas):
+                    yield self.deltas[i]
+                    i += 1
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await self._changed.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done:
+                logging.info("All subscribers left, cancelling upstream stream")
+                self.abandoned = True
+                self.task.cancel()
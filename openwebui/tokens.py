@@ -0,0 +1,29 @@
+import re
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:
+    # tiktoken is optional; without it we fall back to the estimate below
+    _encoding = None
+
+# Roughly how BPE tokenizers pre-split text: runs of letters, runs of digits
+# (split in threes), and single punctuation marks.
+_PIECES = re.compile(r"[^\W\d_]+|\d{1,3}|[^\w\s]|_+")
+
+
+def estimate_tokens(text):
+    """Tokenizer-free estimate of a BPE token count, used when tiktoken isn't installed."""
+    count = 0
+    for piece in _PIECES.findall(text):
+        # Long words get split into several sub-word tokens
+        count += 1 + (len(piece) - 1) // 6
+    return count
+
+
+def count_tokens(text):
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return estimate_tokens(text)
@@ -0,0 +1,121 @@
+import contextvars
+import json
+import logging
+import os
+import time
+import uuid
+
+request_id_var = contextvars.ContextVar('request_id', default='-')
+
+
+def new_request_id(incoming=None):
+    """Use the caller's X-Request-Id when it looks sane, otherwise make one up."""
+    if incoming and len(incoming) <= 64 and incoming.isprintable():
+        request_id = incoming
+    else:
+        request_id = uuid.uuid4().hex[:16]
+    request_id_var.set(request_id)
+    return request_id
+
+
+class RequestIdFilter(logging.Filter):
+    """Adds %(request_id)s to every log record."""
+
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+
+def install_request_id_logging():
+    # Handler-level, so records propagated from library loggers get it too
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(RequestIdFilter())
+
+
+class SpanLog:
+    """Appends one JSON object per finished request to a file, for offline analysis."""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._logger = logging.getLogger('substrate_proxy.spans')
+        self._logger.propagate = False
+        self._logger.setLevel(logging.INFO)
+        handler = logging.FileHandler(path)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        self._logger.addHandler(handler)
+
+    def write(self, record):
+        self._logger.info(json.dumps(record, separators=(',', ':')))
+
+
+class Span:
+    """
+    One /api/chat request from admission to the last byte.
+
+    The response generators call first_byte()/add_bytes() as they write and
+    finish() once at the end; finish() records the request into the metrics
+    and, if configured, the span log. Bytes are summed locally and added to
+    the counter once, so the per-chunk cost is an integer add.
+    """
+
+    def __init__(self, metrics, model, stream, usage, span_log=None):
+        self.metrics = metrics
+        self.model = model
+        self.stream = stream
+        self.usage = usage
+        self.span_log = span_log
+        self.request_id = request_id_var.get()
+        self.source = 'upstream'
+        # The model whose answer was sent, when a hedge or fallback stood in for `model`
+        self.answered_by = None
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self.ttfb = None
+        self.bytes = 0
+        self.error = None
+        self.finished = False
+
+    def first_byte(self):
+        if self.ttfb is None:
+            self.ttfb = time.perf_counter() - self._start
+
+    def add_bytes(self, n):
+        self.bytes += n
+
+    def fail(self, error_type):
+        self.error = error_type
+
+    def finish(self, status=200):
+        if self.finished:
+            return
+        self.finished = True
+        duration = time.perf_counter() - self._start
+        m = self.metrics
+        m.requests.inc((self.model, 'true' if self.stream else 'false', self.source))
+        if self.error is not None:
+            m.errors.inc((self.model, self.error))
+        if self.ttfb is not None:
+            m.time_to_first_byte.observe(self.model, self.ttfb)
+        m.duration.observe(self.model, duration)
+        if self.bytes:
+            m.bytes_streamed.inc((self.model,), self.bytes)
+
+        if self.span_log is not None:
+            usage = self.usage
+            self.span_log.write({
+                'request_id': self.request_id,
+                'model': self.model,
+                'stream': self.stream,
+                'source': self.source,
+                'answered_by': self.answered_by,
+                'status': status,
+                'error': self.error,
+                'start': self.started_at,
+                'ttfb': self.ttfb,
+                'duration': duration,
+                'bytes': self.bytes,
+                'deltas': usage.delta_count if usage else None,
+                'prompt_tokens': usage.prompt_tokens if usage else None,
+                'completion_tokens': usage.completion_tokens if usage else None,
+            })